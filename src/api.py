@@ -31,7 +31,7 @@ def glm(prompt,model,max_tokens):
 
 client_gpt = OpenAI(
     base_url=config["openai_base_url"], 
-    api_key=config["openai_key"],
+    api_key=config["openai_key"] or None,
     http_client=httpx.Client(
         base_url=config["openai_base_url"],
         follow_redirects=True,
@@ -86,8 +86,23 @@ def remove_consecutive_repeated_sentences(text, threshold=5):
     return cleaned_text
 
 
-@backoff.on_exception(backoff.expo, (Exception), max_time=500)
+async_client = None
+
+def enable_async_client():
+    """Route call_api through the pooled, rate-limited AsyncAPIClient so that many threads can have calls in flight."""
+    global async_client
+    if async_client is None:
+        from async_api import AsyncAPIClient
+        async_client = AsyncAPIClient(config)
+    return async_client
+
 def call_api(prompt,model,max_new_tokens):
+    if async_client is not None:
+        return async_client.call(prompt, model, max_new_tokens)
+    return call_api_sync(prompt, model, max_new_tokens)
+
+@backoff.on_exception(backoff.expo, (Exception), max_time=500)
+def call_api_sync(prompt,model,max_new_tokens):
     if "glm" in model:
         res=glm(prompt,model, max_new_tokens)
     elif "gpt" in model:
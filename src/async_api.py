@@ -0,0 +1,215 @@
+import os
+import time
+import random
+import asyncio
+import argparse
+import threading
+import httpx
+from mock_api import start_mock_server
+
+ZP_BASE_URL = "https://open.bigmodel.cn/api/paas/v4"
+# Rate limited, timed out or failing on the server side: worth another try
+RETRYABLE_STATUS = {408, 409, 429}
+
+
+class APIError(Exception):
+
+    def __init__(self, message, status=None, retryable=False):
+        super().__init__(message)
+        self.status = status
+        self.retryable = retryable
+
+
+class TokenBucket:
+    """Allows `per_minute` units per minute, refilled continuously."""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.rate = per_minute / 60
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+class AsyncAPIClient:
+    """asyncio client for the GLM and GPT chat APIs.
+
+    All requests share one pooled HTTP connection. Each model gets its own request and
+    token budget per minute and its own concurrency limit (`api.rate_limits` in config.yaml,
+    with a `default` entry). Rate limits, timeouts and 5xx responses are retried with
+    jittered exponential backoff; other errors are raised at once. Synchronous code
+    (thread pools in main.py and gen_LRGinstruction.py) submits calls through `call`,
+    which runs them on a background event loop.
+    """
+
+    def __init__(self, config):
+        self.providers = {
+            "glm": (config.get("zp_base_url") or ZP_BASE_URL, config.get("zp_key", ""), 0.99),
+            "gpt": (config.get("openai_base_url", ""), config.get("openai_key", ""), 1),
+        }
+        self.rate_limits = config.get("rate_limits", {})
+        self.max_connections = config.get("max_connections", 100)
+        self.max_retries = config.get("max_retries", 8)
+        self.timeout = config.get("timeout", 120)
+        self.base_backoff = config.get("base_backoff", 1)
+        self.max_backoff = config.get("max_backoff", 60)
+        self.client = None
+        self.models = {}
+        self.loop = None
+        self.start_lock = threading.Lock()
+
+    def _limits(self, model):
+        if model not in self.models:
+            limits = dict(self.rate_limits.get("default", {}), **self.rate_limits.get(model, {}))
+            self.models[model] = (asyncio.Semaphore(limits.get("concurrency", 32)), TokenBucket(limits.get("rpm", 500)), TokenBucket(limits.get("tpm", 1000000)))
+        return self.models[model]
+
+    async def _request(self, prompt, model, max_tokens):
+        if "glm" in model:
+            base_url, key, temperature = self.providers["glm"]
+        elif "gpt" in model:
+            base_url, key, temperature = self.providers["gpt"]
+        else:
+            raise APIError(f"No API provider for model {model}")
+        payload = {"model": model, "messages": [{"role": "user", "content": prompt}], "max_tokens": max_tokens, "temperature": temperature}
+        response = await self.client.post(f"{base_url.rstrip('/')}/chat/completions", json=payload, headers={"Authorization": f"Bearer {key}"} if key else None)
+        if response.status_code != 200:
+            raise APIError(f"{response.status_code}: {response.text[:500]}", response.status_code, response.status_code in RETRYABLE_STATUS or response.status_code >= 500)
+        return response.json()["choices"][0]["message"]["content"]
+
+    async def chat(self, prompt, model, max_tokens):
+        if self.client is None:
+            self.client = httpx.AsyncClient(timeout=self.timeout, follow_redirects=True, limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections))
+        semaphore, requests, tokens = self._limits(model)
+        cleaned = False
+        for attempt in range(self.max_retries + 1):
+            await requests.acquire(1)
+            # Rough prompt size estimate; the exact count is only known to the provider
+            await tokens.acquire(len(prompt) // 4 + max_tokens)
+            try:
+                async with semaphore:
+                    response = await self._request(prompt, model, max_tokens)
+                if response is not None:
+                    return response
+                error = APIError("Empty response", retryable=True)
+            except (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError) as e:
+                error = APIError(f"{type(e).__name__}: {e}", retryable=True)
+            except APIError as e:
+                error = e
+            if not error.retryable:
+                if "gpt" in model and not cleaned:
+                    # Remove duplicate sentences to prevent GPT API from refusing to respond due to repeated input
+                    from api import remove_consecutive_repeated_sentences
+                    prompt = remove_consecutive_repeated_sentences(prompt)
+                    cleaned = True
+                    continue
+                raise error
+            await asyncio.sleep(random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt)))
+        raise error
+
+    def _ensure_loop(self):
+        with self.start_lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def submit(self, prompt, model, max_tokens):
+        self._ensure_loop()
+        return asyncio.run_coroutine_threadsafe(self.chat(prompt, model, max_tokens), self.loop)
+
+    def call(self, prompt, model, max_tokens):
+        return self.submit(prompt, model, max_tokens).result()
+
+    def call_many(self, prompts, model, max_tokens):
+        futures = [self.submit(prompt, model, max_tokens) for prompt in prompts]
+        return [future.result() for future in futures]
+
+    def close(self):
+        if self.loop is None:
+            return
+        if self.client is not None:
+            asyncio.run_coroutine_threadsafe(self.client.aclose(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop = None
+        self.client = None
+
+
+def check_retries():
+    """Retryable failures are retried until success; a 400 raises after one attempt, two for GPT."""
+    server, url = start_mock_server(latency=0, fail_rate=0)
+    client = AsyncAPIClient({"zp_base_url": url, "openai_base_url": url, "base_backoff": 0.01})
+    for prompt, failures in [("fail_429_3", 3), ("fail_500_2", 2), ("fail_503_1", 1), ("fail_408_2", 2)]:
+        assert client.call(prompt, "glm-4", 32).startswith("mock answer"), prompt
+        assert server.attempts[prompt] == failures + 1, (prompt, server.attempts[prompt])
+    for model, attempts in [("glm-4", 1), ("gpt-3.5-turbo", 2)]:
+        before = server.requests
+        try:
+            client.call("bad_request", model, 32)
+            raise AssertionError(f"400 did not raise for {model}")
+        except APIError as e:
+            assert e.status == 400 and not e.retryable, e
+        assert server.requests - before == attempts, (model, server.requests - before)
+    client.close()
+    server.shutdown()
+    print("retries: ok")
+
+def check_concurrency(concurrency=4, num=40):
+    """No more than `concurrency` requests of one model are in flight at once."""
+    server, url = start_mock_server(latency=0.05, fail_rate=0)
+    client = AsyncAPIClient({"zp_base_url": url, "rate_limits": {"default": {"concurrency": concurrency}}})
+    client.call_many([f"Hello {i}" for i in range(num)], "glm-4", 32)
+    assert server.max_in_flight == concurrency, server.max_in_flight
+    client.close()
+    server.shutdown()
+    print(f"concurrency: ok, at most {server.max_in_flight} in flight")
+
+def check_rpm(rpm=600, extra=30):
+    """After the initial burst of `rpm` requests, requests go out at `rpm` per minute."""
+    server, url = start_mock_server(latency=0, fail_rate=0)
+    client = AsyncAPIClient({"zp_base_url": url, "rate_limits": {"default": {"rpm": rpm}}})
+    start_time = time.time()
+    client.call_many([f"Hello {i}" for i in range(rpm + extra)], "glm-4", 32)
+    elapsed = time.time() - start_time
+    expected = extra * 60 / rpm
+    assert expected * 0.9 <= elapsed <= expected + 2, (elapsed, expected)
+    client.close()
+    server.shutdown()
+    print(f"rpm: ok, {rpm + extra} requests in {elapsed:.2f}s, expected {expected:.2f}s")
+
+
+if __name__ == "__main__":
+    # api.py, imported for the GPT prompt cleaning, creates its clients at import and needs some key
+    os.environ.setdefault("OPENAI_API_KEY", "offline")
+    parser = argparse.ArgumentParser(description="Check the client against the local mock API server, then run concurrent calls with injected failures.")
+    parser.add_argument('--num', type=int, default=300)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--rpm', type=int, default=6000)
+    parser.add_argument('--latency', type=float, default=0.2)
+    parser.add_argument('--fail_rate', type=float, default=0.1)
+    args = parser.parse_args()
+
+    check_retries()
+    check_concurrency()
+    check_rpm()
+
+    server, url = start_mock_server(latency=args.latency, fail_rate=args.fail_rate)
+    client = AsyncAPIClient({"zp_base_url": url, "openai_base_url": url, "rate_limits": {"default": {"rpm": args.rpm, "concurrency": args.concurrency}}})
+    start_time = time.time()
+    responses = client.call_many([f"Hello {i}" for i in range(args.num)], "gpt-3.5-turbo", 32)
+    elapsed = time.time() - start_time
+    assert len(responses) == args.num and server.requests == args.num + server.failures, (server.requests, server.failures)
+    print(f"{len(responses)} responses in {elapsed:.2f}s, {server.requests} requests served, {server.failures} injected failures retried")
+    client.close()
+    server.shutdown()
@@ -0,0 +1,314 @@
+"""Offline benchmark of the retrieval and generation pipeline.
+
+Builds a synthetic corpus and eval set at several scales and times process_data,
+calculate_embeddings, vector_search, sort_section, s2l_doc, filter and extractor on CPU
+without network access. It also measures the recall of dense and BM25-fused retrieval
+against the rerank latency at several top_k1, and the latency of cascaded reranking
+together with its agreement with the full ranking, and the latency of sharded search
+together with its agreement with the single index. The embedder is a deterministic
+hashing stub. The reranker is a word-overlap stub or, with --reranker tiny, a small
+randomly initialised BERT cross-encoder. The generator is a stub with configurable
+latency. Results are written as JSON; --compare reports stages that got slower than a
+previous result file.
+
+    python bench.py --scales 1000 10000 --output bench_results.json
+    python bench.py --scales 1000 10000 --compare bench_results.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import platform
+import subprocess
+import tempfile
+from types import SimpleNamespace
+from multiprocessing.dummy import Pool as ThreadPool
+import numpy as np
+import torch
+from tracing import Tracer, percentile
+from tokens import TokenCounter
+
+WORDS = [f"w{i}" for i in range(5000)]
+STOP = [".", ",", ";", "!", "?"]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the LongRAG pipeline offline.")
+    parser.add_argument('--scales', type=int, nargs="+", default=[1000, 10000], help="Numbers of corpus paragraphs")
+    parser.add_argument('--questions', type=int, default=32, help="Number of questions timed per stage")
+    parser.add_argument('--dimension', type=int, default=128, help="Dimension of the stub embeddings")
+    parser.add_argument('--index_type', type=str, default="flat", help="Index type passed to calculate_embeddings")
+    parser.add_argument('--reranker', type=str, choices=["stub", "tiny"], default="stub")
+    parser.add_argument('--gen_latency', type=float, default=0.0, help="Seconds the stub generator sleeps per call")
+    parser.add_argument('--workers', type=int, default=1, help="Chunking processes for process_data")
+    parser.add_argument('--top_k1', type=int, default=100)
+    parser.add_argument('--top_k2', type=int, default=7)
+    parser.add_argument('--recall_top_k1', type=int, nargs="*", default=[10, 25, 50, 100], help="top_k1 values at which dense and hybrid recall and rerank latency are measured")
+    parser.add_argument('--cascade_keep', type=int, nargs="*", default=[15, 30, 50], help="Cascade sizes at which rerank latency and agreement with the full ranking are measured")
+    parser.add_argument('--num_shards', type=int, nargs="*", default=[2, 4], help="Shard counts at which sharded search latency and agreement with the single index are measured")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', type=str, default="bench_results.json")
+    parser.add_argument('--compare', type=str, default="", help="Previous result file to compare against")
+    parser.add_argument('--threshold', type=float, default=1.2, help="Slowdown ratio reported as a regression")
+    return parser.parse_args()
+
+
+def synthetic_data(num_paragraphs, num_questions, seed):
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(num_paragraphs):
+        sentences = []
+        for _ in range(rng.randint(3, 40)):
+            sentences.append(" ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 25))) + rng.choice(STOP))
+        corpus.append({"title": f"doc{i}", "paragraph_text": " ".join(sentences)})
+    questions = []
+    for _ in range(num_questions):
+        paragraph_id = rng.randrange(num_paragraphs)
+        words = corpus[paragraph_id]["paragraph_text"].split()
+        questions.append({"question": " ".join(rng.sample(words, min(8, len(words)))) + "?", "answers": [rng.choice(words).strip(".,;!?")], "paragraph_id": paragraph_id})
+    return corpus, questions
+
+def word_ids(text):
+    return [int(hashlib.md5(w.encode('utf-8')).hexdigest()[:8], 16) for w in text.lower().split()]
+
+
+class StubEmbedder:
+    """Deterministic hashed bag-of-words embeddings."""
+
+    def __init__(self, dimension=128):
+        self.dimension = dimension
+
+    def to(self, device):
+        return self
+
+    def encode(self, texts, batch_size=32, **kwargs):
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for h in word_ids(text):
+                vectors[i, h % self.dimension] += 1.0 if h & 1 else -1.0
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-6)
+
+
+class StubCrossTokenizer:
+    """Encodes each (question, passage) pair as its word-overlap score."""
+
+    def __call__(self, questions, passages, max_length=None, **kwargs):
+        if max_length:
+            passages = [" ".join(p.split()[:max_length]) for p in passages]
+        scores = [len(set(q.lower().split()) & set(p.lower().split())) / (1 + len(p.split()) ** 0.5) for q, p in zip(questions, passages)]
+        return SimpleNamespace(to=lambda device: {"scores": torch.tensor(scores, dtype=torch.float32)})
+
+
+class StubCrossModel:
+
+    def eval(self):
+        return self
+
+    def __call__(self, scores):
+        return SimpleNamespace(logits=scores[:, None])
+
+
+class WhitespaceTokenizer:
+    """Minimal tokenizer with the call/decode interface used by TokenCounter."""
+
+    def __call__(self, text, **kwargs):
+        ids = [word_ids(t) for t in text] if isinstance(text, list) else word_ids(text)
+        return SimpleNamespace(input_ids=ids)
+
+    def decode(self, ids, **kwargs):
+        return " ".join(str(i) for i in ids)
+
+
+def tiny_reranker(tmp_dir, seed):
+    from transformers import BertConfig, BertForSequenceClassification, BertTokenizerFast
+    torch.manual_seed(seed)
+    vocab_path = os.path.join(tmp_dir, "vocab.txt")
+    with open(vocab_path, "w", encoding='utf-8') as fout:
+        fout.write("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + WORDS + STOP))
+    tokenizer = BertTokenizerFast(vocab_path)
+    model = BertForSequenceClassification(BertConfig(vocab_size=len(WORDS) + 10, hidden_size=128, num_hidden_layers=2, num_attention_heads=2, intermediate_size=256, num_labels=1))
+    return tokenizer, model.eval()
+
+
+def stub_pred(model_name, model, tokenizer, prompt, maxlen, max_new_tokens=32, temperature=1):
+    import main
+    prompt, prompt_len = main.set_prompt(prompt, maxlen)
+    if main.bench_gen_latency:
+        time.sleep(main.bench_gen_latency)
+    if "json format" in prompt:
+        return '{"status": "True"}' if len(prompt) % 2 else '{"status": "False"}', prompt_len
+    return " ".join(prompt.split()[:min(max_new_tokens, 50)]), prompt_len
+
+
+def timed(results, scale, stage, fn, items, count=1):
+    """Time fn(item) for every item; `count` is the number of units each call processes."""
+    durations = []
+    outputs = []
+    for item in items:
+        start = time.perf_counter()
+        outputs.append(fn(item))
+        durations.append(time.perf_counter() - start)
+    total = sum(durations)
+    results.append({
+        "scale": scale,
+        "stage": stage,
+        "calls": len(durations),
+        "mean_ms": round(1000 * total / len(durations), 3),
+        "p50_ms": round(1000 * percentile(durations, 50), 3),
+        "p95_ms": round(1000 * percentile(durations, 95), 3),
+        "throughput_per_s": round(count * len(durations) / total, 2) if total else 0.0,
+    })
+    print(f"[{scale}] {stage}: {results[-1]['mean_ms']} ms/call")
+    return outputs
+
+def setup_main(args, save_path, tmp_dir):
+    # main.py parses its own command line only when run as a script. The API clients
+    # are created at import and need some key, although the benchmark never calls them.
+    os.environ.setdefault("OPENAI_API_KEY", "offline")
+    import main
+    from vector_store import load_index
+    from chunk_store import load_chunk_store
+    main.args.top_k1, main.args.top_k2 = args.top_k1, args.top_k2
+    main.args.batch_size = args.questions
+    main.device = torch.device("cpu")
+    main.emb_model = StubEmbedder(args.dimension)
+    main.vector, _ = load_index(f"{save_path}/vector.index")
+    main.chunk_data, main.id_to_rawid, main.paragraphs = load_chunk_store(save_path)
+    if args.reranker == "tiny":
+        main.cross_tokenizer, main.cross_model = tiny_reranker(tmp_dir, args.seed)
+    else:
+        main.cross_tokenizer, main.cross_model = StubCrossTokenizer(), StubCrossModel()
+    main.emb_cache = main.rerank_cache = main.prefix_cache = main.token_lengths = main.bm25_index = None
+    main.generation = main.deleted_chunk_mask = main.index_params = None
+    main.tracer = Tracer()
+    main.set_prompt_tokenizer = WhitespaceTokenizer()
+    main.token_counter = TokenCounter(main.set_prompt_tokenizer)
+    main.filter_pool = ThreadPool(processes=main.args.MaxClients)
+    main.pred = stub_pred
+    main.bench_gen_latency = args.gen_latency
+    main.model_name = main.lrag_model_name = "stub"
+    main.model = main.tokenizer = main.lrag_model = main.lrag_tokenizer = None
+    main.maxlen = main.lrag_maxlen = 30000
+    return main
+
+def run_scale(args, scale, results):
+    import gen_index
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        corpus, questions = synthetic_data(scale, args.questions, args.seed)
+        raw_path = os.path.join(tmp_dir, "raw.json")
+        with open(raw_path, "w", encoding='utf-8') as fout:
+            json.dump(corpus, fout)
+        save_path = os.path.join(tmp_dir, "processed")
+
+        chunks = timed(results, scale, "process_data", lambda _: gen_index.process_data(raw_path, 200, 2, 2, save_path, args.workers), [None], scale)[0]
+        gen_index.SentenceTransformer = lambda model_path: StubEmbedder(args.dimension)
+        index_config = {"index_type": args.index_type, "nlist": 256, "pq_m": 16, "hnsw_m": 32, "nprobe": 32, "ef_search": 128, "train_size": 100000, "recall_top_k": args.top_k1, "recall_queries": 200}
+        timed(results, scale, "calculate_embeddings", lambda _: gen_index.calculate_embeddings(chunks, "stub", f"{save_path}/vector.index", index_config), [None], len(chunks))
+
+        main = setup_main(args, save_path, tmp_dir)
+        qs = [q["question"] for q in questions]
+        retrieved = timed(results, scale, "vector_search", main.vector_search, qs)
+        timed(results, scale, "vector_search_batch", main.vector_search_batch, [qs], len(qs))
+        reranked = timed(results, scale, "sort_section", lambda i: main.sort_section(qs[i], *retrieved[i]), range(len(qs)))
+        timed(results, scale, "sort_section_batch", lambda _: main.sort_section_batch(qs, [r[0] for r in retrieved], [r[1] for r in retrieved]), [None], len(qs))
+        timed(results, scale, "s2l_doc", lambda i: main.s2l_doc(reranked[i][0], reranked[i][1], main.lrag_maxlen), range(len(qs)))
+        timed(results, scale, "filter", lambda i: main.filter(qs[i], reranked[i][0]), range(len(qs)))
+        timed(results, scale, "extractor", lambda i: main.extractor(qs[i], reranked[i][0], reranked[i][1]), range(len(qs)))
+        recall_sweep(args, scale, results, main, save_path, questions)
+        cascade_sweep(args, scale, results, main, qs)
+        shard_sweep(args, scale, results, main, save_path, qs, chunks, index_config)
+        main.filter_pool.close()
+
+def recall_sweep(args, scale, results, main, save_path, questions):
+    """Recall of the gold paragraph among the top_k1 candidates, and after reranking, against
+    the rerank latency, for dense retrieval alone and fused with BM25."""
+    from bm25 import build_bm25, BM25Index
+    timed(results, scale, "build_bm25", lambda _: build_bm25(main.chunk_data, save_path), [None], len(main.chunk_data))
+    bm25_index = BM25Index(save_path)
+    qs = [q["question"] for q in questions]
+    gold = [q["paragraph_id"] for q in questions]
+    top_k1 = main.args.top_k1
+    for method in ["dense", "hybrid"]:
+        main.bm25_index = bm25_index if method == "hybrid" else None
+        for k in args.recall_top_k1:
+            main.args.top_k1 = k
+            retrieved = main.vector_search_batch(qs)
+            reranked = timed(results, scale, f"sort_section.{method}@{k}", lambda i: main.sort_section(qs[i], *retrieved[i]), range(len(qs)))
+            results[-1]["recall"] = round(sum(g in {int(main.id_to_rawid[i]) for i in ids} for g, (_, ids) in zip(gold, retrieved)) / len(qs), 4)
+            results[-1]["rerank_recall"] = round(sum(g in {int(main.id_to_rawid[i]) for i in ids} for g, (_, ids) in zip(gold, reranked)) / len(qs), 4)
+            print(f"[{scale}] {method}@{k}: recall {results[-1]['recall']}, after rerank {results[-1]['rerank_recall']}")
+    main.bm25_index = None
+    main.args.top_k1 = top_k1
+
+def cascade_sweep(args, scale, results, main, qs):
+    """Rerank latency of the cascade and the agreement of its top_k2 with the full ranking."""
+    retrieved = main.vector_search_batch(qs)
+    full = [main.sort_section(q, *r)[1] for q, r in zip(qs, retrieved)]
+    for first_pass in ["truncated", "dense"]:
+        for keep in args.cascade_keep:
+            main.args.cascade_keep, main.args.cascade_first_pass = keep, first_pass
+            reranked = timed(results, scale, f"sort_section.cascade_{first_pass}@{keep}", lambda i: main.sort_section(qs[i], *retrieved[i]), range(len(qs)))
+            results[-1]["overlap"] = round(sum(len(set(r[1]) & set(f)) / max(1, len(f)) for r, f in zip(reranked, full)) / len(qs), 4)
+            results[-1]["same_order"] = round(sum(r[1] == f for r, f in zip(reranked, full)) / len(qs), 4)
+            print(f"[{scale}] cascade {first_pass}@{keep}: top_k2 overlap {results[-1]['overlap']}, identical ranking {results[-1]['same_order']}")
+    main.args.cascade_keep = 0
+
+def shard_sweep(args, scale, results, main, save_path, qs, chunks, index_config):
+    """Latency of vector_search_batch over shard indexes searched by local node processes, and
+    the share of questions whose top_k1 is that of the single index. FAISS does not order equal
+    scores, so both are compared ordered by score and then id."""
+    from sharding import ShardedIndex, build_shards, merge_results
+    embeddings = StubEmbedder(args.dimension).encode(chunks)
+    features = main.embed_questions(qs)
+    single = main.vector
+    expected = merge_results([single.search(features, main.args.top_k1)], main.args.top_k1)
+    for num_shards in args.num_shards:
+        build_shards(embeddings, save_path, num_shards, index_config)
+        main.vector = ShardedIndex(save_path)
+        timed(results, scale, f"vector_search_batch.shards@{num_shards}", main.vector_search_batch, [qs], len(qs))
+        distances, ids = main.vector.search(features, main.args.top_k1)
+        results[-1]["same_ids"] = round(float(np.mean((ids == expected[1]).all(axis=1) & np.isclose(distances, expected[0]).all(axis=1))), 4)
+        print(f"[{scale}] {num_shards} shards: identical top_k1 {results[-1]['same_ids']}")
+        main.vector.close()
+    main.vector = single
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    import faiss
+    return {"commit": commit, "python": platform.python_version(), "torch": torch.__version__, "faiss": faiss.__version__, "machine": platform.machine(), "cpus": os.cpu_count()}
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = {(r["scale"], r["stage"]): r for r in json.load(f)["results"]}
+    regressions = []
+    for r in results:
+        base = baseline.get((r["scale"], r["stage"]))
+        if base and base["mean_ms"] > 0:
+            ratio = r["mean_ms"] / base["mean_ms"]
+            print(f"[{r['scale']}] {r['stage']}: {base['mean_ms']} -> {r['mean_ms']} ms ({ratio:.2f}x)")
+            if ratio > threshold:
+                regressions.append({"scale": r["scale"], "stage": r["stage"], "ratio": round(ratio, 3)})
+    return regressions
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    torch.set_num_threads(max(1, os.cpu_count() or 1))
+    results = []
+    for scale in args.scales:
+        run_scale(args, scale, results)
+    output = {"environment": environment(), "config": vars(args), "results": results}
+    if args.compare:
+        output["regressions"] = compare(results, args.compare, args.threshold)
+    with open(args.output, "w", encoding='utf-8') as fout:
+        json.dump(output, fout, ensure_ascii=False, indent=4)
+    if output.get("regressions"):
+        print(f"Regressions over {args.threshold}x: {output['regressions']}")
+        sys.exit(1)
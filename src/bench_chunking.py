@@ -0,0 +1,61 @@
+import os
+import json
+import time
+import random
+import argparse
+from chunking import split_sentences, chunk_contents
+
+WORDS = ["the", "river", "Paris", "1998", "album", "İstanbul", "straße", "won", "award", "film", "directed", "by", "O'Neil", "co-founder", "北京", "大学", "电影", "导演", "_id"]
+PUNCT = ["", "", "", " ", ",", ".", "!", "?", ";", "。", "，", "！", "？", " - ", "\n"]
+
+
+def synthetic_corpus(num_paragraphs, max_words, seed=42):
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(num_paragraphs):
+        words = [rng.choice(WORDS) + rng.choice(PUNCT) for _ in range(rng.randint(1, max_words))]
+        corpus.append(" ".join(words))
+    return corpus
+
+def legacy_chunking(corpus, chunk_size, min_sentence, overlap):
+    id_to_rawid = {}
+    processed_chunks = []
+    for idx, content in enumerate(corpus):
+        chunks = split_sentences(content, chunk_size, min_sentence, overlap)
+        for i, chunk in enumerate(chunks):
+            id_to_rawid[len(processed_chunks) + i] = idx
+        processed_chunks.extend(chunks)
+    return processed_chunks, id_to_rawid
+
+def fast_chunking(corpus, chunk_size, min_sentence, overlap, workers):
+    id_to_rawid = {}
+    processed_chunks = []
+    for idx, (_, chunks) in enumerate(chunk_contents(corpus, chunk_size, min_sentence, overlap, workers)):
+        for i, chunk in enumerate(chunks):
+            id_to_rawid[len(processed_chunks) + i] = idx
+        processed_chunks.extend(chunks)
+    return processed_chunks, id_to_rawid
+
+def dumps(chunks, id_to_rawid):
+    return json.dumps(chunks, ensure_ascii=False).encode('utf-8'), json.dumps(id_to_rawid, ensure_ascii=False).encode('utf-8')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the chunking engine against split_sentences.")
+    parser.add_argument('--num_paragraphs', type=int, default=20000)
+    parser.add_argument('--max_words', type=int, default=1500)
+    parser.add_argument('--chunk_size', type=int, default=200)
+    parser.add_argument('--min_sentence', type=int, default=2)
+    parser.add_argument('--overlap', type=int, default=2)
+    parser.add_argument('--workers', type=int, nargs="+", default=[1, os.cpu_count()])
+    args = parser.parse_args()
+
+    corpus = synthetic_corpus(args.num_paragraphs, args.max_words)
+    start_time = time.time()
+    expected = dumps(*legacy_chunking(corpus, args.chunk_size, args.min_sentence, args.overlap))
+    results = {"num_paragraphs": args.num_paragraphs, "legacy_seconds": round(time.time() - start_time, 3), "engine": []}
+    for workers in args.workers:
+        start_time = time.time()
+        output = dumps(*fast_chunking(corpus, args.chunk_size, args.min_sentence, args.overlap, workers))
+        results["engine"].append({"workers": workers, "seconds": round(time.time() - start_time, 3), "identical": output == expected})
+    print(json.dumps(results, indent=4))
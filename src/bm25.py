@@ -0,0 +1,141 @@
+import os
+import json
+import shutil
+from array import array
+from collections import Counter
+import numpy as np
+from tqdm import tqdm
+from chunking import WORD_PATTERN
+
+
+def tokenize(text):
+    return WORD_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+    """BM25 over the chunks of a build, stored as a term-major CSR matrix of precomputed impacts.
+
+    `indptr[t]:indptr[t + 1]` delimits the postings of term t in `doc_ids` (chunk ids) and
+    `impacts` (idf * saturated, length-normalised term frequency), so a query only sums the
+    postings of its terms. The arrays are memory-mapped from `{path}/bm25/`.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.join(path, "bm25")
+        with open(f"{self.path}/vocab.json", encoding='utf-8') as f:
+            self.vocab = json.load(f)
+        with open(f"{self.path}/meta.json", encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.indptr = np.load(f"{self.path}/indptr.npy", mmap_mode='r')
+        self.doc_ids = np.load(f"{self.path}/doc_ids.npy", mmap_mode='r')
+        self.impacts = np.load(f"{self.path}/impacts.npy", mmap_mode='r')
+
+    def search(self, query, top_k):
+        """Return (scores, chunk ids) of the `top_k` best chunks, best first."""
+        ids, weights = [], []
+        for term, count in Counter(tokenize(query)).items():
+            t = self.vocab.get(term)
+            if t is None:
+                continue
+            start, end = self.indptr[t], self.indptr[t + 1]
+            ids.append(self.doc_ids[start:end])
+            weights.append(self.impacts[start:end] * count)
+        if not ids:
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+        docs, inverse = np.unique(np.concatenate(ids), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(weights)).astype(np.float32)
+        if len(scores) > top_k:
+            top = np.argpartition(-scores, top_k - 1)[:top_k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return scores[top], docs[top].astype(np.int64)
+
+    def search_batch(self, queries, top_k):
+        return [self.search(query, top_k) for query in queries]
+
+
+def has_bm25(path):
+    return all(os.path.exists(f"{path}/bm25/{name}") for name in ["vocab.json", "meta.json", "indptr.npy", "doc_ids.npy", "impacts.npy"])
+
+def bm25_num_docs(path):
+    """Number of chunks the BM25 index in `{path}/bm25/` was built over, None if there is none."""
+    if not has_bm25(path):
+        return None
+    with open(f"{path}/bm25/meta.json", encoding='utf-8') as f:
+        return json.load(f)["num_docs"]
+
+def commit_bm25(path):
+    """Swap the index staged in `{path}/bm25.tmp/` in for `{path}/bm25/`."""
+    bm25_path = os.path.join(path, "bm25")
+    if os.path.exists(bm25_path):
+        if os.path.exists(f"{bm25_path}.old"):
+            shutil.rmtree(f"{bm25_path}.old")
+        os.replace(bm25_path, f"{bm25_path}.old")
+    os.replace(f"{bm25_path}.tmp", bm25_path)
+    if os.path.exists(f"{bm25_path}.old"):
+        shutil.rmtree(f"{bm25_path}.old")
+
+def build_bm25(chunks, path, k1=0.9, b=0.4, commit=True):
+    """Build the BM25 index of `chunks` (any sized sequence of strings) into `{path}/bm25/`.
+
+    The index is written to `{path}/bm25.tmp/` first. With `commit=False` it stays there
+    until `commit_bm25`, so the caller can swap it in together with the vector index.
+    """
+    vocab = {}
+    term_ids, doc_ids, tfs = array('i'), array('i'), array('i')
+    doc_lens = np.empty(len(chunks), dtype=np.int32)
+    for doc_id in tqdm(range(len(chunks)), desc="Building BM25 index"):
+        tokens = tokenize(chunks[doc_id])
+        doc_lens[doc_id] = len(tokens)
+        for term, tf in Counter(tokens).items():
+            term_ids.append(vocab.setdefault(term, len(vocab)))
+            doc_ids.append(doc_id)
+            tfs.append(tf)
+    term_ids = np.frombuffer(term_ids, dtype=np.int32)
+    order = np.argsort(term_ids, kind='stable')
+    term_ids = term_ids[order]
+    doc_ids = np.frombuffer(doc_ids, dtype=np.int32)[order]
+    tfs = np.frombuffer(tfs, dtype=np.int32)[order].astype(np.float32)
+    indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(term_ids, minlength=len(vocab)), out=indptr[1:])
+
+    num_docs = len(chunks)
+    avgdl = float(doc_lens.mean()) if num_docs else 0.
+    df = np.diff(indptr).astype(np.float64)
+    idf = np.log(1 + (num_docs - df + 0.5) / (df + 0.5))
+    norm = k1 * (1 - b + b * doc_lens[doc_ids] / max(avgdl, 1e-6))
+    impacts = (np.repeat(idf, np.diff(indptr)) * tfs * (k1 + 1) / (tfs + norm)).astype(np.float32)
+
+    staged_path = os.path.join(path, "bm25.tmp")
+    if os.path.exists(staged_path):
+        shutil.rmtree(staged_path)
+    os.makedirs(staged_path)
+    for name, values in [("indptr", indptr), ("doc_ids", doc_ids), ("impacts", impacts)]:
+        np.save(f"{staged_path}/{name}.npy", values)
+    with open(f"{staged_path}/vocab.json", "w", encoding='utf-8') as fout:
+        json.dump(vocab, fout, ensure_ascii=False)
+    with open(f"{staged_path}/meta.json", "w", encoding='utf-8') as fout:
+        json.dump({"k1": k1, "b": b, "num_docs": num_docs, "avgdl": avgdl, "num_terms": len(vocab), "num_postings": len(doc_ids)}, fout)
+    if commit:
+        commit_bm25(path)
+
+def fuse(dense, sparse, top_k, method="rrf", rrf_k=60, dense_weight=0.5):
+    """Fuse two (scores, ids) result lists, best first, into the `top_k` best ids.
+
+    `rrf` sums 1 / (rrf_k + rank) over the lists; `weighted` sums the min-max normalised
+    scores weighted by `dense_weight` and 1 - `dense_weight`.
+    """
+    fused = {}
+    for (scores, ids), weight in [(dense, dense_weight), (sparse, 1 - dense_weight)]:
+        valid = [(float(s), int(i)) for s, i in zip(scores, ids) if i >= 0]
+        if not valid:
+            continue
+        if method == "rrf":
+            contributions = [1 / (rrf_k + rank + 1) for rank in range(len(valid))]
+        else:
+            low, high = min(s for s, _ in valid), max(s for s, _ in valid)
+            contributions = [weight * ((s - low) / (high - low) if high > low else 1.) for s, _ in valid]
+        for (_, i), c in zip(valid, contributions):
+            fused[i] = fused.get(i, 0.) + c
+    return sorted(fused, key=lambda i: -fused[i])[:top_k]
@@ -0,0 +1,86 @@
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class PredCache:
+    """Prediction cache shared by all pipeline modes of one run.
+
+    Entries are keyed by (question, model, mode, prompt hash). The jsonl backend keeps
+    the per-mode files (`rb_pred.json`, `fil_pred.json`, ...) and loads each of them
+    once into an in-memory index; the sqlite backend stores everything in one keyed table.
+    """
+
+    def __init__(self, log_path, model_name, prompt_hash, backend="jsonl"):
+        self.log_path = log_path
+        self.model_name = model_name
+        self.prompt_hash = prompt_hash
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.index = {}
+        self.files = {}
+        self.db = None
+        if backend == "sqlite":
+            self.db = sqlite3.connect(os.path.join(log_path, "pred_cache.sqlite"), check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS preds (qhash TEXT, model TEXT, mode TEXT, prompt_hash TEXT, question TEXT, pred TEXT, input_len INTEGER, PRIMARY KEY (qhash, model, mode, prompt_hash))")
+            self.db.commit()
+        elif backend != "jsonl":
+            raise ValueError(f"Unknown cache backend: {backend}")
+
+    def _load(self, pred_key):
+        # Parse the mode file once; later lookups are dict hits
+        index = {}
+        cache_path = os.path.join(self.log_path, f"{pred_key}.json")
+        if os.path.exists(cache_path):
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    data = json.loads(line)
+                    if data.get("model") != self.model_name or data.get("prompt_hash") != self.prompt_hash:
+                        continue
+                    index[text_hash(data["question"])] = (data[pred_key], data["input_len"])
+        self.index[pred_key] = index
+        return index
+
+    def get(self, question, pred_key):
+        qhash = text_hash(question)
+        with self.lock:
+            if self.db is not None:
+                row = self.db.execute("SELECT pred, input_len FROM preds WHERE qhash=? AND model=? AND mode=? AND prompt_hash=?", (qhash, self.model_name, pred_key, self.prompt_hash)).fetchone()
+                return tuple(row) if row else None
+            index = self.index.get(pred_key)
+            if index is None:
+                index = self._load(pred_key)
+            return index.get(qhash)
+
+    def put(self, question, pred_key, pred_result, input_len):
+        qhash = text_hash(question)
+        with self.lock:
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO preds VALUES (?, ?, ?, ?, ?, ?, ?)", (qhash, self.model_name, pred_key, self.prompt_hash, question, pred_result, input_len))
+                self.db.commit()
+                return
+            if pred_key not in self.index:
+                self._load(pred_key)
+            self.index[pred_key][qhash] = (pred_result, input_len)
+            f = self.files.get(pred_key)
+            if f is None:
+                f = self.files[pred_key] = open(os.path.join(self.log_path, f"{pred_key}.json"), 'a', encoding='utf-8')
+            f.write(json.dumps({'question': question, pred_key: pred_result, "input_len": input_len, "model": self.model_name, "prompt_hash": self.prompt_hash}, ensure_ascii=False) + '\n')
+            f.flush()
+
+    def close(self):
+        with self.lock:
+            for f in self.files.values():
+                f.close()
+            self.files = {}
+            if self.db is not None:
+                self.db.close()
+                self.db = None
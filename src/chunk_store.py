@@ -0,0 +1,186 @@
+import os
+import json
+import mmap
+import hashlib
+from array import array
+import numpy as np
+from retrieval_cache import safe_name
+
+
+class TextStore:
+    """Read-only list of strings backed by a memory-mapped UTF-8 blob (`{prefix}.bin`) and an
+    int64 offset table (`{prefix}.offsets.npy`). Texts are decoded only when accessed."""
+
+    def __init__(self, prefix):
+        self.offsets = np.load(f"{prefix}.offsets.npy", mmap_mode='r')
+        with open(f"{prefix}.bin", "rb") as f:
+            self.blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(f"{prefix}.bin") else b''
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.blob[int(self.offsets[i]):int(self.offsets[i + 1])].decode('utf-8')
+
+
+class TextStoreWriter:
+    """Writes a TextStore. With `append`, texts are added after the first `keep` texts (all by
+    default) of the existing store: the blob grows in place and the offset table is replaced
+    on close, so readers of the old table never see a partial text."""
+
+    def __init__(self, prefix, append=False, keep=None):
+        self.prefix = prefix
+        self.append_mode = append
+        self.offsets = array('q', [0])
+        if append:
+            self.offsets = array('q')
+            self.offsets.frombytes(np.load(f"{prefix}.offsets.npy")[:None if keep is None else keep + 1].astype(np.int64).tobytes())
+            self.fout = open(f"{prefix}.bin", "r+b")
+            # Drop whatever an interrupted append left after the last committed text
+            self.fout.truncate(self.offsets[-1])
+            self.fout.seek(self.offsets[-1])
+        else:
+            self.fout = open(f"{prefix}.bin.tmp", "wb")
+
+    def append(self, text):
+        data = text.encode('utf-8')
+        self.fout.write(data)
+        self.offsets.append(self.offsets[-1] + len(data))
+
+    def close(self):
+        self.fout.close()
+        with open(f"{self.prefix}.offsets.npy.tmp", "wb") as fout:
+            np.save(fout, np.frombuffer(self.offsets, dtype=np.int64))
+        if not self.append_mode:
+            os.replace(f"{self.prefix}.bin.tmp", f"{self.prefix}.bin")
+        os.replace(f"{self.prefix}.offsets.npy.tmp", f"{self.prefix}.offsets.npy")
+
+
+class ChunkStoreWriter:
+    """Writes `chunks.*`, `paragraphs.*` and `id_to_rawid.npy` into `save_path`.
+
+    With `append`, paragraphs are added to the existing store after its first `num_chunks`
+    chunks (all by default) and the paragraphs they belong to.
+    """
+
+    def __init__(self, save_path, append=False, num_chunks=None):
+        self.save_path = save_path
+        self.id_to_rawid = array('i')
+        if append:
+            id_to_rawid = np.load(f"{save_path}/id_to_rawid.npy")[:num_chunks]
+            num_paragraphs = int(id_to_rawid[-1]) + 1 if len(id_to_rawid) else 0
+            self.id_to_rawid.frombytes(id_to_rawid.astype(np.int32).tobytes())
+            self.chunks = TextStoreWriter(f"{save_path}/chunks", True, len(id_to_rawid))
+            self.paragraphs = TextStoreWriter(f"{save_path}/paragraphs", True, num_paragraphs)
+        else:
+            self.chunks = TextStoreWriter(f"{save_path}/chunks")
+            self.paragraphs = TextStoreWriter(f"{save_path}/paragraphs")
+
+    def add_paragraph(self, paragraph, chunks):
+        raw_id = len(self.paragraphs.offsets) - 1
+        self.paragraphs.append(paragraph)
+        for chunk in chunks:
+            self.chunks.append(chunk)
+            self.id_to_rawid.append(raw_id)
+
+    def close(self):
+        self.chunks.close()
+        self.paragraphs.close()
+        with open(f"{self.save_path}/id_to_rawid.npy.tmp", "wb") as fout:
+            np.save(fout, np.frombuffer(self.id_to_rawid, dtype=np.int32))
+        os.replace(f"{self.save_path}/id_to_rawid.npy.tmp", f"{self.save_path}/id_to_rawid.npy")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+
+
+def has_chunk_store(path):
+    return all(os.path.exists(f"{path}/{name}") for name in ["chunks.bin", "chunks.offsets.npy", "paragraphs.bin", "paragraphs.offsets.npy", "id_to_rawid.npy"])
+
+def load_chunk_store(path):
+    """Return (chunks, id_to_rawid, paragraphs) opened via mmap."""
+    return TextStore(f"{path}/chunks"), np.load(f"{path}/id_to_rawid.npy", mmap_mode='r'), TextStore(f"{path}/paragraphs")
+
+def token_lengths_dir(path, tokenizer_name):
+    return os.path.join(path, "token_lengths", safe_name(tokenizer_name))
+
+def save_token_lengths(path, tokenizer_name, paragraph_lens, chunk_lens):
+    """Store the token counts of every paragraph and chunk of the store in `path` under one tokenizer."""
+    lengths_dir = token_lengths_dir(path, tokenizer_name)
+    os.makedirs(lengths_dir, exist_ok=True)
+    for name, lens in [("paragraphs", paragraph_lens), ("chunks", chunk_lens)]:
+        with open(f"{lengths_dir}/{name}.npy.tmp", "wb") as fout:
+            np.save(fout, np.asarray(lens, dtype=np.int32))
+        os.replace(f"{lengths_dir}/{name}.npy.tmp", f"{lengths_dir}/{name}.npy")
+
+def load_token_lengths(path, tokenizer_name):
+    """Return (paragraph_lens, chunk_lens) int32 arrays opened via mmap, or None if they were not computed for this tokenizer."""
+    lengths_dir = token_lengths_dir(path, tokenizer_name)
+    if not all(os.path.exists(f"{lengths_dir}/{name}.npy") for name in ["paragraphs", "chunks"]):
+        return None
+    return np.load(f"{lengths_dir}/paragraphs.npy", mmap_mode='r'), np.load(f"{lengths_dir}/chunks.npy", mmap_mode='r')
+
+def truncate_token_lengths(path, tokenizer_name, num_paragraphs, num_chunks):
+    """Drop the counts past the committed end of the store, left by an interrupted update."""
+    lengths = load_token_lengths(path, tokenizer_name)
+    if lengths is not None and (len(lengths[0]) > num_paragraphs or len(lengths[1]) > num_chunks):
+        save_token_lengths(path, tokenizer_name, np.array(lengths[0][:num_paragraphs]), np.array(lengths[1][:num_chunks]))
+
+def save_array(file_path, values):
+    with open(f"{file_path}.tmp", "wb") as fout:
+        np.save(fout, values)
+    os.replace(f"{file_path}.tmp", file_path)
+
+def paragraph_hash(text):
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+def load_paragraph_hashes(path, paragraphs):
+    """Content hashes of the paragraphs of the store in `path`. Hashes of paragraphs added since
+    the last call are computed and saved to `paragraph_hashes.npy`."""
+    hashes = np.empty(0, dtype='V16')
+    if os.path.exists(f"{path}/paragraph_hashes.npy"):
+        hashes = np.load(f"{path}/paragraph_hashes.npy")
+    # Hashes past the end of the store belong to paragraphs of an interrupted update
+    changed = len(hashes) != len(paragraphs)
+    hashes = hashes[:len(paragraphs)]
+    if len(hashes) < len(paragraphs):
+        new = np.frombuffer(b''.join(paragraph_hash(paragraphs[i]) for i in range(len(hashes), len(paragraphs))), dtype='V16')
+        hashes = np.concatenate([hashes, new])
+    if changed:
+        save_array(f"{path}/paragraph_hashes.npy", hashes)
+    return hashes
+
+def load_tombstones(path):
+    """Ids of the paragraphs removed from the corpus by incremental updates, sorted."""
+    if not os.path.exists(f"{path}/tombstones.npy"):
+        return np.empty(0, dtype=np.int32)
+    return np.load(f"{path}/tombstones.npy")
+
+def save_tombstones(path, raw_ids):
+    save_array(f"{path}/tombstones.npy", np.unique(np.asarray(raw_ids, dtype=np.int32)))
+
+def deleted_chunks(id_to_rawid, tombstones):
+    """Boolean mask of the chunks whose paragraph was removed."""
+    return np.isin(np.asarray(id_to_rawid), tombstones)
+
+def load_generation(path):
+    """Manifest of the last committed build or incremental update of `path`, or None for builds without one."""
+    if not os.path.exists(f"{path}/generation.json"):
+        return None
+    with open(f"{path}/generation.json", encoding='utf-8') as f:
+        return json.load(f)
+
+def save_generation(path, generation):
+    with open(f"{path}/generation.json.tmp", "w", encoding='utf-8') as fout:
+        json.dump(generation, fout, indent=4)
+    os.replace(f"{path}/generation.json.tmp", f"{path}/generation.json")
+
+def reset_generation(path):
+    """Remove the update state of a previous build, which refers to its chunk and paragraph ids."""
+    for name in ["generation.json", "tombstones.npy", "paragraph_hashes.npy"]:
+        if os.path.exists(f"{path}/{name}"):
+            os.remove(f"{path}/{name}")
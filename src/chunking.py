@@ -0,0 +1,117 @@
+import re
+from itertools import islice
+from multiprocessing import Pool
+
+STOP_LIST = ['!', '。', '，', '！', '?', '？', ',', '.', ';']
+SENTENCE_PATTERN = re.compile(f"({'|'.join(map(re.escape, STOP_LIST))})")
+# A word is either a single Chinese character or a run of other word characters
+WORD_PATTERN = re.compile(r"[\u4e00-\u9fa5]|[^\W\u4e00-\u9fa5]+")
+
+def get_word_count(text):
+    regEx = re.compile('[\W]')
+    chinese_char_re = re.compile(r"([\u4e00-\u9fa5])")
+    words = regEx.split(text.lower())
+    word_list = []
+    for word in words:
+        if chinese_char_re.split(word):
+            word_list.extend(chinese_char_re.split(word))
+        else:
+            word_list.append(word)
+    return len([w for w in word_list if len(w.strip()) > 0])
+
+def split_sentences(content, chunk_size, min_sentence, overlap):
+    stop_list = ['!', '。', '，', '！', '?', '？', ',', '.', ';']
+    split_pattern = f"({'|'.join(map(re.escape, stop_list))})"
+    sentences = re.split(split_pattern, content)
+    
+    if len(sentences) == 1:
+        return sentences
+    
+    sentences = [sentences[i] + sentences[i+1] for i in range(0, len(sentences) - 1, 2)]
+    chunks = []
+    temp_text = ''
+    sentence_overlap_len = 0
+    start_index = 0
+
+    for i, sentence in enumerate(sentences):
+        temp_text += sentence
+        if get_word_count(temp_text) >= chunk_size - sentence_overlap_len or i == len(sentences) - 1:
+            if i + 1 > overlap:
+                sentence_overlap_len = sum([get_word_count(sentences[j]) for j in range(i+1-overlap, i+1)])
+            if chunks:
+                if start_index > overlap:
+                    start_index -= overlap
+            chunk_text = ''.join(sentences[start_index:i+1])
+            if not chunks:
+                chunks.append(chunk_text)
+            elif i == len(sentences) - 1 and (i - start_index + 1) < min_sentence:
+                chunks[-1] += chunk_text
+            else:
+                chunks.append(chunk_text)
+            temp_text = ''
+            start_index = i + 1
+    
+    return chunks
+
+
+def word_count(text):
+    """Same result as get_word_count with a single precompiled pattern."""
+    return len(WORD_PATTERN.findall(text.lower()))
+
+def split_sentences_fast(content, chunk_size, min_sentence, overlap):
+    """Same chunks as split_sentences. Every sentence ends with a stop character, which never
+    belongs to a word, so the word count of the running chunk is the sum of its sentence counts."""
+    sentences = SENTENCE_PATTERN.split(content)
+
+    if len(sentences) == 1:
+        return sentences
+
+    sentences = [sentences[i] + sentences[i+1] for i in range(0, len(sentences) - 1, 2)]
+    counts = [word_count(sentence) for sentence in sentences]
+    chunks = []
+    temp_count = 0
+    sentence_overlap_len = 0
+    start_index = 0
+    last = len(sentences) - 1
+
+    for i in range(len(sentences)):
+        temp_count += counts[i]
+        if temp_count >= chunk_size - sentence_overlap_len or i == last:
+            if i + 1 > overlap:
+                sentence_overlap_len = sum(counts[i+1-overlap:i+1])
+            if chunks:
+                if start_index > overlap:
+                    start_index -= overlap
+            chunk_text = ''.join(sentences[start_index:i+1])
+            if not chunks:
+                chunks.append(chunk_text)
+            elif i == last and (i - start_index + 1) < min_sentence:
+                chunks[-1] += chunk_text
+            else:
+                chunks.append(chunk_text)
+            temp_count = 0
+            start_index = i + 1
+
+    return chunks
+
+def _split_star(args):
+    return split_sentences_fast(*args)
+
+def chunk_contents(contents, chunk_size, min_sentence, overlap, workers=1, batch_size=256):
+    """Yield (content, chunks) for every paragraph of `contents` in input order.
+
+    Paragraphs are fanned out to `workers` processes a window at a time, so a lazily read
+    corpus is never queued in memory as a whole.
+    """
+    if workers <= 1:
+        for content in contents:
+            yield content, split_sentences_fast(content, chunk_size, min_sentence, overlap)
+        return
+    contents = iter(contents)
+    with Pool(workers) as pool:
+        while True:
+            window = list(islice(contents, workers * batch_size * 4))
+            if not window:
+                return
+            tasks = [(content, chunk_size, min_sentence, overlap) for content in window]
+            yield from zip(window, pool.imap(_split_star, tasks, chunksize=batch_size))
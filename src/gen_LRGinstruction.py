@@ -3,12 +3,17 @@ import random
 import argparse
 from tqdm import tqdm
 import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from api import enable_async_client
 from task import build_ext_instruction, build_fil_instruction, build_cot_instruction,build_rag_instruction,get_word_len
 parser = argparse.ArgumentParser()
 parser.add_argument('--per_task_num', type=int, default=200, help="Number of instructions to generate for each task in each dataset")
 parser.add_argument('--min_res_tokens', type=int, default=20, help="Minimum number of response tokens") 
 parser.add_argument('--long_ratio', type=int, default=0.2, help="Proportion of long data") 
 parser.add_argument('--model', type=str, choices=["chatglm_turbo", "glm-4", "gpt-4-32k"], default='chatglm_turbo')
+parser.add_argument('--async_api', action="store_true", default=False, help="Send API calls through the pooled, rate-limited asyncio client")
+parser.add_argument('--workers', type=int, default=16, help="Number of samples whose instructions are built concurrently")
+parser.add_argument('--seed', type=int, default=42, help="Seed of the order in which samples are tried. Resuming skips the samples in the checkpoint by id, so it works with any seed; the same seed keeps the order")
 args = parser.parse_args()
 
 
@@ -26,9 +31,93 @@ def predata(data):
     return data
 
 
-if __name__ == "__main__":
+class TaskQuota:
+    """Accepted and in-flight instructions per task type, counting those built from short contexts separately.
+    A task slot is reserved when a sample is submitted and released when its builder finishes,
+    so concurrent builders never exceed the quotas."""
+
+    def __init__(self, tasks, limit, short_limit=None):
+        self.limit = limit
+        self.short_limit = short_limit
+        self.accepted = {task: [0, 0] for task in tasks}
+        self.reserved = {task: [0, 0] for task in tasks}
+
+    def used(self, task, short=False):
+        return self.accepted[task][short] + self.reserved[task][short]
+
+    def has_capacity(self):
+        return any(self.used(task) < self.limit for task in self.accepted)
+
+    def full(self):
+        return all(self.accepted[task][0] >= self.limit for task in self.accepted)
+
+    def reserve(self, task, short):
+        self.reserved[task][0] += 1
+        self.reserved[task][1] += short
+
+    def release(self, task, short, accepted):
+        self.reserved[task][0] -= 1
+        self.reserved[task][1] -= short
+        if accepted:
+            self.add(task, short)
+
+    def add(self, task, short):
+        self.accepted[task][0] += 1
+        self.accepted[task][1] += short
 
 
+def run_builders(samples, assign, build, quota, on_result, workers):
+    """Build instructions for `samples` with up to `workers` samples in flight.
+
+    `assign(sample)` reserves a task in `quota` and returns (task, short), or None to skip the
+    sample. `on_result(sample, task, short, instruction)` is called in this thread for every
+    finished sample, in completion order.
+    """
+    samples = iter(samples)
+    pending = {}
+    with ThreadPoolExecutor(workers) as pool:
+        while True:
+            while len(pending) < workers and quota.has_capacity():
+                sample = next(samples, None)
+                if sample is None:
+                    break
+                assigned = assign(sample)
+                if assigned is not None:
+                    pending[pool.submit(build, assigned[0], sample)] = (sample, *assigned)
+            if not pending:
+                return
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                sample, task, short = pending.pop(future)
+                try:
+                    instruction = future.result()
+                except Exception as e:
+                    print(f"Failed to build {task} instruction: {e}")
+                    instruction = None
+                quota.release(task, short, bool(instruction))
+                on_result(sample, task, short, instruction)
+
+
+def load_checkpoint(path):
+    """Records of the samples already attempted, dropping a line cut off by an interrupted write."""
+    records = []
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break
+    return records
+
+
+if __name__ == "__main__":
+    if args.async_api:
+        enable_async_client()
+    random.seed(args.seed)
+    # Builder threads also draw from the global generator, so the sample order has its own
+    order_rng = random.Random(args.seed)
+
     """
     Configure the threshold for long and short contexts for each dataset. For example, set 2wikimultihopqa to 1500, which means if the total length
     of all paragraphs exceeds 1500 tokens, it is considered a long context; otherwise, it is considered a short context.
@@ -42,85 +131,100 @@ if __name__ == "__main__":
         "cot": build_cot_instruction,
         "rag": build_rag_instruction
     }
-    
-    all_instructions = []
+
+    save_path = f"../data/train/processed"
+    if not os.path.exists(save_path):
+        os.makedirs(save_path)
+    # Every attempted sample is appended here, so that a rerun skips it and keeps the accepted instructions
+    checkpoint_path = f"{save_path}/LRGinstruction.checkpoint.jsonl"
+    records = load_checkpoint(checkpoint_path)
+    attempted = {(r["dataset"], r["sample"]) for r in records}
+    checkpoint = open(checkpoint_path, "a", encoding='utf-8')
+
+    def save_record(dataset, sample_id, task, short, instruction):
+        record = {"dataset": dataset, "sample": sample_id, "task": task, "short": short, "instruction": instruction}
+        records.append(record)
+        checkpoint.write(json.dumps(record, ensure_ascii=False) + "\n")
+        checkpoint.flush()
+
     for name, min_token in dataset_config.items():   
         print(f"{'*'*10}Generating {name} instruction{'*'*10}")
-        progress_bars = {task_type: tqdm(total=args.per_task_num, desc=f"{task_type} progress") for task_type in instruction_builders.keys()}
+        quota = TaskQuota(instruction_builders.keys(), args.per_task_num, args.per_task_num*args.long_ratio)
+        for r in records:
+            if r["dataset"] == name and r["instruction"]:
+                quota.add(r["task"], r["short"])
+        progress_bars = {task_type: tqdm(total=args.per_task_num, initial=quota.accepted[task_type][0], desc=f"{task_type} progress") for task_type in instruction_builders.keys()}
 
         with open(f"../data/train/raw/{name}/train.jsonl", "r") as fin:
-            data = [json.loads(line) for line in fin]
-
-        random.shuffle(data)
+            data = [dict(json.loads(line), sample_id=i) for i, line in enumerate(fin)]
+
+        order_rng.shuffle(data)
+
+        def assign(d):
+            # Each sample goes to the first task whose quota is not used up; short contexts are capped per task
+            if (name, d["sample_id"]) in attempted:
+                return None
+            d["content"] = "\n".join([c["title"] + c["paragraph_text"] for c in d["contexts"]])
+            short_status = get_word_len(d["content"]) < min_token
+            for task_type in instruction_builders:
+                if short_status and quota.used(task_type, True) >= quota.short_limit:
+                    return None
+                if quota.used(task_type) < args.per_task_num:
+                    if task_type == "fil":
+                        d["sup_flag"] = quota.used(task_type) % 2 == 1
+                    quota.reserve(task_type, short_status)
+                    return task_type, short_status
+            return None
 
-        task_instructions = []
-        task_counters = {key: [0,0] for key in instruction_builders.keys()}
-        for index, d in enumerate(data):
+        def build(task_type, d):
             question = d["question"]
             answer = d["answer"]
-            content = "\n".join([c["title"] + c["paragraph_text"] for c in d["contexts"]])
+            content = d["content"]
             support = [c["title"] + c["paragraph_text"] for c in d["contexts"] if c["is_supporting"]]
             non_support = [c["title"] + c["paragraph_text"] for c in d["contexts"] if not c["is_supporting"]]
-
-            for task_type, builder in instruction_builders.items():
-                short_status=False
-                if get_word_len(content)<min_token:
-                    short_status=True
-                    if task_counters[task_type][1] >= args.per_task_num*args.long_ratio:
-                        break
-                if task_counters[task_type][0] < args.per_task_num:
-                    if task_type == "fil":
-                        sup_flag=True
-                        if task_counters[task_type][0]%2==0:
-                            sup_flag=False                
-                        instruction = builder(args.model, question, answer, support, non_support, sup_flag)
-                    elif task_type=="rag":
-                        instruction = builder(args.model, question, answer, content)
-                    else:
-                        instruction = builder(args.model, question, answer, content, support, args.min_res_tokens)
-
-                    if instruction:
-                        if short_status and task_counters[task_type][1] < args.per_task_num*args.long_ratio:
-                            task_counters[task_type][1] += 1
-                        task_instructions.append(instruction)
-                        task_counters[task_type][0] += 1
-                        progress_bars[task_type].update(1)               
-                    break
-
-            if all(task_counters[task][0] >= args.per_task_num for task in task_counters):
-                break
-        all_instructions.extend(task_instructions)
-    for bar in progress_bars.values():
-       bar.close()
+            builder = instruction_builders[task_type]
+            if task_type == "fil":
+                return builder(args.model, question, answer, support, non_support, d["sup_flag"])
+            elif task_type=="rag":
+                return builder(args.model, question, answer, content)
+            return builder(args.model, question, answer, content, support, args.min_res_tokens)
+
+        def on_result(d, task_type, short_status, instruction):
+            save_record(name, d["sample_id"], task_type, short_status, instruction)
+            if instruction:
+                progress_bars[task_type].update(1)
+
+        run_builders(data, assign, build, quota, on_result, args.workers)
+        for bar in progress_bars.values():
+            bar.close()
 
     # Build longer context training data for ext and cot tasks
     with open(f"../data/train/raw/qasper/train.jsonl", "r") as fin:
-        data = [json.loads(line) for line in fin]
-    cot_instructions=[]
-    ext_instructions=[]
-    for index, d in enumerate(data):
-        question = d["question"]
-        answer = d["answer"]
-        content = d["content"]
-        support = d["support"]
-        if d["answer"] and len(cot_instructions)<args.per_task_num//2:
-            cot_instruction = build_cot_instruction(args.model, question, answer, content, support, args.min_res_tokens)
-            if not cot_instruction:
-                continue
-            cot_instructions.append(cot_instruction)
-        else:
-            ext_instruction = build_ext_instruction(args.model, question, answer, content, support, args.min_res_tokens)
-            if not ext_instruction:
-                continue
-            ext_instructions.append(ext_instruction)
-        if len(cot_instructions)>=args.per_task_num//2 and len(ext_instructions)>=args.per_task_num//2:
-            break
-    all_instructions+=ext_instructions+cot_instructions
+        data = [dict(json.loads(line), sample_id=i) for i, line in enumerate(fin)]
+    quota = TaskQuota(["cot", "ext"], args.per_task_num//2)
+    for r in records:
+        if r["dataset"] == "qasper" and r["instruction"]:
+            quota.add(r["task"], False)
+
+    def assign(d):
+        if ("qasper", d["sample_id"]) in attempted:
+            return None
+        for task_type in (["cot", "ext"] if d["answer"] else ["ext"]):
+            if quota.used(task_type) < quota.limit:
+                quota.reserve(task_type, False)
+                return task_type, False
+        return None
+
+    def build(task_type, d):
+        builder = build_cot_instruction if task_type == "cot" else build_ext_instruction
+        return builder(args.model, d["question"], d["answer"], d["content"], d["support"], args.min_res_tokens)
+
+    run_builders(data, assign, build, quota, lambda d, task_type, short, instruction: save_record("qasper", d["sample_id"], task_type, short, instruction), args.workers)
+    checkpoint.close()
+
+    all_instructions = [r["instruction"] for r in records if r["instruction"] and r["dataset"] != "qasper"]
+    all_instructions += [r["instruction"] for task_type in ["ext", "cot"] for r in records if r["instruction"] and r["dataset"] == "qasper" and r["task"] == task_type]
     random.shuffle(all_instructions)
 
-    save_path = f"../data/train/processed"
-    if not os.path.exists(save_path):
-        os.makedirs(save_path)
     with open(f"{save_path}/LRGinstruction.json", 'w') as fout:
         json.dump(all_instructions, fout, ensure_ascii=False)
-
@@ -1,12 +1,20 @@
 import json
-import re
 import os
 import time
+import shutil
+import hashlib
 from sentence_transformers import SentenceTransformer
-import faiss
 import argparse
 from tqdm import tqdm
 import yaml
+import numpy as np
+from chunking import chunk_contents
+from jsonstream import iter_json_array, JsonStreamWriter
+from chunk_store import (ChunkStoreWriter, has_chunk_store, load_chunk_store, load_token_lengths, save_token_lengths, paragraph_hash,
+                         load_paragraph_hashes, truncate_token_lengths, load_tombstones, save_tombstones, load_generation, save_generation, reset_generation)
+from bm25 import build_bm25, commit_bm25, bm25_num_docs
+from sharding import has_shards, load_shards_meta, build_shards, append_to_shards
+from vector_store import INDEX_TYPES, build_index, create_index, train_index, evaluate_recall, save_index, load_index, set_search_params
 with open("../config/config.yaml", "r") as file:
     config = yaml.safe_load(file)
 model2path = config["model_path"]
@@ -17,69 +25,41 @@ def parse_arguments():
     parser.add_argument('--chunk_size', type=int, default=200, help="Minimum chunk size for splitting")
     parser.add_argument('--min_sentence', type=int, default=2, help="Minimum number of sentences in a chunk")
     parser.add_argument('--overlap', type=int, default=2, help="Number of overlapping sentences between chunks")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Number of processes used for chunking")
+    parser.add_argument('--index_type', type=str, choices=INDEX_TYPES, default="flat", help="FAISS index type")
+    parser.add_argument('--nlist', type=int, default=1024, help="Number of inverted lists for IVF indexes")
+    parser.add_argument('--pq_m', type=int, default=64, help="Number of PQ sub-quantizers for ivf_pq")
+    parser.add_argument('--hnsw_m', type=int, default=32, help="Number of neighbors per node for hnsw")
+    parser.add_argument('--nprobe', type=int, default=32, help="Number of inverted lists visited at query time")
+    parser.add_argument('--ef_search', type=int, default=128, help="Search depth of hnsw at query time")
+    parser.add_argument('--train_size', type=int, default=100000, help="Number of vectors sampled to train IVF/PQ/SQ indexes")
+    parser.add_argument('--recall_top_k', type=int, default=100, help="k used to report recall against the flat index (top_k1 in main.py)")
+    parser.add_argument('--recall_queries', type=int, default=1000, help="Number of sampled chunks used as recall queries")
+    parser.add_argument('--stream', action="store_true", default=False, help="Read, chunk and embed the corpus incrementally in shards, resuming from completed shards")
+    parser.add_argument('--shard_size', type=int, default=10000, help="Number of chunks encoded per shard in --stream mode")
+    parser.add_argument('--length_tokenizers', type=str, nargs="*", default=[model2path["chatglm3-6b-32k"]], help="Tokenizers whose paragraph and chunk token counts are stored next to the index")
+    parser.add_argument('--bm25', action="store_true", default=False, help="Also build the BM25 index used by main.py --hybrid")
+    parser.add_argument('--token_lengths_only', action="store_true", default=False, help="Only compute the token counts (and the BM25 index with --bm25) of an existing build")
+    parser.add_argument('--num_shards', type=int, default=1, help="Also split the index into N shard indexes of contiguous chunk ids for main.py --sharded")
+    parser.add_argument('--update', action="store_true", default=False, help="Update an existing build to the current raw corpus, embedding only new or changed paragraphs")
     return parser.parse_args()
 
-def get_word_count(text):
-    regEx = re.compile('[\W]')
-    chinese_char_re = re.compile(r"([\u4e00-\u9fa5])")
-    words = regEx.split(text.lower())
-    word_list = []
-    for word in words:
-        if chinese_char_re.split(word):
-            word_list.extend(chinese_char_re.split(word))
-        else:
-            word_list.append(word)
-    return len([w for w in word_list if len(w.strip()) > 0])
-
-def split_sentences(content, chunk_size, min_sentence, overlap):
-    stop_list = ['!', '。', '，', '！', '?', '？', ',', '.', ';']
-    split_pattern = f"({'|'.join(map(re.escape, stop_list))})"
-    sentences = re.split(split_pattern, content)
-    
-    if len(sentences) == 1:
-        return sentences
-    
-    sentences = [sentences[i] + sentences[i+1] for i in range(0, len(sentences) - 1, 2)]
-    chunks = []
-    temp_text = ''
-    sentence_overlap_len = 0
-    start_index = 0
-
-    for i, sentence in enumerate(sentences):
-        temp_text += sentence
-        if get_word_count(temp_text) >= chunk_size - sentence_overlap_len or i == len(sentences) - 1:
-            if i + 1 > overlap:
-                sentence_overlap_len = sum([get_word_count(sentences[j]) for j in range(i+1-overlap, i+1)])
-            if chunks:
-                if start_index > overlap:
-                    start_index -= overlap
-            chunk_text = ''.join(sentences[start_index:i+1])
-            if not chunks:
-                chunks.append(chunk_text)
-            elif i == len(sentences) - 1 and (i - start_index + 1) < min_sentence:
-                chunks[-1] += chunk_text
-            else:
-                chunks.append(chunk_text)
-            temp_text = ''
-            start_index = i + 1
-    
-    return chunks
-
-def process_data(file_path, chunk_size, min_sentence, overlap, save_path):
+def process_data(file_path, chunk_size, min_sentence, overlap, save_path, workers=1):
     with open(file_path, encoding='utf-8') as f:
         data = json.load(f)
     
     id_to_rawid = {}
     processed_chunks = []
+    os.makedirs(save_path, exist_ok=True)
 
-    for idx, item in tqdm(enumerate(data), total=len(data), desc="Processing data"):
-        content = item.get("paragraph_text") or item.get("ch_content") or item.get("ch_contenn")
-        chunks = split_sentences(content, chunk_size, min_sentence, overlap)
-        for i, chunk in enumerate(chunks):
-            id_to_rawid[len(processed_chunks) + i] = idx
-        processed_chunks.extend(chunks)
+    contents = (item.get("paragraph_text") or item.get("ch_content") or item.get("ch_contenn") for item in data)
+    with ChunkStoreWriter(save_path) as store:
+        for idx, (content, chunks) in tqdm(enumerate(chunk_contents(contents, chunk_size, min_sentence, overlap, workers)), total=len(data), desc="Processing data"):
+            for i, chunk in enumerate(chunks):
+                id_to_rawid[len(processed_chunks) + i] = idx
+            processed_chunks.extend(chunks)
+            store.add_paragraph(content, chunks)
     
-    os.makedirs(save_path, exist_ok=True)
     with open(f"{save_path}/chunks.json", "w", encoding='utf-8') as fout:
         json.dump(processed_chunks, fout, ensure_ascii=False)
     with open(f"{save_path}/id_to_rawid.json", "w", encoding='utf-8') as fout:
@@ -87,28 +67,257 @@ def process_data(file_path, chunk_size, min_sentence, overlap, save_path):
     
     return processed_chunks
 
-def calculate_embeddings(content, model_path, vector_store_path):
+def calculate_embeddings(content, model_path, vector_store_path, index_config, num_shards=1):
     model = SentenceTransformer(model_path)
     embeddings = model.encode(content)
-    dimension = embeddings.shape[1]
-    index = faiss.IndexFlatIP(dimension)
-    index.add(embeddings)
-    faiss.write_index(index, vector_store_path)
+    index = build_index(embeddings, **index_config)
+    meta = dict(index_config, dimension=embeddings.shape[1], ntotal=index.ntotal)
+    if index_config["index_type"] != "flat":
+        set_search_params(index, index_config["nprobe"], index_config["ef_search"])
+        meta["recall"] = evaluate_recall(index, embeddings, index_config["recall_top_k"], index_config["recall_queries"])
+        print(f"recall@{index_config['recall_top_k']} against flat index: {meta['recall']:.4f}")
+    save_index(index, vector_store_path, meta)
+    if num_shards > 1:
+        build_shards(embeddings, os.path.dirname(vector_store_path), num_shards, index_config)
+
+def chunks_hash(chunks):
+    digest = hashlib.blake2b(digest_size=16)
+    for chunk in chunks:
+        data = chunk.encode('utf-8')
+        digest.update(len(data).to_bytes(8, 'little'))
+        digest.update(data)
+    return digest.hexdigest()
+
+def stream_build(file_path, chunk_size, min_sentence, overlap, save_path, model_path, index_config, shard_size, workers=1, num_shards=1):
+    """Chunk and embed the corpus shard by shard. Embeddings of completed shards are kept in
+    `save_path/shards` together with a hash of their chunk texts, so an interrupted build only
+    re-encodes the shards it did not finish. The directory is removed once the index is saved."""
+    shard_dir = f"{save_path}/shards"
+    os.makedirs(shard_dir, exist_ok=True)
+    # The corpus fingerprint keeps an interrupted build from being resumed on a different corpus
+    corpus = {"path": os.path.abspath(file_path), "size": os.path.getsize(file_path), "mtime": os.path.getmtime(file_path)}
+    state = {"chunk_size": chunk_size, "min_sentence": min_sentence, "overlap": overlap, "shard_size": shard_size, "emb_model": model_path, "corpus": corpus}
+    state_path = f"{shard_dir}/build_state.json"
+    if os.path.exists(state_path):
+        with open(state_path, encoding='utf-8') as f:
+            if json.load(f) != state:
+                raise ValueError(f"{shard_dir} was built with different settings, remove it to rebuild")
+    else:
+        with open(state_path, "w", encoding='utf-8') as fout:
+            json.dump(state, fout)
+
+    model = None
+    index = None
+    shard_paths = []
+
+    def flush(shard):
+        nonlocal model, index
+        shard_path = f"{shard_dir}/emb_{len(shard_paths):05d}.npy"
+        shard_state = {"chunks": len(shard), "hash": chunks_hash(shard)}
+        stored_state = None
+        if os.path.exists(f"{shard_path}.json") and os.path.exists(shard_path):
+            with open(f"{shard_path}.json", encoding='utf-8') as f:
+                stored_state = json.load(f)
+        if stored_state == shard_state:
+            embeddings = np.load(shard_path)
+        else:
+            if model is None:
+                model = SentenceTransformer(model_path)
+            embeddings = model.encode(shard)
+            with open(f"{shard_path}.tmp", "wb") as fout:
+                np.save(fout, embeddings)
+            os.replace(f"{shard_path}.tmp", shard_path)
+            # Written after the embeddings, so a shard is only reused once both are complete
+            with open(f"{shard_path}.json.tmp", "w", encoding='utf-8') as fout:
+                json.dump(shard_state, fout)
+            os.replace(f"{shard_path}.json.tmp", f"{shard_path}.json")
+        if index is None:
+            # Trained index types are trained on the first shard
+            config = dict(index_config, nlist=max(1, min(index_config["nlist"], len(embeddings))))
+            index = create_index(embeddings.shape[1], **config)
+            train_index(index, embeddings, index_config["train_size"])
+        index.add(np.ascontiguousarray(embeddings, dtype='float32'))
+        shard_paths.append(shard_path)
+
+    os.makedirs(save_path, exist_ok=True)
+    shard = []
+    with JsonStreamWriter(f"{save_path}/chunks.json") as chunk_writer, JsonStreamWriter(f"{save_path}/id_to_rawid.json", "dict") as id_writer, ChunkStoreWriter(save_path) as store:
+        contents = (item.get("paragraph_text") or item.get("ch_content") or item.get("ch_contenn") for item in iter_json_array(file_path))
+        for idx, (content, chunks) in tqdm(enumerate(chunk_contents(contents, chunk_size, min_sentence, overlap, workers)), desc="Processing data"):
+            store.add_paragraph(content, chunks)
+            for chunk in chunks:
+                id_writer.add(chunk_writer.count, idx)
+                chunk_writer.append(chunk)
+                shard.append(chunk)
+                if len(shard) == shard_size:
+                    flush(shard)
+                    shard = []
+        if shard:
+            flush(shard)
+
+    meta = dict(index_config, dimension=index.d, ntotal=index.ntotal, shards=len(shard_paths))
+    if index_config["index_type"] != "flat":
+        set_search_params(index, index_config["nprobe"], index_config["ef_search"])
+        meta["recall"] = evaluate_recall(index, [np.load(p, mmap_mode='r') for p in shard_paths], index_config["recall_top_k"], index_config["recall_queries"])
+        print(f"recall@{index_config['recall_top_k']} against flat index: {meta['recall']:.4f}")
+    save_index(index, f"{save_path}/vector.index", meta)
+    if num_shards > 1:
+        build_shards([np.load(p, mmap_mode='r') for p in shard_paths], save_path, num_shards, index_config)
+    shutil.rmtree(shard_dir)
+
+def compute_token_lengths(save_path, tokenizer_path, batch_size=1000, append=False):
+    """Count the tokens of every paragraph and chunk in the chunk store with batched tokenizer calls.
+    With `append`, only the paragraphs and chunks added since the last count are tokenized."""
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, trust_remote_code=True)
+    chunks, _, paragraphs = load_chunk_store(save_path)
+    existing = load_token_lengths(save_path, tokenizer_path) if append else None
+    lengths = []
+    for k, (name, store) in enumerate([("paragraphs", paragraphs), ("chunks", chunks)]):
+        lens = np.empty(len(store), dtype=np.int32)
+        start = 0
+        if existing is not None:
+            start = min(len(existing[k]), len(store))
+            lens[:start] = existing[k][:start]
+        for start in tqdm(range(start, len(store), batch_size), desc=f"Counting {name} tokens"):
+            batch = [store[i] for i in range(start, min(start + batch_size, len(store)))]
+            lens[start:start + len(batch)] = [len(ids) for ids in tokenizer(batch, truncation=False, add_special_tokens=False).input_ids]
+        lengths.append(lens)
+    save_token_lengths(save_path, tokenizer_path, *lengths)
+
+def update_build(file_path, chunk_size, min_sentence, overlap, save_path, model_path, length_tokenizers=(), bm25=False, workers=1):
+    """Bring an existing build up to date with the raw corpus in `file_path`.
+
+    Paragraphs are matched by content hash: new or changed paragraphs are chunked, embedded and
+    appended to the chunk store and the index, and paragraphs no longer in the corpus are
+    tombstoned, so the ids of all other chunks stay the same. The index is the commit point:
+    chunks it does not contain were left by an interrupted update and are overwritten.
+    Token counts of `length_tokenizers` are brought up to date before the commit. With `bm25`,
+    the BM25 index is staged before the commit and swapped in right after it, and rebuilt if an
+    interrupted update left it behind the index. `generation.json` is written last and tells
+    running readers to reload.
+    """
+    if not has_chunk_store(save_path):
+        raise FileNotFoundError(f"No chunk store in {save_path}, rebuild it without --update first")
+    index_path = f"{save_path}/vector.index"
+    index, meta = load_index(index_path)
+    generation = load_generation(save_path) or {"generation": 0}
+    # Truncates whatever an interrupted update appended after the last committed chunk
+    ChunkStoreWriter(save_path, append=True, num_chunks=index.ntotal).close()
+    chunks, _, paragraphs = load_chunk_store(save_path)
+    if len(chunks) != index.ntotal:
+        raise ValueError(f"{index_path} has {index.ntotal} vectors but the chunk store {len(chunks)} chunks, rebuild it without --update")
+    if has_shards(save_path) and load_shards_meta(save_path)["ntotal"] != index.ntotal:
+        raise ValueError(f"The shards in {save_path}/vector_shards do not match {index_path}, rebuild them with --num_shards")
+    hashes = load_paragraph_hashes(save_path, paragraphs)
+    # Counts of the truncated chunks would otherwise be kept for the ids they get reused for
+    for tokenizer_path in length_tokenizers:
+        truncate_token_lengths(save_path, tokenizer_path, len(paragraphs), len(chunks))
+    tombstones = load_tombstones(save_path)
+
+    # Each corpus paragraph claims one live stored paragraph with the same content
+    live = {}
+    deleted = set(tombstones.tolist())
+    for raw_id, h in enumerate(hashes):
+        if raw_id not in deleted:
+            live.setdefault(h.tobytes(), []).append(raw_id)
+    new_contents = []
+    for item in tqdm(iter_json_array(file_path), desc="Diffing corpus"):
+        content = item.get("paragraph_text") or item.get("ch_content") or item.get("ch_contenn")
+        raw_ids = live.get(paragraph_hash(content))
+        if raw_ids:
+            raw_ids.pop()
+        else:
+            new_contents.append(content)
+    removed = [raw_id for raw_ids in live.values() for raw_id in raw_ids]
+    print(f"{len(new_contents)} new or changed paragraphs, {len(removed)} removed or changed paragraphs")
+    if not new_contents and not removed:
+        if bm25 and bm25_num_docs(save_path) != index.ntotal:
+            build_bm25(chunks, save_path)
+        return False
+
+    new_chunks = []
+    with ChunkStoreWriter(save_path, append=True, num_chunks=index.ntotal) as store:
+        for content, chunks in tqdm(chunk_contents(new_contents, chunk_size, min_sentence, overlap, workers), total=len(new_contents), desc="Processing new data"):
+            store.add_paragraph(content, chunks)
+            new_chunks.extend(chunks)
+    chunks, _, paragraphs = load_chunk_store(save_path)
+    load_paragraph_hashes(save_path, paragraphs)
+    for tokenizer_path in length_tokenizers:
+        compute_token_lengths(save_path, tokenizer_path, append=True)
+    if bm25:
+        build_bm25(chunks, save_path, commit=False)
+    if new_chunks:
+        embeddings = SentenceTransformer(model_path).encode(new_chunks)
+        index.add(np.ascontiguousarray(embeddings, dtype='float32'))
+    meta["ntotal"] = index.ntotal
+    save_index(index, index_path, meta)
+    if bm25:
+        commit_bm25(save_path)
+    if new_chunks and has_shards(save_path):
+        append_to_shards(embeddings, save_path)
+    tombstones = np.unique(np.concatenate([tombstones, np.asarray(removed, dtype=np.int32)]))
+    save_tombstones(save_path, tombstones)
+    save_generation(save_path, {
+        "generation": generation["generation"] + 1,
+        "built_at": generation.get("built_at"),
+        "num_paragraphs": len(paragraphs),
+        "num_chunks": index.ntotal,
+        "deleted_paragraphs": len(tombstones),
+        "added_paragraphs": len(new_contents),
+        "removed_paragraphs": len(removed),
+        "added_chunks": len(new_chunks),
+        "updated_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+    })
+    return True
 
 def main():
     args = parse_arguments()
     save_path = f'../data/corpus/processed/{args.chunk_size}_{args.min_sentence}_{args.overlap}/{args.dataset}'
     vector_store_path = f"{save_path}/vector.index"
+    if args.token_lengths_only:
+        for tokenizer_path in args.length_tokenizers:
+            compute_token_lengths(save_path, tokenizer_path)
+        if args.bm25:
+            build_bm25(load_chunk_store(save_path)[0], save_path)
+        return
+    if args.update:
+        start_time = time.time()
+        updated = update_build(f"../data/corpus/raw/{args.dataset}.json", args.chunk_size, args.min_sentence, args.overlap, save_path, model2path["emb_model"], args.length_tokenizers, args.bm25, args.workers)
+        print(f"Updated to generation {load_generation(save_path)['generation']} in {time.time() - start_time:.2f} seconds." if updated else "The build is up to date.")
+        return
     
-    print("Starting data processing...")
-    content = process_data(f"../data/corpus/raw/{args.dataset}.json", args.chunk_size, args.min_sentence, args.overlap, save_path)
-    
-    print("Calculating embeddings...")
-    start_time = time.time()
-    calculate_embeddings(content, model2path["emb_model"], vector_store_path)
-    end_time = time.time()
+    # Tombstones, hashes and shards of a previous build refer to its ids
+    reset_generation(save_path)
+    if os.path.exists(f"{save_path}/vector_shards"):
+        shutil.rmtree(f"{save_path}/vector_shards")
+    index_config = {key: getattr(args, key) for key in ["index_type", "nlist", "pq_m", "hnsw_m", "nprobe", "ef_search", "train_size", "recall_top_k", "recall_queries"]}
+
+    if args.stream:
+        print("Processing data and calculating embeddings in shards...")
+        start_time = time.time()
+        stream_build(f"../data/corpus/raw/{args.dataset}.json", args.chunk_size, args.min_sentence, args.overlap, save_path, model2path["emb_model"], index_config, args.shard_size, args.workers, args.num_shards)
+        end_time = time.time()
+    else:
+        print("Starting data processing...")
+        content = process_data(f"../data/corpus/raw/{args.dataset}.json", args.chunk_size, args.min_sentence, args.overlap, save_path, args.workers)
+
+        print("Calculating embeddings...")
+        start_time = time.time()
+        calculate_embeddings(content, model2path["emb_model"], vector_store_path, index_config, args.num_shards)
+        end_time = time.time()
     
     print(f"Embeddings generated in {end_time - start_time:.2f} seconds.")
+    for tokenizer_path in args.length_tokenizers:
+        print(f"Counting tokens with {tokenizer_path}...")
+        compute_token_lengths(save_path, tokenizer_path)
+    if args.bm25:
+        print("Building BM25 index...")
+        build_bm25(load_chunk_store(save_path)[0], save_path)
+    chunks, _, paragraphs = load_chunk_store(save_path)
+    load_paragraph_hashes(save_path, paragraphs)
+    built_at = time.strftime("%Y-%m-%d %H:%M:%S")
+    save_generation(save_path, {"generation": 0, "built_at": built_at, "num_paragraphs": len(paragraphs), "num_chunks": len(chunks), "deleted_paragraphs": 0, "updated_at": built_at})
 
 if __name__ == '__main__':
     main()
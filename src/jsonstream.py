@@ -0,0 +1,102 @@
+import os
+import re
+import json
+
+_decoder = json.JSONDecoder()
+_skip = re.compile(r'[\s,]*')
+_space = re.compile(r'\s*')
+# Characters that can continue a number that raw_decode has already accepted, e.g. `1` of `1.5`
+_number_tail = re.compile(r'[\d.eE+-]*')
+
+
+def iter_json_array(file_path, buffer_size=1 << 20):
+    """Yield the elements of a top-level JSON array one at a time without loading the whole file."""
+    with open(file_path, encoding='utf-8') as f:
+        buffer = f.read(buffer_size)
+        eof = not buffer
+        pos = _skip.match(buffer).end()
+        while pos == len(buffer) and not eof:
+            more = f.read(buffer_size)
+            eof = not more
+            buffer = buffer[pos:] + more
+            pos = _skip.match(buffer).end()
+        if buffer[pos:pos + 1] != '[':
+            raise ValueError(f"{file_path} does not contain a JSON array")
+        pos += 1
+        while True:
+            pos = _skip.match(buffer, pos).end()
+            if buffer.startswith(']', pos):
+                return
+            try:
+                item, end = _decoder.raw_decode(buffer, pos)
+                # An item is only complete once the next non-whitespace character is known to end it,
+                # since a number split at the end of the buffer decodes as its prefix
+                after = _space.match(buffer, end).end()
+                if after == len(buffer) or _number_tail.match(buffer, end).end() == len(buffer):
+                    complete = eof
+                elif buffer[after] in ',]':
+                    complete = True
+                else:
+                    raise json.JSONDecodeError("Expecting ',' delimiter", buffer, after)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                complete = False
+            if not complete:
+                more = f.read(buffer_size)
+                eof = not more
+                buffer = buffer[pos:] + more
+                pos = 0
+                continue
+            yield item
+            pos = end
+
+
+def iter_records(file_path):
+    """Yield the records of a JSON Lines file (`.jsonl`) or of a top-level JSON array one at a time."""
+    if not file_path.endswith(".jsonl"):
+        yield from iter_json_array(file_path)
+        return
+    with open(file_path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+class JsonStreamWriter:
+    """Write a JSON list or object element by element; the file only appears once closed."""
+
+    def __init__(self, file_path, kind="list"):
+        self.file_path = file_path
+        self.tmp_path = f"{file_path}.tmp"
+        self.kind = kind
+        self.count = 0
+        self.fout = open(self.tmp_path, "w", encoding='utf-8')
+        self.fout.write('[' if kind == "list" else '{')
+
+    def _sep(self):
+        if self.count:
+            self.fout.write(', ')
+        self.count += 1
+
+    def append(self, value):
+        self._sep()
+        self.fout.write(json.dumps(value, ensure_ascii=False))
+
+    def add(self, key, value):
+        self._sep()
+        self.fout.write(f"{json.dumps(str(key), ensure_ascii=False)}: {json.dumps(value, ensure_ascii=False)}")
+
+    def close(self):
+        self.fout.write(']' if self.kind == "list" else '}')
+        self.fout.close()
+        os.replace(self.tmp_path, self.file_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.fout.close()
@@ -0,0 +1,72 @@
+"""Load test of server.py: sends questions from `--concurrency` concurrent clients and
+reports QPS, latency percentiles and errors.
+
+    python load_test.py --url http://127.0.0.1:8000 --mode rb --dataset hotpotqa --num 500 --concurrency 32
+"""
+import json
+import time
+import random
+import asyncio
+import argparse
+import httpx
+from tracing import percentile
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Load test of the LongRAG server.")
+    parser.add_argument('--url', type=str, default="http://127.0.0.1:8000")
+    parser.add_argument('--mode', type=str, default="rb", help="Endpoint to call: raw_pred, rb, rl, ext, fil or ext_fil")
+    parser.add_argument('--dataset', type=str, default="hotpotqa", help="Questions are read from ../data/eval/{dataset}.json")
+    parser.add_argument('--questions_file', type=str, default="", help="Read questions from this JSON file instead")
+    parser.add_argument('--num', type=int, default=200, help="Number of requests")
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', type=str, default="", help="Also write the report to this JSON file")
+    return parser.parse_args()
+
+
+async def run_load_test(url, mode, questions, concurrency, timeout=600):
+    """Send every question once to `{url}/{mode}` with `concurrency` concurrent requests."""
+    pending = iter(questions)
+    latencies, errors = [], {}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, timeout=timeout, limits=limits) as client:
+        async def worker():
+            for question in pending:
+                start = time.perf_counter()
+                try:
+                    response = await client.post(f"/{mode}", json={"question": question})
+                    status = response.status_code
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                if status == 200:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    errors[str(status)] = errors.get(str(status), 0) + 1
+
+        start_time = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start_time
+    return {
+        "requests": len(questions),
+        "succeeded": len(latencies),
+        "errors": errors,
+        "concurrency": concurrency,
+        "elapsed_s": round(elapsed, 3),
+        "qps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {f"p{q}": round(1000 * percentile(latencies, q), 2) for q in (50, 90, 95, 99)} | {"max": round(1000 * max(latencies, default=0), 2)},
+    }
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    with open(args.questions_file or f'../data/eval/{args.dataset}.json', encoding='utf-8') as f:
+        questions = [d["question"] for d in json.load(f)]
+    random.seed(args.seed)
+    questions = [random.choice(questions) for _ in range(args.num)] if args.num > len(questions) else random.sample(questions, args.num)
+    report = asyncio.run(run_load_test(args.url, args.mode, questions, args.concurrency, args.timeout))
+    print(json.dumps(report, indent=4))
+    if args.output:
+        with open(args.output, "w", encoding='utf-8') as fout:
+            json.dump(report, fout, ensure_ascii=False, indent=4)
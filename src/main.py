@@ -1,23 +1,34 @@
 import re
 import json
-import faiss 
 from tqdm import tqdm
 from multiprocessing.dummy import Pool as ThreadPool
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from itertools import islice
 import time
-from transformers import AutoModelForCausalLM, AutoTokenizer, LlamaTokenizer, LlamaForCausalLM, AutoModelForSequenceClassification
-from transformers.generation.utils import GenerationConfig
+import threading
 import numpy as np
 import torch
 import os
 import random
-from sentence_transformers import SentenceTransformer
 from datetime import datetime
 import backoff
 import logging
 import argparse
 import yaml
-from metric import F1_scorer
-from api import call_api
+from metric import RunningEval
+from api import call_api, enable_async_client
+from cache import PredCache, text_hash
+from tokens import TokenCounter
+from retrieval_cache import EmbeddingCache, RerankCache
+from prefix_cache import PrefixKVCache
+from tracing import Tracer
+from chunk_store import has_chunk_store, load_chunk_store, load_token_lengths, load_tombstones, deleted_chunks, load_generation
+from jsonstream import iter_records
+from registry import ComponentRegistry
+from packing import PACK_METHODS, group_positions, pack_context
+from bm25 import BM25Index, has_bm25, fuse
+from sharding import ShardedIndex, has_shards, load_shards_meta
 
 logger = logging.getLogger()
 
@@ -27,6 +38,9 @@ choices = [
     "LongRAG-chatglm3-32k", "LongRAG-qwen1.5-32k","LongRAG-vicuna-v1.5-16k", "LongRAG-llama3-8k",  "LongRAG-llama2-4k"
 ]
 
+# Generation modes, each enabled by the flag of the same name
+MODES = ["raw_pred", "rb", "rl", "ext", "fil", "ext_fil"]
+
 parser = argparse.ArgumentParser()
 parser.add_argument("--dataset", type=str, choices=["hotpotqa", "2wikimultihopqa", "musique"], default="hotpotqa", help="Name of the dataset")
 parser.add_argument('--top_k1', type=int, default=100, help="Number of candidates after initial retrieval")
@@ -40,21 +54,48 @@ parser.add_argument('--ext', action="store_true", default=False, help="Only usin
 parser.add_argument('--fil', action="store_true", default=False, help="Only using Extractor")
 parser.add_argument('--ext_fil', action="store_true", default=False, help="Using Extractor and Filter")
 parser.add_argument('--MaxClients', type=int, default=1)
+parser.add_argument('--workers', type=int, default=1, help="Number of questions whose generation steps run concurrently")
+parser.add_argument('--retrieval_workers', type=int, default=1, help="Number of question batches retrieved and reranked concurrently")
+parser.add_argument('--batch_size', type=int, default=16, help="Number of questions embedded, searched and reranked together")
+parser.add_argument('--rerank_batch_size', type=int, default=64, help="Number of (question, chunk) pairs per cross-encoder forward pass")
+parser.add_argument('--cascade_keep', type=int, default=0, help="Number of candidates per question scored by the full cross-encoder after a cheap first pass, disabled if 0")
+parser.add_argument('--cascade_first_pass', type=str, choices=["truncated", "dense"], default="truncated", help="Cheap first pass: the cross-encoder on truncated inputs or the retrieval order")
+parser.add_argument('--cascade_max_length', type=int, default=64, help="Input length in tokens of the truncated first pass")
+parser.add_argument('--gen_batch_size', type=int, default=8, help="Number of filter prompts generated together by local models")
+parser.add_argument('--prefix_cache_tokens', type=int, default=0, help="Token budget of the shared-prefix KV cache for local models, disabled if 0")
+parser.add_argument('--async_api', action="store_true", default=False, help="Send API calls through the pooled, rate-limited asyncio client")
+parser.add_argument('--trace', action="store_true", default=False, help="Write per-question stage timings and token counts to trace.jsonl and latency percentiles to eval_result.json")
+parser.add_argument('--pack', type=str, choices=PACK_METHODS, default="greedy", help="How R&L and the Extractor select paragraphs and chunks within the model's context window")
 parser.add_argument('--log_path', type=str, default="")
+parser.add_argument('--eval_file', type=str, default="", help="Questions to evaluate as a JSON array or JSON Lines file, ../data/eval/{dataset}.json by default")
+parser.add_argument('--flush_every', type=int, default=100, help="Write partial results to eval_result.json every N questions, disabled if 0")
+parser.add_argument('--cache_backend', type=str, choices=["jsonl", "sqlite"], default="jsonl", help="Storage of the prediction cache under log_path")
+parser.add_argument('--nprobe', type=int, default=None, help="Override the IVF nprobe stored in the index metadata")
+parser.add_argument('--ef_search', type=int, default=None, help="Override the HNSW efSearch stored in the index metadata")
+parser.add_argument('--hybrid', action="store_true", default=False, help="Fuse BM25 results (built by gen_index.py --bm25) with the dense results before reranking")
+parser.add_argument('--sparse_top_k', type=int, default=100, help="Number of BM25 candidates fused with the top_k1 dense candidates")
+parser.add_argument('--fusion', type=str, choices=["rrf", "weighted"], default="rrf", help="Reciprocal rank fusion or a weighted sum of normalized scores")
+parser.add_argument('--dense_weight', type=float, default=0.5, help="Weight of the dense scores in weighted fusion")
+parser.add_argument('--sharded', action="store_true", default=False, help="Search the shard indexes built by gen_index.py --num_shards in parallel node processes")
+parser.add_argument('--shard_nodes', type=str, nargs="*", default=[], help="host:port of running sharding.py nodes, by default one local node per shard is started")
+parser.add_argument('--shard_threads', type=int, default=None, help="FAISS threads of each local node, by default the CPUs divided by the number of shards")
+parser.add_argument('--reload_interval', type=float, default=0, help="Check every N seconds for a corpus generation written by gen_index.py --update and load it without restarting, disabled if 0")
+parser.add_argument('--retrieval_cache_dir', type=str, default="", help="Directory of the persistent query embedding and rerank score cache, disabled if empty")
 parser.add_argument('--r_path', type=str, default="../data/corpus/processed/200_2_2", help="Path to the vector database")
-args = parser.parse_args()
+# Defaults only when imported, e.g. by bench.py
+args = parser.parse_args() if __name__ == '__main__' else parser.parse_args([])
 
 
 
 def get_word_len(input):
-    tokenized_prompt = set_prompt_tokenizer(input, truncation=False, return_tensors="pt", add_special_tokens=False).input_ids[0]
-    return len(tokenized_prompt)
+    return token_counter.length(input)
 
 def set_prompt(input, maxlen):
-    tokenized_prompt = set_prompt_tokenizer(input, truncation=False, return_tensors="pt", add_special_tokens=False).input_ids[0]
+    # Whole prompts are almost never seen twice, so they are not kept in the token cache
+    tokenized_prompt = token_counter.encode(input, cache=False)
     if len(tokenized_prompt) > maxlen:
          half = int(maxlen * 0.5)
-         input = set_prompt_tokenizer.decode(tokenized_prompt[:half], skip_special_tokens=True) + set_prompt_tokenizer.decode(tokenized_prompt[-half:], skip_special_tokens=True)
+         input = token_counter.decode(tokenized_prompt[:half]) + token_counter.decode(tokenized_prompt[-half:])
     return input, len(tokenized_prompt)
 
 def seed_everything(seed):
@@ -69,6 +110,7 @@ def seed_everything(seed):
 def load_model_and_tokenizer(model2path, model_name):
     if "gpt" in model_name or "glm-4" in model_name or "glm3-turbo-128k" in model_name:
         return model_name, model_name
+    from transformers import AutoModelForCausalLM, AutoTokenizer, LlamaTokenizer, LlamaForCausalLM
     if "chatglm" in model_name or "internlm" in model_name or "xgen" in model_name or "longalign-6b" in model_name or "qwen" in model_name or "llama3" in model_name:
         tokenizer = AutoTokenizer.from_pretrained(model2path[model_name], trust_remote_code=True)
         model = AutoModelForCausalLM.from_pretrained(model2path[model_name], trust_remote_code=True, torch_dtype=torch.bfloat16, device_map='auto')
@@ -84,6 +126,11 @@ def load_model_and_tokenizer(model2path, model_name):
     model = model.eval()
     return model, tokenizer
 
+def generate(model, input_ids, **kwargs):
+    if prefix_cache is None:
+        return model.generate(input_ids, attention_mask=torch.ones_like(input_ids), **kwargs)
+    return prefix_cache.generate(model, input_ids, **kwargs)
+
 @backoff.on_exception(backoff.expo, (Exception), max_time=200)
 def pred(model_name, model, tokenizer, prompt, maxlen, max_new_tokens=32, temperature=1):
     try:
@@ -95,6 +142,7 @@ def pred(model_name, model, tokenizer, prompt, maxlen, max_new_tokens=32, temper
             response, history = model.chat(tokenizer, prompt, history=history, max_new_tokens=max_new_tokens, temperature=temperature, num_beams=1, do_sample=False)
             return response, prompt_len
         elif "baichuan" in model_name:
+            from transformers.generation.utils import GenerationConfig
             messages = [{"content": prompt, "role": "user"}]
             model.generation_config = GenerationConfig.from_pretrained(model2path["baichuan2-7b-4k"], temperature=temperature, max_new_tokens=max_new_tokens, num_beams=1, do_sample=False)
             response = model.chat(tokenizer, messages)
@@ -106,7 +154,7 @@ def pred(model_name, model, tokenizer, prompt, maxlen, max_new_tokens=32, temper
                 tokenizer.eos_token_id,
                 tokenizer.convert_tokens_to_ids("<|eot_id|>")
             ]
-            outputs = model.generate(input_ids, eos_token_id=terminators, max_new_tokens=max_new_tokens, temperature=temperature, num_beams=1, do_sample=False)
+            outputs = generate(model, input_ids, eos_token_id=terminators, max_new_tokens=max_new_tokens, temperature=temperature, num_beams=1, do_sample=False)
             response = tokenizer.decode(outputs[0][input_ids.shape[-1]:], skip_special_tokens=True)
             return response, prompt_len
         elif "glm-4" in model_name or "glm3-turbo-128k" in model_name or "gpt" in model_name:
@@ -116,7 +164,7 @@ def pred(model_name, model, tokenizer, prompt, maxlen, max_new_tokens=32, temper
             messages = [{"role": "user", "content": prompt}]
             text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
             model_inputs = tokenizer([text], return_tensors="pt").to(model.device)
-            generated_ids = model.generate(model_inputs.input_ids, max_new_tokens=max_new_tokens, num_beams=1, do_sample=False, temperature=1.0)
+            generated_ids = generate(model, model_inputs.input_ids, max_new_tokens=max_new_tokens, num_beams=1, do_sample=False, temperature=1.0)
             response = tokenizer.batch_decode([output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)], skip_special_tokens=True)[0]
             return response, prompt_len
         elif "llama" in model_name:
@@ -128,7 +176,7 @@ def pred(model_name, model, tokenizer, prompt, maxlen, max_new_tokens=32, temper
             conv.append_message(conv.roles[1], None)
             input = tokenizer(conv.get_prompt(), truncation=False, return_tensors="pt").to(model.device)
         context_length = input.input_ids.shape[-1]
-        output = model.generate(**input, max_new_tokens=max_new_tokens, num_beams=1, do_sample=False, temperature=temperature)
+        output = generate(model, input.input_ids, max_new_tokens=max_new_tokens, num_beams=1, do_sample=False, temperature=temperature)
         response = tokenizer.decode(output[0][context_length:], skip_special_tokens=True).strip()
     except Exception as e:
         print(f"An error occurred: {e}")
@@ -138,6 +186,66 @@ def pred(model_name, model, tokenizer, prompt, maxlen, max_new_tokens=32, temper
 
 
 
+def batch_backend(model_name):
+    """Local backend of `pred` that supports batched generation, following the same name matching as `pred`."""
+    if "internlm" in model_name or "chatglm" in model_name or "longalign-6b" in model_name or "baichuan" in model_name:
+        return None
+    if "llama3" in model_name:
+        return "llama3"
+    if "glm-4" in model_name or "glm3-turbo-128k" in model_name or "gpt" in model_name:
+        return None
+    if "qwen" in model_name:
+        return "qwen"
+    if "llama" in model_name:
+        return "llama2"
+    if "vicuna" in model_name:
+        return "vicuna"
+    return None
+
+def pred_batch(model_name, model, tokenizer, prompts, maxlen, max_new_tokens=32, temperature=1):
+    """Batched `pred` for the local llama3/qwen/llama2/vicuna backends: prompts are left-padded and
+    generated together in micro-batches of --gen_batch_size. Falls back to one `pred` per prompt
+    for other backends or when batched generation fails."""
+    backend = batch_backend(model_name)
+    if backend is None:
+        return filter_pool.starmap(pred, [(model_name, model, tokenizer, prompt, maxlen, max_new_tokens, temperature) for prompt in prompts])
+    try:
+        texts, prompt_lens = [], []
+        for prompt in prompts:
+            prompt, prompt_len = set_prompt(prompt, maxlen)
+            prompt_lens.append(prompt_len)
+            if backend in ("llama3", "qwen"):
+                texts.append(tokenizer.apply_chat_template([{"role": "user", "content": prompt}], tokenize=False, add_generation_prompt=True))
+            elif backend == "llama2":
+                texts.append(f"[INST]{prompt}[/INST]")
+            else:
+                from fastchat.model import get_conversation_template
+                conv = get_conversation_template("vicuna")
+                conv.append_message(conv.roles[0], prompt)
+                conv.append_message(conv.roles[1], None)
+                texts.append(conv.get_prompt())
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        tokenizer.padding_side = "left"
+        generate_kwargs = {"max_new_tokens": max_new_tokens, "num_beams": 1, "do_sample": False, "temperature": temperature, "pad_token_id": tokenizer.pad_token_id}
+        if backend == "llama3":
+            generate_kwargs["eos_token_id"] = [tokenizer.eos_token_id, tokenizer.convert_tokens_to_ids("<|eot_id|>")]
+        responses = []
+        for start in range(0, len(texts), args.gen_batch_size):
+            # The llama3 chat template already contains the BOS token
+            inputs = tokenizer(texts[start:start + args.gen_batch_size], padding=True, truncation=False, return_tensors="pt", add_special_tokens=backend != "llama3").to(model.device)
+            context_length = inputs.input_ids.shape[-1]
+            with torch.no_grad():
+                outputs = model.generate(**inputs, **generate_kwargs)
+            for output in outputs:
+                response = tokenizer.decode(output[context_length:], skip_special_tokens=True)
+                responses.append(response.strip() if backend in ("llama2", "vicuna") else response)
+        return list(zip(responses, prompt_lens))
+    except Exception as e:
+        print(f"Batched generation failed, falling back to single prompts: {e}")
+        return filter_pool.starmap(pred, [(model_name, model, tokenizer, prompt, maxlen, max_new_tokens, temperature) for prompt in prompts])
+
+
 def setup_logger(logger, filename='log'):
     logger.setLevel(logging.DEBUG)
     if logger.hasHandlers():
@@ -158,105 +266,114 @@ def print_args(args):
     logger.info(f"LongRAG model used: {args.lrag_model}")
     logger.info(f"{'*' * 30} CONFIGURATION {'*' * 30}")
 
-def search_q(question):
+def search_q(question, retrieved=None, modes=None):
+    """Answer `question` with each of `modes` (default: the modes selected on the command line)."""
+    modes = selected_modes() if modes is None else modes
     doc_len = {}
     raw_pred = ""
-    if args.raw_pred:
-        raw_pred = search_cache_and_predict(raw_pred, f'{log_path}/raw_pred.json', 'raw_pred', question, model_name, model, tokenizer, lambda: create_prompt(question), maxlen)
-
-    retriever, match_id = vector_search(question)
-    rerank, match_id = sort_section(question, retriever, match_id)
+    if "raw_pred" in modes:
+        raw_pred = load_cache('raw_pred', question)
+        raw_pred = search_cache_and_predict(raw_pred, 'raw_pred', question, model_name, model, tokenizer, lambda: create_raw_prompt(question), maxlen)
+
+    if retrieved is not None:
+        retriever, rerank, match_id = retrieved
+    elif needs_retrieval(modes):
+        retriever, match_id = vector_search(question)
+        rerank, match_id = sort_section(question, retriever, match_id)
+    else:
+        retriever, rerank, match_id = [], [], []
 
     filter_output = []
     extractor_output = []
     fil_pred = ext_pred = ext_fil_pred = rb_pred = rl_pred = ''
 
-    if args.fil:
-        fil_pred = load_cache(f'{log_path}/fil_pred.json', 'fil_pred', question, doc_len, 'Fil')
+    if "fil" in modes:
+        fil_pred = load_cache('fil_pred', question, doc_len, 'Fil')
         if not fil_pred:
             filter_output = filter(question, rerank)
-            fil_pred = search_cache_and_predict(fil_pred, f'{log_path}/fil_pred.json', 'fil_pred', question, model_name, model, tokenizer, lambda: create_prompt(''.join(filter_output), question), maxlen, doc_len, 'Fil')
+            fil_pred = search_cache_and_predict(fil_pred, 'fil_pred', question, model_name, model, tokenizer, lambda: create_prompt(''.join(filter_output), question), maxlen, doc_len, 'Fil')
     
-    if args.ext:
-        ext_pred = load_cache(f'{log_path}/ext_pred.json', 'ext_pred', question, doc_len, 'Ext')
+    if "ext" in modes:
+        ext_pred = load_cache('ext_pred', question, doc_len, 'Ext')
         if not ext_pred:
             extractor_output = extractor(question, rerank, match_id)
-            ext_pred = search_cache_and_predict(ext_pred, f'{log_path}/ext_pred.json', 'ext_pred', question, model_name, model, tokenizer, lambda: create_prompt(''.join(rerank + extractor_output), question), maxlen, doc_len, 'Ext')
+            ext_pred = search_cache_and_predict(ext_pred, 'ext_pred', question, model_name, model, tokenizer, lambda: create_prompt(''.join(rerank + extractor_output), question), maxlen, doc_len, 'Ext')
 
-    if args.ext_fil:
-        ext_fil_pred = load_cache(f'{log_path}/ext_fil_pred.json', 'ext_fil_pred', question, doc_len, 'E&F')
+    if "ext_fil" in modes:
+        ext_fil_pred = load_cache('ext_fil_pred', question, doc_len, 'E&F')
         if not ext_fil_pred:
             if not filter_output:
                 filter_output = filter(question, rerank)
             if not extractor_output:
                 extractor_output = extractor(question, rerank, match_id)
-            ext_fil_pred = search_cache_and_predict(ext_fil_pred, f'{log_path}/ext_fil_pred.json', 'ext_fil_pred', question, model_name, model, tokenizer, lambda: create_prompt(''.join(filter_output + extractor_output), question), maxlen, doc_len, 'E&F')
+            ext_fil_pred = search_cache_and_predict(ext_fil_pred, 'ext_fil_pred', question, model_name, model, tokenizer, lambda: create_prompt(''.join(filter_output + extractor_output), question), maxlen, doc_len, 'E&F')
     
-    if args.rb:
-        rb_pred = load_cache(f'{log_path}/rb_pred.json', 'rb_pred', question, doc_len, 'R&B')
+    if "rb" in modes:
+        rb_pred = load_cache('rb_pred', question, doc_len, 'R&B')
         if not rb_pred:
-            rb_pred = search_cache_and_predict(rb_pred, f'{log_path}/rb_pred.json', 'rb_pred', question, model_name, model, tokenizer, lambda: create_prompt(''.join(rerank), question), maxlen, doc_len, 'R&B')
+            rb_pred = search_cache_and_predict(rb_pred, 'rb_pred', question, model_name, model, tokenizer, lambda: create_prompt(''.join(rerank), question), maxlen, doc_len, 'R&B')
     
-    if args.rl:
-        rl_pred = load_cache(f'{log_path}/rl_pred.json', 'rl_pred', question, doc_len, 'R&L')
+    if "rl" in modes:
+        rl_pred = load_cache('rl_pred', question, doc_len, 'R&L')
         if not rl_pred:
-            rl_pred = search_cache_and_predict(rl_pred, f'{log_path}/rl_pred.json', 'rl_pred', question, model_name, model, tokenizer, lambda: create_prompt(''.join(s2l_doc(rerank, match_id, maxlen)[0]), question), maxlen, doc_len, 'R&L')
+            rl_pred = search_cache_and_predict(rl_pred, 'rl_pred', question, model_name, model, tokenizer, lambda: create_prompt(''.join(s2l_doc(rerank, match_id, maxlen, maxlen - get_word_len(create_prompt('', question)))[0]), question), maxlen, doc_len, 'R&L')
     
     return question, retriever, rerank, raw_pred, rb_pred, ext_pred, fil_pred, rl_pred, ext_fil_pred, doc_len
 
-def load_cache(cache_path, pred_key, question, doc_len=None, doc_key=None):
-    if os.path.exists(cache_path):
-        with open(cache_path, 'r', encoding='utf-8') as f:
-            for line in f.readlines():
-                data = json.loads(line)
-                if data['question'] == question:
-                    pred_result = data[pred_key]
-                    if doc_len is not None and doc_key is not None:
-                        doc_len[doc_key] = data["input_len"]
-                    return pred_result
-    return ''
-
-def search_cache_and_predict(pred_result, cache_path, pred_key, question, model_name, model, tokenizer, create_prompt_func, maxlen, doc_len=None, doc_key=None):
+def load_cache(pred_key, question, doc_len=None, doc_key=None):
+    cached = pred_cache.get(question, pred_key)
+    if cached is None:
+        tracer.count("pred_cache_miss")
+        return ''
+    tracer.count("pred_cache_hit")
+    pred_result, input_len = cached
+    if doc_len is not None and doc_key is not None:
+        doc_len[doc_key] = input_len
+    return pred_result
+
+def search_cache_and_predict(pred_result, pred_key, question, model_name, model, tokenizer, create_prompt_func, maxlen, doc_len=None, doc_key=None):
     if not pred_result:
-        query = create_prompt_func()
-        pred_result, input_len = pred(model_name, model, tokenizer, query, maxlen)
-        with open(cache_path, 'a', encoding='utf-8') as f:
-            json.dump({'question': question, pred_key: pred_result, "input_len": input_len}, f, ensure_ascii=False)
-            f.write('\n')
+        with tracer.span(f"generate.{pred_key}"):
+            query = create_prompt_func()
+            pred_result, input_len = pred(model_name, model, tokenizer, query, maxlen)
+            count_tokens([(pred_result, input_len)])
+        pred_cache.put(question, pred_key, pred_result, input_len)
         if doc_len is not None and doc_key is not None:
             doc_len[doc_key] = input_len
     return pred_result
 
-def s2l_doc(rerank, match_id, maxlen):
-    unique_raw_id = []
+def s2l_doc(rerank, match_id, maxlen, budget=None):
+    """Expand the reranked chunks to their deduplicated paragraphs, keeping the total under `budget` tokens."""
+    section_index = [int(id_to_rawid[i]) for i in match_id]
+    groups = group_positions(section_index)
+    if token_lengths is not None:
+        # Counted at index build time with the same tokenizer
+        paragraph_token_lens, chunk_token_lens = token_lengths
+        paragraph_lens = {id: int(paragraph_token_lens[id]) for id in groups}
+        chunk_lens = chunk_token_lens[np.asarray(match_id, dtype=np.int64)].tolist()
+    else:
+        paragraph_lens = dict(zip(groups, token_counter.lengths([paragraphs[id] for id in groups])))
+        chunk_lens = token_counter.lengths(rerank)
     contents = []
     s2l_index = {}
-    section_index = [id_to_rawid[str(i)] for i in match_id]
-    for index, id in enumerate(section_index):
-        data = raw_data[id]
-        text = data["paragraph_text"]
-        if id in unique_raw_id and get_word_len(text) < maxlen:
-            continue
-        if get_word_len(text) >= maxlen:
-            content = rerank[index]
-        else:
-            unique_raw_id.append(id)
-            content = text
-        s2l_index[len(contents)] = [i for i, v in enumerate(section_index) if v == section_index[index]]
-        contents.append(content)
+    for position, is_paragraph in pack_context(section_index, paragraph_lens, chunk_lens, maxlen, budget, args.pack):
+        s2l_index[len(contents)] = groups[section_index[position]]
+        contents.append(paragraphs[section_index[position]] if is_paragraph else rerank[position])
     return contents, s2l_index
 
-
 def filter(question,rank_docs): 
     
     content="\n".join(rank_docs)
     query=f"{content}\n\nPlease combine the above information and give your thinking process for the following question:{question}."
-    think_pro,_=pred(lrag_model_name, lrag_model, lrag_tokenizer, query,lrag_maxlen,1000)
+    with tracer.span("filter.think"):
+        think_pro,prompt_len=pred(lrag_model_name, lrag_model, lrag_tokenizer, query,lrag_maxlen,1000)
+        count_tokens([(think_pro, prompt_len)])
     selected = []
 
     prompts=[f"""Given an article:{d}\nQuestion: {question}.\nThought process:{think_pro}.\nYour task is to use the thought process provided to decide whether you need to cite the article to answer this question. If you need to cite the article, set the status value to True. If not, set the status value to False. Please output the response in the following json format: {{"status": "{{the value of status}}"}}""" for d in rank_docs]
-    pool = ThreadPool(processes=args.MaxClients)
-    all_responses=pool.starmap(pred, [(lrag_model_name,lrag_model, lrag_tokenizer,prompt,lrag_maxlen,32) for prompt in prompts])
+    with tracer.span("filter.verdicts"):
+        all_responses=pred_batch(lrag_model_name, lrag_model, lrag_tokenizer, prompts, lrag_maxlen, 32)
+        count_tokens(all_responses)
 
     for i,r in enumerate(all_responses):
         try:    
@@ -276,57 +393,322 @@ def filter(question,rank_docs):
 
 
 def r2long_unique(rerank, match_id):
-    unique_raw_id = list(set(id_to_rawid[str(i)] for i in match_id))
-    section_index = [id_to_rawid[str(i)] for i in match_id]
-    contents = [''.join(rerank[i] for i in range(len(section_index)) if section_index[i] == uid) for uid in unique_raw_id]
+    section_index = [int(id_to_rawid[i]) for i in match_id]
+    unique_raw_id = list(set(section_index))
+    groups = group_positions(section_index)
+    contents = [''.join(rerank[i] for i in groups[uid]) for uid in unique_raw_id]
     return contents, unique_raw_id
 
 def extractor(question, docs, match_id):
-    long_docs = s2l_doc(docs, match_id, lrag_maxlen)[0]
+    instruction = f".\n\nBased on the above background, please output the information you need to cite to answer the question below.\n{question}"
+    long_docs = s2l_doc(docs, match_id, lrag_maxlen, lrag_maxlen - get_word_len(instruction))[0]
     content = ''.join(long_docs)
-    query = f"{content}.\n\nBased on the above background, please output the information you need to cite to answer the question below.\n{question}"
-    response = pred(lrag_model_name, lrag_model, lrag_tokenizer, query, lrag_maxlen, 1000)[0]
+    query = f"{content}{instruction}"
+    with tracer.span("extractor"):
+        response, prompt_len = pred(lrag_model_name, lrag_model, lrag_tokenizer, query, lrag_maxlen, 1000)
+        count_tokens([(response, prompt_len)])
     # logger.info(f"cite_passage responses: {all_responses}")
     return [response]
 
 
 def vector_search(question):
-    feature = emb_model.encode([question])
-    distance, match_id = vector.search(feature, args.top_k1)
-    content = [chunk_data[int(i)] for i in match_id[0]]
-    return content, list(match_id[0])
+    return vector_search_batch([question])[0]
+
+def embed_questions(questions):
+    if emb_cache is None:
+        return emb_model.encode(questions, batch_size=args.batch_size)
+    features = [emb_cache.get(q) for q in questions]
+    missing = [i for i, f in enumerate(features) if f is None]
+    if missing:
+        encoded = emb_model.encode([questions[i] for i in missing], batch_size=args.batch_size)
+        emb_cache.put_many([questions[i] for i in missing], encoded)
+        for i, f in zip(missing, encoded):
+            features[i] = f
+    return np.stack(features).astype(np.float32)
+
+def vector_search_batch(questions):
+    # One encode call and one FAISS search for the whole batch of questions
+    with tracer.span("embed"):
+        features = embed_questions(questions)
+    with tracer.span("faiss"):
+        # Chunks of paragraphs removed by incremental updates are skipped by the search itself
+        distance, match_ids = vector.search(features, args.top_k1, params=index_params)
+    if bm25_index is not None:
+        with tracer.span("bm25"):
+            sparse = [drop_deleted(scores, ids) for scores, ids in bm25_index.search_batch(questions, args.sparse_top_k)]
+        match_ids = [fuse(dense, s, args.top_k1, args.fusion, dense_weight=args.dense_weight) for dense, s in zip(zip(distance, match_ids), sparse)]
+    match_ids = [[int(i) for i in ids if i >= 0] for ids in match_ids]
+    return [([chunk_data[i] for i in ids], ids) for ids in match_ids]
+
+def drop_deleted(scores, ids):
+    # Ids past the end of the index can only come from a BM25 index newer than it
+    keep = ids < vector.ntotal
+    if deleted_chunk_mask is not None:
+        keep[keep] = ~deleted_chunk_mask[ids[keep]]
+    return scores[keep], ids[keep]
 
 def sort_section(question, section, match_id):
-    q = [question] * len(section)
-    features = cross_tokenizer(q, section, padding=True, truncation=True, return_tensors="pt").to(device)
+    return sort_section_batch([question], [section], [match_id])[0]
+
+def score_pairs(questions, sections, pairs, max_length=None):
+    """Cross-encoder scores of (question index, section index) pairs, in micro-batches of similar length to reduce padding."""
+    order = sorted(range(len(pairs)), key=lambda p: len(questions[pairs[p][0]]) + len(sections[pairs[p][0]][pairs[p][1]]))
+    scores = np.empty(len(pairs), dtype=np.float32)
     cross_model.eval()
-    with torch.no_grad():
-        scores = cross_model(**features).logits.squeeze(dim=1)
-    sort_scores = torch.argsort(scores, dim=0, descending=True).cpu()
-    result = [section[sort_scores[i].item()] for i in range(args.top_k2)]
-    match_id = [match_id[sort_scores[i].item()] for i in range(args.top_k2)]
-    return result, match_id
+    for start in range(0, len(order), args.rerank_batch_size):
+        batch = order[start:start + args.rerank_batch_size]
+        features = cross_tokenizer([questions[pairs[p][0]] for p in batch], [sections[pairs[p][0]][pairs[p][1]] for p in batch], padding=True, truncation=True, max_length=max_length, return_tensors="pt").to(device)
+        with torch.no_grad():
+            scores[batch] = cross_model(**features).logits[:, 0].float().cpu().numpy()
+    return scores
+
+def cascade_survivors(questions, sections, pairs):
+    """Prune the candidate pairs of every question to the `cascade_keep` best under a cheap first pass:
+    the cross-encoder on inputs truncated to `cascade_max_length` tokens, or the retrieval order."""
+    by_question = {}
+    for p, (qi, _) in enumerate(pairs):
+        by_question.setdefault(qi, []).append(p)
+    if args.cascade_first_pass == "truncated":
+        with tracer.span("rerank.first_pass"):
+            cheap = score_pairs(questions, sections, pairs, args.cascade_max_length)
+    else:
+        # Candidates arrive in retrieval order, best first
+        cheap = -np.array([j for _, j in pairs], dtype=np.float32)
+    survivors = []
+    for ps in by_question.values():
+        if len(ps) > args.cascade_keep:
+            ps = np.asarray(ps)[np.argpartition(-cheap[ps], args.cascade_keep - 1)[:args.cascade_keep]].tolist()
+        survivors.extend(ps)
+    return [pairs[p] for p in sorted(survivors)]
+
+def sort_section_batch(questions, sections, match_ids):
+    if rerank_cache is None:
+        scores = [np.full(len(section), np.nan, dtype=np.float32) for section in sections]
+    else:
+        scores = [rerank_cache.get(question, match_id) for question, match_id in zip(questions, match_ids)]
+    candidates = [(qi, j) for qi, section in enumerate(sections) for j in range(len(section))]
+    if args.cascade_keep > 0:
+        # The first pass always sees every candidate, so cached full scores never change which ones survive
+        survivors = cascade_survivors(questions, sections, candidates)
+        tracer.count("rerank_pruned", len(candidates) - len(survivors))
+        keep = [np.zeros(len(section), dtype=bool) for section in sections]
+        for qi, j in survivors:
+            keep[qi][j] = True
+        candidates = survivors
+    pairs = [(qi, j) for qi, j in candidates if np.isnan(scores[qi][j])]
+    tracer.count("rerank_pairs", len(pairs))
+    for (qi, j), score in zip(pairs, score_pairs(questions, sections, pairs)):
+        scores[qi][j] = score
+    if rerank_cache is not None and pairs:
+        scored = {}
+        for qi, j in pairs:
+            scored.setdefault(qi, []).append(j)
+        for qi, js in scored.items():
+            rerank_cache.put(questions[qi], [match_ids[qi][j] for j in js], scores[qi][js])
+    results = []
+    for qi, (section, match_id, score) in enumerate(zip(sections, match_ids, scores)):
+        # Pairs pruned by the cascade rank last, even if an earlier run cached their full score
+        score = np.nan_to_num(score, nan=-np.inf)
+        if args.cascade_keep > 0:
+            score = np.where(keep[qi], score, -np.inf)
+        k = min(args.top_k2, len(section))
+        top = np.argpartition(-score, k - 1)[:k] if 0 < k < len(section) else np.arange(k)
+        top = top[np.argsort(-score[top], kind='stable')].tolist()
+        results.append(([section[i] for i in top], [match_id[i] for i in top]))
+    return results
+
+def selected_modes():
+    return {mode for mode in MODES if getattr(args, mode)}
+
+def needs_retrieval(modes=None):
+    return bool(set(selected_modes() if modes is None else modes) - {"raw_pred"})
+
+def needs_lrag_model(modes=None):
+    return bool(set(selected_modes() if modes is None else modes) & {"ext", "fil", "ext_fil"})
+
+def retrieve_batch(batch):
+    tracer.start_batch()
+    if not needs_retrieval():
+        return [([], [], [])] * len(batch), tracer.finish_batch(len(batch))
+    retrieved = vector_search_batch(batch)
+    with tracer.span("rerank"):
+        reranked = sort_section_batch(batch, [r[0] for r in retrieved], [r[1] for r in retrieved])
+    return [(retriever, rerank, match_id) for (retriever, _), (rerank, match_id) in zip(retrieved, reranked)], tracer.finish_batch(len(batch))
+
+def search_q_traced(question, retrieved, retrieval_stages, modes=None):
+    tracer.start_question(question, retrieval_stages)
+    try:
+        with tracer.span("question"):
+            return search_q(question, retrieved, modes)
+    finally:
+        tracer.finish_question()
+
+def count_tokens(responses):
+    # Completion tokens are only counted when tracing, since it costs a tokenization
+    if tracer.enabled:
+        tracer.add_tokens(sum(prompt_len or 0 for _, prompt_len in responses), sum(get_word_len(r) for r, _ in responses if r))
+
+def run_questions(questions):
+    """Yield search_q results in question order. Retrieval/rerank batches and per-question
+    generation run on separate executors with their own concurrency limits."""
+    questions = iter(questions)
+    retrieving, generating = deque(), deque()
+    with ThreadPoolExecutor(args.retrieval_workers) as retrieval_pool, ThreadPoolExecutor(args.workers) as generation_pool:
+        def submit_retrieval():
+            batch = list(islice(questions, args.batch_size))
+            if batch:
+                retrieving.append((batch, retrieval_pool.submit(retrieve_batch, batch)))
+
+        for _ in range(args.retrieval_workers + 1):
+            submit_retrieval()
+        while retrieving:
+            batch, future = retrieving.popleft()
+            submit_retrieval()
+            retrieved_batch, retrieval_stages = future.result()
+            for query, retrieved in zip(batch, retrieved_batch):
+                generating.append(generation_pool.submit(search_q_traced, query, retrieved, retrieval_stages))
+                # Bound the number of questions held in memory ahead of the consumer
+                while len(generating) > 2 * args.workers:
+                    yield generating.popleft().result()
+        while generating:
+            yield generating.popleft().result()
 
 def create_prompt(input, question):
     user_prompt = f"Answer the question based on the given passages. Only give me the answer and do not output any other words.\n\nThe following are given passages.\n{input}\n\nAnswer the question based on the given passages. Only give me the answer and do not output any other words.\n\nQuestion: {question}\nAnswer:"
     return user_prompt
 
+def create_raw_prompt(question):
+    # The --raw_pred baseline: the same instructions without any passages
+    user_prompt = f"Answer the question. Only give me the answer and do not output any other words.\n\nQuestion: {question}\nAnswer:"
+    return user_prompt
 
-if __name__ == '__main__':
-    seed_everything(42)
-    index_path = f'{args.r_path}/{args.dataset}/vector.index' # Vector index path
-    vector = faiss.read_index(index_path)
+
+def write_json(path, data):
+    # Written to a temporary file first so that a crash never leaves a truncated result
+    with open(f"{path}.tmp", "w") as fout:
+        json.dump(data, fout, ensure_ascii=False, indent=4)
+    os.replace(f"{path}.tmp", path)
+
+# Components built by gen_index.py, reloaded together when the corpus is updated
+CORPUS_COMPONENTS = ["index", "chunks", "token_lengths", "tombstones"]
+
+def corpus_path():
+    return f'{args.r_path}/{args.dataset}'
+
+def load_vector_index():
+    if args.sharded:
+        if not has_shards(corpus_path()):
+            raise FileNotFoundError(f"No shard indexes in {corpus_path()}, build them with gen_index.py --num_shards")
+        # One connection per concurrent retrieval batch
+        return ShardedIndex(corpus_path(), args.shard_nodes, args.retrieval_workers, args.shard_threads, args.nprobe, args.ef_search), load_shards_meta(corpus_path())
+    from vector_store import load_index
+    return load_index(f'{corpus_path()}/vector.index', args.nprobe, args.ef_search)
+
+def load_chunks():
+    if has_chunk_store(corpus_path()):
+        return load_chunk_store(corpus_path())
+    # Indexes built before the binary chunk store was introduced
     with open(f'../data/corpus/raw/{args.dataset}.json', encoding='utf-8') as f:
-        raw_data = json.load(f)
-    with open(f'{args.r_path}/{args.dataset}/id_to_rawid.json', encoding='utf-8') as f:
+        paragraphs = [d["paragraph_text"] for d in json.load(f)]
+    with open(f'{corpus_path()}/id_to_rawid.json', encoding='utf-8') as f:
         id_to_rawid = json.load(f)
-    with open(f"{args.r_path}/{args.dataset}/chunks.json", "r") as fin:
+        id_to_rawid = [id_to_rawid[str(i)] for i in range(len(id_to_rawid))]
+    with open(f"{corpus_path()}/chunks.json", "r") as fin:
         chunk_data = json.load(fin)
-
-    now = datetime.now() 
-    now_time = now.strftime("%Y-%m-%d-%H:%M:%S")
-    log_path = args.log_path or f'./log/{args.r_path.split("/")[-1]}/{args.dataset}/{args.model}/{args.lrag_model or "base"}/{now_time}'
+    return chunk_data, id_to_rawid, paragraphs
+
+def load_bm25():
+    if not has_bm25(corpus_path()):
+        raise FileNotFoundError(f"No BM25 index in {corpus_path()}, build it with gen_index.py --bm25")
+    return BM25Index(corpus_path())
+
+def load_corpus_token_lengths(registry):
+    lengths = load_token_lengths(corpus_path(), model2path["chatglm3-6b-32k"])
+    # A sidecar that was not extended by an incremental update does not cover the new paragraphs
+    if lengths is not None and len(lengths[0]) < len(registry.get("chunks")[2]):
+        return None
+    return lengths
+
+def load_deleted(registry):
+    """Mask of the chunks removed by incremental updates and the search parameters that skip them."""
+    from vector_store import search_params
+    vector, _ = registry.get("index")
+    tombstones = load_tombstones(corpus_path()) if has_chunk_store(corpus_path()) else []
+    if not len(tombstones):
+        return None, None
+    deleted = deleted_chunks(registry.get("chunks")[1][:vector.ntotal], tombstones)
+    if isinstance(vector, ShardedIndex):
+        # Each node keeps the tombstones of its shard
+        vector.set_deleted(deleted)
+        return deleted, None
+    return deleted, search_params(vector, deleted)
+
+def register_corpus(registry):
+    registry.register("index", load_vector_index)
+    registry.register("chunks", load_chunks)
+    registry.register("bm25", load_bm25)
+    registry.register("token_lengths", lambda: load_corpus_token_lengths(registry))
+    registry.register("tombstones", lambda: load_deleted(registry))
+
+def rerank_corpus_key():
+    # Rerank scores refer to chunk ids, so they are only shared between runs on the same index build.
+    # Incremental updates keep the ids of all chunks, so they keep the key of their build.
+    index_path = f'{corpus_path()}/vector.index'
+    if generation is not None and generation.get("built_at"):
+        return text_hash(f"{os.path.abspath(index_path)}:{generation['built_at']}")[:16]
+    return text_hash(f"{os.path.abspath(index_path)}:{vector.ntotal}:{os.path.getmtime(index_path)}")[:16]
+
+def reload_corpus():
+    """Load the corpus generation last committed by gen_index.py --update if it is not the
+    loaded one. Returns whether a new generation was loaded."""
+    global generation, vector, index_meta, bm25_index, chunk_data, id_to_rawid, paragraphs, token_lengths
+    global deleted_chunk_mask, index_params, rerank_cache
+    latest = load_generation(corpus_path())
+    if latest is None or latest == generation:
+        return False
+    registry = ComponentRegistry()
+    register_corpus(registry)
+    registry.prefetch(CORPUS_COMPONENTS + (["bm25"] if args.hybrid else []))
+    new_vector, new_index_meta = registry.get("index")
+    new_bm25_index = registry.get("bm25") if args.hybrid else None
+    new_chunks = registry.get("chunks")
+    new_token_lengths = registry.get("token_lengths")
+    new_deleted = registry.get("tombstones")
+    # The chunk store only grows, so it is swapped first and serves every id of the old index;
+    # the tombstones are swapped before the index so that removed chunks never reappear
+    chunk_data, id_to_rawid, paragraphs = new_chunks
+    token_lengths = new_token_lengths
+    bm25_index = new_bm25_index
+    deleted_chunk_mask, index_params = new_deleted
+    previous_vector, vector, index_meta = vector, new_vector, new_index_meta
+    if isinstance(previous_vector, ShardedIndex):
+        previous_vector.close()
+    previous, generation = generation, latest
+    if rerank_cache is not None and (previous or {}).get("built_at") != latest.get("built_at"):
+        rerank_cache = RerankCache(args.retrieval_cache_dir, model2path["rerank_model"], rerank_corpus_key())
+    logger.info(f"Loaded corpus generation {latest.get('generation')} in {sum(registry.loaded_timings().values()):.2f}s: {latest}")
+    return True
+
+def watch_corpus(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            reload_corpus()
+        except Exception:
+            logger.exception("Loading the new corpus generation failed")
+
+def setup(path):
+    """Load the components of the selected modes and create the caches, logger and tracer under `path`."""
+    global log_path, tracer, model_name, model2path, maxlen, lrag_model_name, lrag_maxlen, device, components
+    global model, tokenizer, lrag_model, lrag_tokenizer, set_prompt_tokenizer, token_counter, filter_pool
+    global vector, index_meta, bm25_index, chunk_data, id_to_rawid, paragraphs, token_lengths, emb_model, cross_tokenizer, cross_model
+    global generation, deleted_chunk_mask, index_params, emb_cache, rerank_cache, prefix_cache, pred_cache
+    log_path = path
+    seed_everything(42)
+    if args.async_api:
+        enable_async_client()
     os.makedirs(log_path, exist_ok=True)
+    tracer = Tracer(f"{log_path}/trace.jsonl" if args.trace else None)
 
     with open("../config/config.yaml", "r") as file:
         config = yaml.safe_load(file)
@@ -334,69 +716,109 @@ if __name__ == '__main__':
     model_name = args.model.lower()
     model2path = config["model_path"]
     maxlen = config["model_maxlen"][model_name]
+    lrag_model_name = args.lrag_model.lower() if args.lrag_model else model_name
+    lrag_maxlen = config["model_maxlen"][lrag_model_name]
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
-    emb_model = SentenceTransformer(model2path["emb_model"]).to(device)
-    cross_tokenizer = AutoTokenizer.from_pretrained(model2path["rerank_model"])
-    cross_model = AutoModelForSequenceClassification.from_pretrained(model2path["rerank_model"]).to(device)
-    model, tokenizer = load_model_and_tokenizer(model2path, model_name)
-    
-    if args.lrag_model:
-        lrag_model_name = args.lrag_model.lower()
-        lrag_maxlen = config["model_maxlen"][lrag_model_name]
-        lrag_model, lrag_tokenizer = (model, tokenizer) if model_name == lrag_model_name else load_model_and_tokenizer(model2path, lrag_model_name)
-    else:
-        lrag_model_name, lrag_model, lrag_tokenizer, lrag_maxlen = (model_name, model, tokenizer, maxlen)
-    set_prompt_tokenizer = AutoTokenizer.from_pretrained(model2path["chatglm3-6b-32k"], trust_remote_code=True)
+    def load_emb_model():
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(model2path["emb_model"]).to(device)
+
+    def load_cross_encoder():
+        from transformers import AutoTokenizer, AutoModelForSequenceClassification
+        # low_cpu_mem_usage skips the random initialisation and, for safetensors checkpoints, maps the weights from disk
+        return AutoTokenizer.from_pretrained(model2path["rerank_model"]), AutoModelForSequenceClassification.from_pretrained(model2path["rerank_model"], low_cpu_mem_usage=True).to(device)
+
+    def load_set_prompt_tokenizer():
+        from transformers import AutoTokenizer
+        return AutoTokenizer.from_pretrained(model2path["chatglm3-6b-32k"], trust_remote_code=True)
+
+    # Only the components used by the selected modes are loaded, all in parallel
+    components = ComponentRegistry()
+    register_corpus(components)
+    components.register("emb_model", load_emb_model)
+    components.register("cross_encoder", load_cross_encoder)
+    components.register("model", lambda: load_model_and_tokenizer(model2path, model_name))
+    components.register("lrag_model", lambda: components.get("model") if lrag_model_name == model_name else load_model_and_tokenizer(model2path, lrag_model_name))
+    components.register("set_prompt_tokenizer", load_set_prompt_tokenizer)
+    needed = ["model", "set_prompt_tokenizer"]
+    # Read before the corpus files, which are therefore at least as new
+    generation = load_generation(corpus_path())
+    if needs_retrieval():
+        needed += CORPUS_COMPONENTS + ["emb_model", "cross_encoder"] + (["bm25"] if args.hybrid else [])
+    if needs_lrag_model() and lrag_model_name != model_name:
+        needed.append("lrag_model")
+    components.prefetch(needed)
+
+    model, tokenizer = components.get("model")
+    # The LongRAG model is only used by the Extractor and Filter
+    lrag_model, lrag_tokenizer = components.get("lrag_model") if needs_lrag_model() else (None, None)
+    set_prompt_tokenizer = components.get("set_prompt_tokenizer")
+    token_counter = TokenCounter(set_prompt_tokenizer)
+    filter_pool = ThreadPool(processes=args.MaxClients)
+    emb_cache = rerank_cache = token_lengths = bm25_index = deleted_chunk_mask = index_params = None
+    if needs_retrieval():
+        vector, index_meta = components.get("index")
+        bm25_index = components.get("bm25") if args.hybrid else None
+        chunk_data, id_to_rawid, paragraphs = components.get("chunks")
+        token_lengths = components.get("token_lengths")
+        deleted_chunk_mask, index_params = components.get("tombstones")
+        emb_model = components.get("emb_model")
+        cross_tokenizer, cross_model = components.get("cross_encoder")
+        if args.retrieval_cache_dir:
+            emb_cache = EmbeddingCache(args.retrieval_cache_dir, model2path["emb_model"])
+            rerank_cache = RerankCache(args.retrieval_cache_dir, model2path["rerank_model"], rerank_corpus_key())
+    prefix_cache = PrefixKVCache(args.prefix_cache_tokens) if args.prefix_cache_tokens > 0 else None
+    # Cached predictions are only reused for the same generator/LongRAG models and prompt template
+    cache_model = model_name if lrag_model_name == model_name else f"{model_name}+{lrag_model_name}"
+    pred_cache = PredCache(log_path, cache_model, text_hash(create_prompt("{input}", "{question}"))[:12], args.cache_backend)
     setup_logger(logger)
     print_args(args)
+    logger.info(f"Loaded {', '.join(f'{name} in {t}s' for name, t in components.loaded_timings().items())}")
+    logger.info(f"Predictions are cached under model {cache_model} and prompt hash {pred_cache.prompt_hash}")
+    if needs_retrieval():
+        logger.info(f"Vector index: {index_meta}")
+        if token_lengths is None:
+            logger.info("No token length sidecar for the set_prompt tokenizer, paragraph lengths are counted at query time")
+        if generation is not None:
+            logger.info(f"Corpus generation: {generation}")
+        if args.reload_interval > 0:
+            threading.Thread(target=watch_corpus, args=(args.reload_interval,), daemon=True).start()
 
-    questions, answer, raw_preds, rank_preds, ext_preds, fil_preds, longdoc_preds, ext_fil_preds, docs_len = [], [], [], [], [], [], [], [], []
-    with open(f'../data/eval/{args.dataset}.json', encoding='utf-8') as f:
-        qs_data = json.load(f)
-
-    for d in qs_data:
-        questions.append(d["question"])
-        answer.append(d["answers"])
-
-    for index, query in tqdm(enumerate(questions)):
-        logger.info(f"Question: {query}")
-        question, retriever, rerank, raw_pred, rb_pred, ext_pred, fil_pred, rl_pred, ext_fil_pred, doc_len = search_q(query)
-
-        raw_preds.append(raw_pred)
-        rank_preds.append(rb_pred)
-        ext_preds.append(ext_pred)
-        fil_preds.append(fil_pred)
-        longdoc_preds.append(rl_pred)
-        ext_fil_preds.append(ext_fil_pred)
-        docs_len.append(doc_len)
-
-    all_len1 = all_len2 = all_len3 = all_len4 = all_len5 = 0
-    for dl in docs_len:
-        all_len1 += dl.get('Ext', 0)
-        all_len2 += dl.get('Fil', 0)
-        all_len3 += dl.get('R&B', 0)
-        all_len4 += dl.get('R&L', 0)
-        all_len5 += dl.get('E&F', 0)
-
-    doc_len_eval = {
-        "Ext": all_len1 / len(docs_len),
-        "Fil": all_len2 / len(docs_len),
-        "R&B": all_len3 / len(docs_len),
-        "R&L": all_len4 / len(docs_len),
-        "E&F": all_len5 / len(docs_len)
-    }
-    
-    
-    F1 = {
-        "raw_pre": F1_scorer(raw_preds, answer),
-        "R&B": F1_scorer(rank_preds, answer),
-        "Ext": F1_scorer(ext_preds, answer),
-        "Fil": F1_scorer(fil_preds, answer),
-        "R&L": F1_scorer(longdoc_preds, answer),
-        "E&F": F1_scorer(ext_fil_preds, answer)
-    }
-
-    eval_result = {"F1": F1, "doc_len": doc_len_eval}
-    with open(f"{log_path}/eval_result.json", "w") as fout:
-        json.dump(eval_result, fout, ensure_ascii=False, indent=4)
\ No newline at end of file
+if __name__ == '__main__':
+    now = datetime.now() 
+    now_time = now.strftime("%Y-%m-%d-%H:%M:%S")
+    setup(args.log_path or f'./log/{args.r_path.split("/")[-1]}/{args.dataset}/{args.model}/{args.lrag_model or "base"}/{now_time}')
+
+    # Questions are read lazily; only the answers of questions still in flight are held
+    answers = deque()
+    def questions():
+        for d in iter_records(args.eval_file or f'../data/eval/{args.dataset}.json'):
+            answers.append(d["answers"])
+            yield d["question"]
+
+    evaluation = RunningEval(["raw_pre", "R&B", "Ext", "Fil", "R&L", "E&F"], ["Ext", "Fil", "R&B", "R&L", "E&F"])
+    for question, retriever, rerank, raw_pred, rb_pred, ext_pred, fil_pred, rl_pred, ext_fil_pred, doc_len in tqdm(run_questions(questions())):
+        logger.info(f"Question: {question}")
+        evaluation.add(answers.popleft(), {"raw_pre": raw_pred, "R&B": rb_pred, "Ext": ext_pred, "Fil": fil_pred, "R&L": rl_pred, "E&F": ext_fil_pred}, doc_len)
+        if args.flush_every and evaluation.count % args.flush_every == 0:
+            write_json(f"{log_path}/eval_result.json", dict(evaluation.result(), partial=True))
+    filter_pool.close()
+    if emb_cache is not None:
+        logger.info(f"Retrieval cache: {emb_cache.hits} embedding hits, {emb_cache.misses} misses; {rerank_cache.hits} rerank hits, {rerank_cache.misses} misses")
+    if prefix_cache is not None:
+        logger.info(f"Prefix cache: {prefix_cache.hits} hits, {prefix_cache.misses} misses, {prefix_cache.reused_tokens} prompt tokens reused")
+
+    pred_cache.close()
+
+    eval_result = evaluation.result()
+    if tracer.enabled:
+        caches = {"token_counter": (token_counter.hits, token_counter.misses)}
+        if emb_cache is not None:
+            caches.update({"embedding": (emb_cache.hits, emb_cache.misses), "rerank": (rerank_cache.hits, rerank_cache.misses)})
+        if prefix_cache is not None:
+            caches["prefix_kv"] = (prefix_cache.hits, prefix_cache.misses)
+        caches["prediction"] = (tracer.counters["pred_cache_hit"], tracer.counters["pred_cache_miss"])
+        eval_result["trace"] = tracer.summary(caches)
+        tracer.close()
+    write_json(f"{log_path}/eval_result.json", eval_result)
\ No newline at end of file
@@ -1,23 +1,22 @@
+import os
+import re
+import json
 import string
+import sqlite3
+import argparse
 from collections import Counter
-import re
-def normalize_answer(s):
-    """Lower text and remove punctuation, articles and extra whitespace."""
-
-    def remove_articles(text):
-        return re.sub(r"\b(a|an|the)\b", " ", text)
+from functools import lru_cache
+from multiprocessing import Pool
 
-    def white_space_fix(text):
-        return " ".join(text.split())
+PUNCTUATION_TABLE = str.maketrans("", "", string.punctuation)
+ARTICLES_PATTERN = re.compile(r"\b(a|an|the)\b")
+# Prediction files written by main.py and the eval_result.json key of each mode
+PRED_KEYS = {"raw_pred": "raw_pre", "rb_pred": "R&B", "ext_pred": "Ext", "fil_pred": "Fil", "rl_pred": "R&L", "ext_fil_pred": "E&F"}
 
-    def remove_punc(text):
-        exclude = set(string.punctuation)
-        return "".join(ch for ch in text if ch not in exclude)
 
-    def lower(text):
-        return text.lower()
-
-    return white_space_fix(remove_articles(remove_punc(lower(s))))
+def normalize_answer(s):
+    """Lower text and remove punctuation, articles and extra whitespace."""
+    return " ".join(ARTICLES_PATTERN.sub(" ", s.lower().translate(PUNCTUATION_TABLE)).split())
 def f1_score(prediction, ground_truth):
     common = Counter(prediction) & Counter(ground_truth)
     num_same = sum(common.values())
@@ -42,4 +41,167 @@ def F1_scorer(predictions, answers):
         for ground_truth in ground_truths:
             score = max(score, qa_f1_score(prediction, ground_truth))
         total_score += score
-    return round(100 * total_score / len(predictions), 2)
\ No newline at end of file
+    return round(100 * total_score / len(predictions), 2)
+
+
+class RunningF1:
+    """`F1_scorer` over predictions added one at a time."""
+
+    def __init__(self):
+        self.total_score = 0.
+        self.count = 0
+
+    def add(self, prediction, ground_truths):
+        score = 0.
+        for ground_truth in ground_truths:
+            score = max(score, qa_f1_score(prediction, ground_truth))
+        self.total_score += score
+        self.count += 1
+
+    def score(self):
+        return round(100 * self.total_score / self.count, 2) if self.count else 0.
+
+
+class RunningEval:
+    """F1 per mode and mean document length per mode of the questions evaluated so far.
+
+    Only running sums are kept, so memory does not grow with the number of questions.
+    """
+
+    def __init__(self, f1_keys, doc_len_keys):
+        self.f1 = {key: RunningF1() for key in f1_keys}
+        self.doc_len = {key: 0 for key in doc_len_keys}
+        self.count = 0
+
+    def add(self, ground_truths, predictions, doc_len):
+        for key, prediction in predictions.items():
+            self.f1[key].add(prediction, ground_truths)
+        for key in self.doc_len:
+            self.doc_len[key] += doc_len.get(key, 0)
+        self.count += 1
+
+    def result(self):
+        return {
+            "F1": {key: f1.score() for key, f1 in self.f1.items()},
+            "doc_len": {key: total / self.count if self.count else 0. for key, total in self.doc_len.items()},
+            "num_questions": self.count,
+        }
+
+
+@lru_cache(maxsize=1 << 20)
+def ground_truth_tokens(ground_truth):
+    tokens = normalize_answer(ground_truth).split()
+    return tokens, Counter(tokens)
+
+def score_prediction(prediction, ground_truths):
+    """Best F1, exact match and token recall of `prediction` over `ground_truths`.
+    F1 is computed exactly as in `qa_f1_score`."""
+    prediction_tokens = normalize_answer(prediction).split()
+    prediction_counter = Counter(prediction_tokens)
+    best_f1 = best_em = best_recall = 0.
+    for ground_truth in ground_truths:
+        tokens, counter = ground_truth_tokens(ground_truth)
+        if prediction_tokens == tokens:
+            best_em = 1.
+        num_same = sum((prediction_counter & counter).values())
+        if num_same == 0:
+            continue
+        precision = 1.0 * num_same / len(prediction_tokens)
+        recall = 1.0 * num_same / len(tokens)
+        best_f1 = max(best_f1, (2 * precision * recall) / (precision + recall))
+        best_recall = max(best_recall, recall)
+    return best_f1, best_em, best_recall
+
+def _score_rows(chunk):
+    columns, answers = chunk
+    return {name: [score_prediction(prediction, ground_truths) for prediction, ground_truths in zip(predictions, answers)] for name, predictions in columns.items()}
+
+def bulk_score(columns, answers, workers=1, chunk_size=5000):
+    """F1, EM and recall of every prediction column in `columns` ({name: predictions}) against `answers`.
+
+    Ground truths are normalized once, all columns are scored in one pass over the rows, and
+    chunks of rows are scored in `workers` processes. Per-row scores are summed in row order,
+    so F1 is identical to `F1_scorer`.
+    """
+    chunks = [({name: predictions[i:i + chunk_size] for name, predictions in columns.items()}, answers[i:i + chunk_size]) for i in range(0, len(answers), chunk_size)]
+    if workers > 1 and len(chunks) > 1:
+        with Pool(workers) as pool:
+            parts = pool.map(_score_rows, chunks)
+    else:
+        parts = map(_score_rows, chunks)
+    totals = {name: [0., 0., 0.] for name in columns}
+    for part in parts:
+        for name, rows in part.items():
+            total = totals[name]
+            for f1, em, recall in rows:
+                total[0] += f1
+                total[1] += em
+                total[2] += recall
+    n = len(answers)
+    return {name: {metric: round(100 * value / n, 2) if n else 0. for metric, value in zip(("F1", "EM", "Recall"), total)} for name, total in totals.items()}
+
+def iter_logged_predictions(log_path):
+    """(mode, model, prompt hash, question, prediction) of every prediction saved in a main.py log
+    directory, from the `{mode}_pred.json` files and from `pred_cache.sqlite`."""
+    for pred_key in PRED_KEYS:
+        path = os.path.join(log_path, f"{pred_key}.json")
+        if not os.path.exists(path):
+            continue
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    data = json.loads(line)
+                    yield pred_key, data.get("model"), data.get("prompt_hash"), data["question"], data[pred_key]
+    path = os.path.join(log_path, "pred_cache.sqlite")
+    if os.path.exists(path):
+        db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            yield from db.execute("SELECT mode, model, prompt_hash, question, pred FROM preds")
+        finally:
+            db.close()
+
+def load_predictions(log_path, questions, model=None, prompt_hash=None):
+    """Prediction columns of a main.py log directory, aligned with `questions` ("" where missing).
+
+    Only predictions of `model` and `prompt_hash` are read when they are given. Predictions of
+    different models or prompt templates are never mixed: if several remain for a mode, each
+    gets its own column, named `{mode}:{model}:{prompt hash}`.
+    """
+    groups = {}
+    for pred_key, pred_model, pred_hash, question, pred in iter_logged_predictions(log_path):
+        if pred_key not in PRED_KEYS or (model and pred_model != model) or (prompt_hash and pred_hash != prompt_hash):
+            continue
+        groups.setdefault(pred_key, {}).setdefault((pred_model, pred_hash), {})[question] = pred
+    columns = {}
+    for pred_key, name in PRED_KEYS.items():
+        for (pred_model, pred_hash), preds in groups.get(pred_key, {}).items():
+            column = name if len(groups[pred_key]) == 1 else f"{name}:{pred_model}:{pred_hash}"
+            columns[column] = [preds.get(question, "") for question in questions]
+    return columns
+
+
+if __name__ == '__main__':
+    from jsonstream import iter_records
+    parser = argparse.ArgumentParser(description="Rescore the prediction logs of main.py with F1, EM and recall.")
+    parser.add_argument('--log_path', type=str, nargs="+", required=True, help="Log directories containing {mode}_pred.json files or pred_cache.sqlite")
+    parser.add_argument("--dataset", type=str, default="hotpotqa")
+    parser.add_argument('--eval_file', type=str, default="", help="Questions and answers, ../data/eval/{dataset}.json by default")
+    parser.add_argument('--model', type=str, default="", help="Only score predictions of this model (the model name main.py caches them under)")
+    parser.add_argument('--prompt_hash', type=str, default="", help="Only score predictions made with this prompt template hash")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--output', type=str, default="", help="Also write the scores to this JSON file")
+    args = parser.parse_args()
+
+    questions, answers = [], []
+    for d in iter_records(args.eval_file or f'../data/eval/{args.dataset}.json'):
+        questions.append(d["question"])
+        answers.append(d["answers"])
+    columns = {}
+    for log_path in args.log_path:
+        for name, predictions in load_predictions(log_path, questions, args.model, args.prompt_hash).items():
+            columns[f"{log_path}:{name}" if len(args.log_path) > 1 else name] = predictions
+    scores = bulk_score(columns, answers, args.workers)
+    print(json.dumps(scores, ensure_ascii=False, indent=4))
+    if args.output:
+        with open(args.output, "w", encoding='utf-8') as fout:
+            json.dump(scores, fout, ensure_ascii=False, indent=4)
@@ -0,0 +1,71 @@
+import re
+import json
+import time
+import random
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """OpenAI-compatible `/chat/completions` endpoint with injected latency and failures.
+    Prompts containing `bad_request` get a 400, and prompts containing `fail_<status>_<n>`
+    get that status on their first n attempts. The server counts the attempts of every
+    prompt and the peak number of requests in flight."""
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        prompt = body.get("messages", [{}])[-1].get("content", "")
+        with server.lock:
+            server.requests += 1
+            server.attempts[prompt] += 1
+            attempt = server.attempts[prompt]
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            fail = server.rng.random() < server.fail_rate
+            status = server.rng.choice([429, 500, 503]) if fail else 200
+            server.failures += fail
+        try:
+            time.sleep(server.latency)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+        injected = re.search(r"fail_(\d{3})_(\d+)", prompt)
+        if self.path.rstrip("/").split("/")[-1] != "completions":
+            status = 404
+        elif "bad_request" in prompt:
+            status = 400
+        elif injected and attempt <= int(injected.group(2)):
+            status = int(injected.group(1))
+        if status == 200:
+            payload = {"choices": [{"index": 0, "message": {"role": "assistant", "content": f"mock answer to: {prompt[:50]}"}}], "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": 8}}
+        else:
+            payload = {"error": {"code": status, "message": "mock error"}}
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_mock_server(host="127.0.0.1", port=0, latency=0.05, fail_rate=0.1, seed=0):
+    """Serve the mock API in a background thread and return (server, base_url)."""
+    ThreadingHTTPServer.request_queue_size = 1024
+    server = ThreadingHTTPServer((host, port), MockHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.fail_rate = fail_rate
+    server.rng = random.Random(seed)
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.failures = 0
+    server.attempts = Counter()
+    server.in_flight = 0
+    server.max_in_flight = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
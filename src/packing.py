@@ -0,0 +1,90 @@
+import numpy as np
+
+PACK_METHODS = ["greedy", "knapsack"]
+
+
+def group_positions(raw_ids):
+    """Positions of each paragraph id in the reranked list, in order of first appearance."""
+    groups = {}
+    for position, raw_id in enumerate(raw_ids):
+        groups.setdefault(raw_id, []).append(position)
+    return groups
+
+def pack_greedy(groups, paragraph_lens, chunk_lens, maxlen, budget):
+    """Visit the reranked chunks in order. The first chunk of a paragraph adds the whole
+    paragraph if it is shorter than `maxlen` and fits the remaining budget; otherwise, and
+    for the later chunks of a paragraph that was not added, the chunk itself is added if it fits."""
+    first = {positions[0]: raw_id for raw_id, positions in groups.items()}
+    raw_ids = {position: raw_id for raw_id, positions in groups.items() for position in positions}
+    added, selected = set(), []
+    for position in range(len(chunk_lens)):
+        raw_id = raw_ids[position]
+        if raw_id in added:
+            continue
+        if position in first and paragraph_lens[raw_id] < maxlen and paragraph_lens[raw_id] <= budget:
+            added.add(raw_id)
+            selected.append((position, True))
+            budget -= paragraph_lens[raw_id]
+        elif chunk_lens[position] <= budget:
+            selected.append((position, False))
+            budget -= chunk_lens[position]
+    return selected
+
+def pack_knapsack(groups, paragraph_lens, chunk_lens, maxlen, budget):
+    """Choose per paragraph either the whole paragraph or its top-ranked chunks so that the
+    total rank weight (1 / (rank + 1) of every covered chunk) is maximal within the budget.
+    Solved as a multiple-choice knapsack over token counts."""
+    weights = [1 / (position + 1) for position in range(len(chunk_lens))]
+    # Each option is (length, value, [(position, is_paragraph)])
+    group_options = []
+    for raw_id, positions in groups.items():
+        options = []
+        if paragraph_lens[raw_id] < maxlen:
+            options.append((paragraph_lens[raw_id], sum(weights[p] for p in positions), [(positions[0], True)]))
+        length = value = 0
+        for k, position in enumerate(positions):
+            length += chunk_lens[position]
+            value += weights[position]
+            options.append((length, value, [(p, False) for p in positions[:k + 1]]))
+        group_options.append(options)
+
+    best = np.zeros(budget + 1)
+    choices = []
+    for options in group_options:
+        new_best = best.copy()
+        choice = np.full(budget + 1, -1, dtype=np.int32)
+        for i, (length, value, _) in enumerate(options):
+            if length > budget:
+                continue
+            candidate = np.full(budget + 1, -np.inf)
+            candidate[length:] = best[:budget + 1 - length] + value
+            better = candidate > new_best
+            new_best[better] = candidate[better]
+            choice[better] = i
+        best = new_best
+        choices.append(choice)
+
+    selected, remaining = [], int(np.argmax(best))
+    for options, choice in zip(reversed(group_options), reversed(choices)):
+        i = choice[remaining]
+        if i >= 0:
+            selected.extend(options[i][2])
+            remaining -= options[i][0]
+    return sorted(selected)
+
+def pack_context(raw_ids, paragraph_lens, chunk_lens, maxlen, budget=None, method="greedy"):
+    """Select paragraphs and chunks of a reranked list whose token lengths sum to at most `budget`.
+
+    `raw_ids[i]` is the paragraph of the i-th reranked chunk, `paragraph_lens` maps a
+    paragraph id to its token length and `chunk_lens[i]` is the length of the i-th chunk.
+    Paragraphs of `maxlen` tokens or more are never expanded. Returns
+    (position, is_paragraph) pairs in reranked order; a selected paragraph is placed at the
+    position of its first chunk and covers all of its chunks.
+    """
+    groups = group_positions(raw_ids)
+    if budget is None:
+        budget = sum(chunk_lens) + sum(paragraph_lens[raw_id] for raw_id in groups)
+    budget = max(0, int(budget))
+    if method == "knapsack":
+        return pack_knapsack(groups, paragraph_lens, chunk_lens, maxlen, budget)
+    return pack_greedy(groups, paragraph_lens, chunk_lens, maxlen, budget)
@@ -0,0 +1,109 @@
+import copy
+import threading
+from collections import OrderedDict
+import torch
+from transformers import DynamicCache
+
+
+def crop_past(past_key_values, length):
+    if hasattr(past_key_values, "crop"):
+        # Negative values remove tokens from the end in every transformers version with `crop`
+        excess = past_key_values.get_seq_length() - length
+        if excess > 0:
+            past_key_values.crop(-excess)
+        return past_key_values
+    return tuple(tuple(t[:, :, :length] for t in layer) for layer in past_key_values)
+
+def layer_tensors(past_key_values):
+    """(key, value) of every layer of a cache object or of legacy tuples."""
+    if hasattr(past_key_values, "layers"):
+        return [(layer.keys, layer.values) for layer in past_key_values.layers]
+    if hasattr(past_key_values, "key_cache"):
+        return list(zip(past_key_values.key_cache, past_key_values.value_cache))
+    return [tuple(layer) for layer in past_key_values]
+
+def copy_prefix(past_key_values, length):
+    """Copy of the first `length` positions of a cache, leaving the cache itself untouched."""
+    if hasattr(past_key_values, "crop") and type(past_key_values) is not DynamicCache:
+        # Other cache classes cannot be rebuilt from their tensors alone
+        return crop_past(copy.deepcopy(past_key_values), length)
+    layers = [(k[:, :, :length].clone(), v[:, :, :length].clone()) for k, v in layer_tensors(past_key_values)]
+    if not hasattr(past_key_values, "crop"):
+        return tuple(layers)
+    cache = DynamicCache()
+    for i, (k, v) in enumerate(layers):
+        cache.update(k, v, i)
+    return cache
+
+def common_prefix_len(a, b):
+    n = min(len(a), len(b))
+    mismatch = (a[:n] != b[:n]).nonzero()
+    return mismatch[0].item() if len(mismatch) else n
+
+
+class PrefixKVCache:
+    """LRU cache of prompt `past_key_values` for local HF models.
+
+    Prompts of one question share long prefixes across modes (the instruction followed by
+    the reranked passages in R&B and Ext, for example). `generate` looks up the cached prompt
+    with the longest common token prefix, crops its cache to that prefix and only prefills
+    the remaining tokens. Memory is bounded by the total number of cached prompt tokens.
+    """
+
+    def __init__(self, max_tokens=65536, min_prefix=256):
+        self.max_tokens = max_tokens
+        self.min_prefix = min_prefix
+        self.cached_tokens = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+
+    def lookup(self, model, input_ids):
+        best_key, best_len = None, 0
+        with self.lock:
+            for key, (model_id, ids, _) in self.entries.items():
+                if model_id != id(model):
+                    continue
+                n = common_prefix_len(ids, input_ids)
+                if n > best_len:
+                    best_key, best_len = key, n
+            # At least one prompt token has to be fed to the model to start generating
+            best_len = min(best_len, len(input_ids) - 1)
+            if best_key is None or best_len < self.min_prefix:
+                self.misses += 1
+                return 0, None
+            self.entries.move_to_end(best_key)
+            past = self.entries[best_key][2]
+            self.hits += 1
+            self.reused_tokens += best_len
+        # Cached entries are never modified, so only the matched prefix is copied, outside the lock
+        return best_len, copy_prefix(past, best_len)
+
+    def store(self, model, input_ids, past_key_values):
+        key = (id(model), hash(tuple(input_ids.tolist())))
+        with self.lock:
+            if key in self.entries or len(input_ids) > self.max_tokens:
+                return
+            self.entries[key] = (id(model), input_ids, crop_past(past_key_values, len(input_ids)))
+            self.cached_tokens += len(input_ids)
+            while self.cached_tokens > self.max_tokens:
+                _, (_, ids, _) = self.entries.popitem(last=False)
+                self.cached_tokens -= len(ids)
+
+    def generate(self, model, input_ids, **kwargs):
+        """`model.generate(input_ids, **kwargs)` for a single prompt, reusing and then caching its prefix."""
+        prompt_ids = input_ids[0].detach()
+        _, past = self.lookup(model, prompt_ids)
+        kwargs = dict(kwargs, return_dict_in_generate=True, use_cache=True, attention_mask=torch.ones_like(input_ids))
+        try:
+            output = model.generate(input_ids, past_key_values=past, **kwargs) if past is not None else model.generate(input_ids, **kwargs)
+        except Exception:
+            if past is None:
+                raise
+            # Models whose remote code cannot continue from a cropped cache
+            output = model.generate(input_ids, **kwargs)
+        if output.past_key_values is not None:
+            self.store(model, prompt_ids, output.past_key_values)
+        return output.sequences
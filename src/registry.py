@@ -0,0 +1,65 @@
+import time
+import threading
+from concurrent.futures import Future
+
+
+class ComponentRegistry:
+    """Models, tokenizers and indexes loaded on demand.
+
+    Each component is registered with a loader and loaded at most once, on the first `get`
+    or in the background by `prefetch`, which starts every requested loader in its own
+    thread so that disk reads and weight initialisation overlap. Loaders may `get` other
+    components; `get` waits for a load that is already in flight.
+    """
+
+    def __init__(self):
+        self.loaders = {}
+        self.futures = {}
+        self.timings = {}
+        self.lock = threading.Lock()
+
+    def register(self, name, loader):
+        self.loaders[name] = loader
+
+    def _start(self, name):
+        """Future of `name` and whether the caller has to run its loader."""
+        with self.lock:
+            if name in self.futures:
+                return self.futures[name], False
+            if name not in self.loaders:
+                raise KeyError(f"Unknown component: {name}")
+            self.futures[name] = Future()
+            return self.futures[name], True
+
+    def _load(self, name, future):
+        start = time.time()
+        try:
+            result = self.loaders[name]()
+        except BaseException as e:
+            self._record(name, start)
+            future.set_exception(e)
+            return
+        # Recorded before the result is published, so whoever waited on it sees the timing
+        self._record(name, start)
+        future.set_result(result)
+
+    def _record(self, name, start):
+        with self.lock:
+            self.timings[name] = round(time.time() - start, 2)
+
+    def loaded_timings(self):
+        """Load time in seconds of every component loaded so far."""
+        with self.lock:
+            return dict(self.timings)
+
+    def prefetch(self, names):
+        for name in names:
+            future, owner = self._start(name)
+            if owner:
+                threading.Thread(target=self._load, args=(name, future), daemon=True).start()
+
+    def get(self, name):
+        future, owner = self._start(name)
+        if owner:
+            self._load(name, future)
+        return future.result()
@@ -0,0 +1,163 @@
+import os
+import re
+import json
+import fcntl
+import threading
+from contextlib import contextmanager
+import numpy as np
+from cache import text_hash
+
+PAIR_DTYPE = np.dtype([('id', '<i8'), ('score', '<f4')])
+KEY_BYTES = len(text_hash("")) + 1
+
+
+def safe_name(name):
+    return re.sub(r'[^\w.-]+', '_', name).strip('_')
+
+
+@contextmanager
+def file_lock(path):
+    """Exclusive lock on `path/lock`, held across processes sharing one cache directory."""
+    with open(os.path.join(path, "lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def truncate_to(path, size):
+    if os.path.exists(path) and os.path.getsize(path) > size:
+        os.truncate(path, size)
+
+
+class EmbeddingCache:
+    """Query embeddings of one embedding model, stored as an append-only float32 matrix
+    (`vectors.f32`, opened as a numpy memmap) plus one question hash per row (`keys.txt`)."""
+
+    def __init__(self, cache_dir, model_name):
+        self.path = os.path.join(cache_dir, "emb", safe_name(model_name))
+        os.makedirs(self.path, exist_ok=True)
+        self.lock = threading.Lock()
+        self.rows = {}
+        self.vectors = None
+        self.pending = {}
+        self.dimension = None
+        self.hits = 0
+        self.misses = 0
+        with file_lock(self.path):
+            if os.path.exists(f"{self.path}/meta.json"):
+                with open(f"{self.path}/meta.json", encoding='utf-8') as f:
+                    self.dimension = json.load(f)["dimension"]
+                count = self.repair()
+                keys = []
+                # A crash right after meta.json was first written leaves no keys file
+                if count:
+                    with open(f"{self.path}/keys.txt", encoding='utf-8') as f:
+                        keys = f.read().split()[:count]
+                if count:
+                    self.vectors = np.memmap(f"{self.path}/vectors.f32", dtype=np.float32, mode='r', shape=(count, self.dimension))
+                self.rows = {key: i for i, key in enumerate(keys)}
+
+    def repair(self):
+        """Drop the tail of an interrupted write so that row i always belongs to key i. Called with the file lock held."""
+        keys = os.path.getsize(f"{self.path}/keys.txt") // KEY_BYTES if os.path.exists(f"{self.path}/keys.txt") else 0
+        rows = os.path.getsize(f"{self.path}/vectors.f32") // (4 * self.dimension) if os.path.exists(f"{self.path}/vectors.f32") else 0
+        count = min(keys, rows)
+        truncate_to(f"{self.path}/keys.txt", count * KEY_BYTES)
+        truncate_to(f"{self.path}/vectors.f32", count * 4 * self.dimension)
+        return count
+
+    def get(self, question):
+        key = text_hash(question)
+        with self.lock:
+            if key in self.pending:
+                self.hits += 1
+                return self.pending[key]
+            if key in self.rows:
+                self.hits += 1
+                return np.array(self.vectors[self.rows[key]])
+            self.misses += 1
+            return None
+
+    def put_many(self, questions, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with self.lock, file_lock(self.path):
+            if self.dimension is None:
+                # Another process may have created the cache since this one started
+                if os.path.exists(f"{self.path}/meta.json"):
+                    with open(f"{self.path}/meta.json", encoding='utf-8') as f:
+                        self.dimension = json.load(f)["dimension"]
+                else:
+                    self.dimension = vectors.shape[1]
+                    with open(f"{self.path}/meta.json.tmp", "w", encoding='utf-8') as fout:
+                        json.dump({"dimension": self.dimension}, fout)
+                    os.replace(f"{self.path}/meta.json.tmp", f"{self.path}/meta.json")
+            self.repair()
+            with open(f"{self.path}/vectors.f32", "ab") as fout:
+                fout.write(vectors.tobytes())
+            with open(f"{self.path}/keys.txt", "a", encoding='utf-8') as fout:
+                fout.write(''.join(f"{text_hash(q)}\n" for q in questions))
+            for question, vector in zip(questions, vectors):
+                self.pending[text_hash(question)] = vector
+
+
+class RerankCache:
+    """Cross-encoder scores of (question, chunk id) pairs for one rerank model and one chunk store.
+    Scores are appended to `pairs.bin` as (chunk id, score) records; `index.jsonl` maps each
+    question hash to its record ranges. Offsets are taken from the file size under a file lock,
+    so several processes can share one cache directory."""
+
+    def __init__(self, cache_dir, model_name, corpus_key):
+        self.path = os.path.join(cache_dir, "rerank", safe_name(model_name), corpus_key)
+        os.makedirs(self.path, exist_ok=True)
+        self.lock = threading.Lock()
+        self.scores = {}
+        self.hits = 0
+        self.misses = 0
+        with file_lock(self.path):
+            count = self.repair()
+            if os.path.exists(f"{self.path}/index.jsonl"):
+                pairs = np.memmap(f"{self.path}/pairs.bin", dtype=PAIR_DTYPE, mode='r') if count else np.empty(0, dtype=PAIR_DTYPE)
+                with open(f"{self.path}/index.jsonl", encoding='utf-8') as f:
+                    for line in f:
+                        entry = json.loads(line)
+                        if entry["offset"] + entry["n"] > len(pairs):
+                            continue
+                        records = pairs[entry["offset"]:entry["offset"] + entry["n"]]
+                        self.scores.setdefault(entry["q"], {}).update(zip(records['id'].tolist(), records['score'].tolist()))
+
+    def repair(self):
+        """Drop a partially written record or index line so later appends stay aligned. Called with the file lock held."""
+        count = os.path.getsize(f"{self.path}/pairs.bin") // PAIR_DTYPE.itemsize if os.path.exists(f"{self.path}/pairs.bin") else 0
+        truncate_to(f"{self.path}/pairs.bin", count * PAIR_DTYPE.itemsize)
+        if os.path.exists(f"{self.path}/index.jsonl"):
+            with open(f"{self.path}/index.jsonl", "rb") as f:
+                data = f.read()
+            truncate_to(f"{self.path}/index.jsonl", data.rfind(b"\n") + 1)
+        return count
+
+    def get(self, question, chunk_ids):
+        """Scores aligned with `chunk_ids`, NaN where the pair has not been scored yet."""
+        with self.lock:
+            known = self.scores.get(text_hash(question), {})
+            scores = np.array([known.get(int(i), np.nan) for i in chunk_ids], dtype=np.float32)
+            found = int((~np.isnan(scores)).sum())
+            self.hits += found
+            self.misses += len(scores) - found
+            return scores
+
+    def put(self, question, chunk_ids, scores):
+        if len(chunk_ids) == 0:
+            return
+        records = np.empty(len(chunk_ids), dtype=PAIR_DTYPE)
+        records['id'] = [int(i) for i in chunk_ids]
+        records['score'] = scores
+        key = text_hash(question)
+        with self.lock, file_lock(self.path):
+            offset = self.repair()
+            with open(f"{self.path}/pairs.bin", "ab") as fout:
+                fout.write(records.tobytes())
+            with open(f"{self.path}/index.jsonl", "a", encoding='utf-8') as fout:
+                fout.write(json.dumps({"q": key, "offset": offset, "n": len(records)}) + "\n")
+            self.scores.setdefault(key, {}).update(zip(records['id'].tolist(), records['score'].tolist()))
@@ -0,0 +1,169 @@
+"""HTTP server that keeps the index, chunk store, embedder, reranker and generators loaded.
+
+Takes the same arguments as main.py; the mode flags (--rb, --rl, --ext, --fil, --ext_fil,
+--raw_pred) select which modes are loaded and served.
+
+    POST /rb, /rl, /ext, /fil, /ext_fil, /raw_pred   {"question": "..."}
+    POST /answer                                      {"question": "...", "modes": ["rb", "ext"]}
+    GET  /health
+
+Concurrent requests are grouped into one `retrieve_batch` call (embedding, FAISS search and
+rerank) of up to --max_batch_size questions, waiting at most --max_wait_ms for a batch to
+fill. Generation then runs on --workers threads per question. `/raw_pred` skips retrieval
+and asks the generator directly.
+"""
+import json
+import time
+import queue
+import threading
+from datetime import datetime
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import main
+
+# Field of each mode in the `search_q` result
+RESULT_INDEX = {"raw_pred": 3, "rb": 4, "ext": 5, "fil": 6, "rl": 7, "ext_fil": 8}
+
+
+class RetrievalBatcher:
+    """Groups questions submitted from concurrent requests into `retrieve` calls.
+
+    A batch is closed when `max_batch_size` questions are waiting or the first of them
+    has waited `max_wait` seconds. `workers` batches are retrieved concurrently.
+    """
+
+    def __init__(self, retrieve, max_batch_size=16, max_wait=0.01, workers=1):
+        self.retrieve = retrieve
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.questions = 0
+        for _ in range(workers):
+            threading.Thread(target=self._loop, daemon=True).start()
+
+    def submit(self, question):
+        """Future of `(retrieved, retrieval_stages)` for `question`."""
+        future = Future()
+        self.queue.put((question, future))
+        return future
+
+    def _loop(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            with self.lock:
+                self.batches += 1
+                self.questions += len(batch)
+            try:
+                retrieved, retrieval_stages = self.retrieve([question for question, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), r in zip(batch, retrieved):
+                future.set_result((r, retrieval_stages))
+
+
+class LongRAGHandler(BaseHTTPRequestHandler):
+
+    def _send(self, status, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/") != "/health":
+            return self._send(404, {"error": f"Unknown path {self.path}"})
+        batcher = self.server.batcher
+        self._send(200, {
+            "modes": sorted(self.server.modes),
+            "batches": batcher.batches,
+            "mean_batch_size": round(batcher.questions / batcher.batches, 2) if batcher.batches else 0.0,
+            "corpus_generation": (main.generation or {}).get("generation") if main.needs_retrieval(self.server.modes) else None,
+        })
+
+    def do_POST(self):
+        server = self.server
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except json.JSONDecodeError as e:
+            return self._send(400, {"error": f"Invalid JSON: {e}"})
+        endpoint = self.path.strip("/")
+        modes = body.get("modes", []) if endpoint == "answer" else [endpoint]
+        if endpoint != "answer" and endpoint not in RESULT_INDEX:
+            return self._send(404, {"error": f"Unknown path {self.path}"})
+        unavailable = [mode for mode in modes if mode not in server.modes]
+        if not modes or unavailable:
+            return self._send(400, {"error": f"Modes {unavailable or modes} are not served, available: {sorted(server.modes)}"})
+        question = body.get("question")
+        if not isinstance(question, str) or not question.strip():
+            return self._send(400, {"error": "A non-empty question is required"})
+
+        start = time.perf_counter()
+        try:
+            if main.needs_retrieval(modes):
+                retrieved, retrieval_stages = server.batcher.submit(question).result()
+            else:
+                retrieved, retrieval_stages = ([], [], []), {}
+            result = server.generation_pool.submit(main.search_q_traced, question, retrieved, retrieval_stages, set(modes)).result()
+        except Exception as e:
+            main.logger.exception(f"Request failed: {question}")
+            return self._send(500, {"error": f"{type(e).__name__}: {e}"})
+        payload = {
+            "question": question,
+            "answers": {mode: result[RESULT_INDEX[mode]] for mode in modes},
+            "doc_len": result[9],
+            "latency": round(time.perf_counter() - start, 4),
+        }
+        if body.get("return_passages"):
+            payload["passages"] = result[2]
+        self._send(200, payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(host="127.0.0.1", port=0, max_batch_size=16, max_wait_ms=10, retrieval_workers=1, workers=1, modes=None):
+    """Serve the loaded pipeline of `main` in a background thread and return (server, base_url)."""
+    ThreadingHTTPServer.request_queue_size = 1024
+    server = ThreadingHTTPServer((host, port), LongRAGHandler)
+    server.daemon_threads = True
+    server.modes = set(main.selected_modes() if modes is None else modes)
+    server.batcher = RetrievalBatcher(main.retrieve_batch, max_batch_size, max_wait_ms / 1000, retrieval_workers)
+    server.generation_pool = ThreadPoolExecutor(workers)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+if __name__ == '__main__':
+    main.parser.add_argument('--host', type=str, default="127.0.0.1")
+    main.parser.add_argument('--port', type=int, default=8000)
+    main.parser.add_argument('--max_batch_size', type=int, default=16, help="Maximum number of concurrent questions retrieved and reranked together")
+    main.parser.add_argument('--max_wait_ms', type=float, default=10, help="Longest time a question waits for its retrieval batch to fill")
+    main.args = args = main.parser.parse_args()
+    if not main.selected_modes():
+        main.parser.error("Select at least one mode to serve (--raw_pred, --rb, --rl, --ext, --fil, --ext_fil)")
+    now_time = datetime.now().strftime("%Y-%m-%d-%H:%M:%S")
+    main.setup(args.log_path or f'./log/server/{args.dataset}/{args.model}/{args.lrag_model or "base"}/{now_time}')
+    server, url = start_server(args.host, args.port, args.max_batch_size, args.max_wait_ms, args.retrieval_workers, args.workers)
+    main.logger.info(f"Serving {sorted(server.modes)} at {url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+        main.pred_cache.close()
+        main.tracer.close()
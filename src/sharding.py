@@ -0,0 +1,315 @@
+"""Sharded vector search. `gen_index.py --num_shards N` splits the chunks into N contiguous id
+ranges with one index each under `vector_shards/`. Every shard is searched by a node process
+and the per-shard top-k lists are merged into the global top-k, which for flat shards is the
+result of the single index.
+
+Nodes are started locally by `ShardedIndex`, or run separately, e.g. one per machine, with
+the build path they serve and a shared secret that main.py reads from the same variable:
+
+    LONGRAG_SHARD_AUTHKEY=... python sharding.py --shard_dir ../data/corpus/processed/200_2_2/hotpotqa --host 0.0.0.0 --port 9001
+
+Messages are a JSON header followed by raw numpy buffers, so a node never unpickles what it receives.
+"""
+import os
+import json
+import queue
+import socket
+import argparse
+import threading
+import multiprocessing
+from multiprocessing.connection import Listener, Client
+import numpy as np
+
+SHARD_DIR = "vector_shards"
+# Environment variable holding the secret shared by separately started nodes and their clients
+AUTHKEY_ENV = "LONGRAG_SHARD_AUTHKEY"
+ARRAY_DTYPES = {"float32", "int64", "bool"}
+MAX_MESSAGE_BYTES = 1 << 30
+MAX_TOP_K = 65536
+
+
+def shard_path(path, k):
+    return os.path.join(path, SHARD_DIR, f"shard_{k:03d}.index")
+
+def has_shards(path):
+    return os.path.exists(os.path.join(path, SHARD_DIR, "shards.json"))
+
+def load_shards_meta(path):
+    with open(os.path.join(path, SHARD_DIR, "shards.json"), encoding='utf-8') as f:
+        return json.load(f)
+
+def save_shards_meta(path, meta):
+    meta_file = os.path.join(path, SHARD_DIR, "shards.json")
+    with open(f"{meta_file}.tmp", "w", encoding='utf-8') as fout:
+        json.dump(meta, fout, indent=4)
+    os.replace(f"{meta_file}.tmp", meta_file)
+
+def take_rows(embeddings, start, end):
+    """Rows `start:end` of `embeddings`, an array or a list of arrays (e.g. memory-mapped shards) in id order."""
+    if not isinstance(embeddings, list):
+        return np.ascontiguousarray(embeddings[start:end], dtype='float32')
+    rows, offset = [], 0
+    for part in embeddings:
+        if offset < end and start < offset + len(part):
+            rows.append(part[max(start - offset, 0):min(end - offset, len(part))])
+        offset += len(part)
+    return np.ascontiguousarray(np.concatenate(rows), dtype='float32')
+
+def build_shards(embeddings, path, num_shards, index_config):
+    """Split `embeddings` into `num_shards` contiguous id ranges and build one index per range."""
+    from vector_store import build_index, save_index, set_search_params
+    total = sum(len(part) for part in embeddings) if isinstance(embeddings, list) else len(embeddings)
+    bounds = np.linspace(0, total, num_shards + 1).astype(int).tolist()
+    os.makedirs(os.path.join(path, SHARD_DIR), exist_ok=True)
+    ranges = []
+    for k, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        index = build_index(take_rows(embeddings, start, end), **index_config)
+        set_search_params(index, index_config.get("nprobe"), index_config.get("ef_search"))
+        save_index(index, shard_path(path, k), dict(index_config, ntotal=index.ntotal, start=start))
+        ranges.append([start, end])
+    dimension = (embeddings[0] if isinstance(embeddings, list) else embeddings).shape[1]
+    save_shards_meta(path, dict(index_config, num_shards=num_shards, dimension=dimension, ntotal=total, ranges=ranges))
+
+def append_to_shards(embeddings, path):
+    """Add the vectors of new chunks, whose ids follow the existing ones, to the last shard."""
+    from vector_store import load_index, save_index
+    meta = load_shards_meta(path)
+    last = meta["num_shards"] - 1
+    index, shard_meta = load_index(shard_path(path, last))
+    if shard_meta["start"] + index.ntotal != meta["ntotal"]:
+        raise ValueError(f"{shard_path(path, last)} does not end at id {meta['ntotal']}, rebuild the shards with gen_index.py --num_shards")
+    index.add(np.ascontiguousarray(embeddings, dtype='float32'))
+    save_index(index, shard_path(path, last), dict(shard_meta, ntotal=index.ntotal))
+    meta["ntotal"] += len(embeddings)
+    meta["ranges"][last][1] = meta["ntotal"]
+    save_shards_meta(path, meta)
+
+def no_delay(conn):
+    """Disable Nagle's algorithm on a connection. Large messages are sent as a header and a
+    payload, which otherwise waits for the delayed ACK of the header."""
+    with socket.fromfd(conn.fileno(), socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return conn
+
+def encode(header, *arrays):
+    """A message of the JSON-serialisable `header` followed by the raw buffers of `arrays`."""
+    header = dict(header, arrays=[{"dtype": a.dtype.name, "shape": list(a.shape)} for a in arrays])
+    meta = json.dumps(header).encode('utf-8')
+    return b''.join([len(meta).to_bytes(4, 'little'), meta] + [np.ascontiguousarray(a).tobytes() for a in arrays])
+
+def decode(data):
+    """Inverse of `encode`: the header and read-only arrays over `data`. Raises ValueError on malformed messages."""
+    size = int.from_bytes(data[:4], 'little')
+    header = json.loads(data[4:4 + size])
+    if not isinstance(header, dict) or not isinstance(header.get("arrays", []), list):
+        raise ValueError("Malformed message header")
+    arrays, offset = [], 4 + size
+    for spec in header.pop("arrays", []):
+        if spec.get("dtype") not in ARRAY_DTYPES or not all(isinstance(n, int) and n >= 0 for n in spec.get("shape", [None])):
+            raise ValueError(f"Unsupported array: {spec}")
+        dtype, count = np.dtype(spec["dtype"]), int(np.prod(spec["shape"], dtype=np.int64))
+        if offset + count * dtype.itemsize > len(data):
+            raise ValueError("Truncated message")
+        arrays.append(np.frombuffer(data, dtype, count, offset).reshape(spec["shape"]))
+        offset += count * dtype.itemsize
+    return header, arrays
+
+def is_loopback(host):
+    try:
+        return all(info[4][0] in ("127.0.0.1", "::1") or info[4][0].startswith("127.") for info in socket.getaddrinfo(host, None))
+    except socket.gaierror:
+        return False
+
+def merge_results(results, top_k):
+    """Merge per-shard (distances, global ids) into the `top_k` best per query, ties broken by id."""
+    distances = np.concatenate([d for d, _ in results], axis=1)
+    ids = np.concatenate([i for _, i in results], axis=1)
+    # Padding of shards with fewer than top_k results sorts last
+    distances = np.where(ids < 0, -np.inf, distances)
+    order = np.lexsort((np.where(ids < 0, np.iinfo(np.int64).max, ids), -distances), axis=-1)[:, :top_k]
+    return np.take_along_axis(distances, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+
+class ShardNode:
+    """Serves searches over the shards of the build in `shard_dir`. An index is loaded once per
+    file version and shared by all connections; every connection has its own shard and tombstones.
+    Clients only choose a shard number, never a path."""
+
+    def __init__(self, shard_dir, threads=None):
+        import faiss
+        if threads:
+            faiss.omp_set_num_threads(threads)
+        self.shard_dir = shard_dir
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def load(self, k, nprobe=None, ef_search=None):
+        from vector_store import load_index
+        num_shards = load_shards_meta(self.shard_dir)["num_shards"]
+        if not isinstance(k, int) or not 0 <= k < num_shards:
+            raise ValueError(f"Unknown shard {k}, {self.shard_dir} has {num_shards} shards")
+        if not all(v is None or isinstance(v, int) and v > 0 for v in (nprobe, ef_search)):
+            raise ValueError("nprobe and ef_search must be positive integers")
+        index_path = shard_path(self.shard_dir, k)
+        key = (k, os.path.getmtime(index_path), nprobe, ef_search)
+        with self.lock:
+            if key not in self.indexes:
+                # Versions of the file that were replaced are dropped once their connections close
+                self.indexes = {other: v for other, v in self.indexes.items() if other[0] != k}
+                self.indexes[key] = load_index(index_path, nprobe, ef_search)
+            return self.indexes[key]
+
+    def handle(self, conn):
+        from vector_store import search_params
+        index, offset, params = None, 0, None
+        with conn:
+            while True:
+                try:
+                    data = conn.recv_bytes(MAX_MESSAGE_BYTES)
+                except (EOFError, OSError):
+                    break
+                try:
+                    header, arrays = decode(data)
+                    op = header.get("op")
+                    if op != "open" and index is None:
+                        raise ValueError("No shard opened")
+                    if op == "open":
+                        (index, meta), params = self.load(header.get("shard"), header.get("nprobe"), header.get("ef_search")), None
+                        offset = meta["start"]
+                        conn.send_bytes(encode({"status": "ok", "start": offset, "ntotal": index.ntotal}))
+                    elif op == "deleted":
+                        params = search_params(index, arrays[0].astype(bool))
+                        conn.send_bytes(encode({"status": "ok"}))
+                    elif op == "search":
+                        queries, top_k = arrays[0], header.get("top_k")
+                        if queries.dtype != np.float32 or queries.ndim != 2 or queries.shape[1] != index.d:
+                            raise ValueError(f"Queries must be float32 of shape (n, {index.d})")
+                        if not isinstance(top_k, int) or not 0 < top_k <= MAX_TOP_K:
+                            raise ValueError(f"top_k must be an integer in [1, {MAX_TOP_K}]")
+                        distances, ids = index.search(np.ascontiguousarray(queries), top_k, params=params)
+                        conn.send_bytes(encode({"status": "ok"}, distances, np.where(ids >= 0, ids + offset, -1)))
+                    else:
+                        raise ValueError(f"Unknown operation: {op}")
+                except Exception as e:
+                    conn.send_bytes(encode({"status": "error", "error": f"{type(e).__name__}: {e}"}))
+
+    def serve(self, address, authkey, ready=None):
+        if not authkey:
+            raise ValueError("Shard nodes require an authkey")
+        with Listener(address, authkey=authkey) as listener:
+            if ready is not None:
+                ready.put(listener.address)
+            while True:
+                try:
+                    conn = listener.accept()
+                except (OSError, EOFError, multiprocessing.AuthenticationError):
+                    # Failed handshakes are dropped without ending the node
+                    continue
+                threading.Thread(target=self.handle, args=(no_delay(conn),), daemon=True).start()
+
+
+def run_node(address, authkey, shard_dir, threads, ready):
+    ShardNode(shard_dir, threads).serve(address, authkey, ready)
+
+
+class ShardedIndex:
+    """Client of the shard nodes with the `ntotal`/`d`/`search` interface of a FAISS index.
+
+    Without `nodes`, one node process per shard is started on this machine with a random
+    authkey. Otherwise the shards are assigned to the given `host:port` nodes in turn, which
+    must serve the same build and share `authkey` (by default read from $LONGRAG_SHARD_AUTHKEY).
+    `connections` searches run concurrently, each over its own
+    connection to every shard; a search sends the queries to all shards before waiting for
+    any of them, so the shards are searched in parallel.
+    """
+
+    def __init__(self, path, nodes=None, connections=1, threads=None, nprobe=None, ef_search=None, authkey=None):
+        self.meta = load_shards_meta(path)
+        self.ntotal = self.meta["ntotal"]
+        self.d = self.meta["dimension"]
+        self.connections = connections
+        self.processes = []
+        num_shards = self.meta["num_shards"]
+        if nodes:
+            authkey = authkey or os.environ.get(AUTHKEY_ENV, "").encode()
+            if not authkey:
+                raise ValueError(f"Set {AUTHKEY_ENV} to the authkey of the shard nodes")
+            addresses = [(host, int(port)) for host, port in (node.rsplit(":", 1) for node in nodes)]
+        else:
+            authkey = os.urandom(32)
+            context = multiprocessing.get_context("spawn")
+            ready = context.Queue()
+            threads = threads or max(1, (os.cpu_count() or 1) // num_shards)
+            for _ in range(num_shards):
+                process = context.Process(target=run_node, args=(("127.0.0.1", 0), authkey, path, threads, ready), daemon=True)
+                process.start()
+                self.processes.append(process)
+            addresses = [ready.get(timeout=600) for _ in range(num_shards)]
+        self.channels = queue.Queue()
+        for _ in range(connections):
+            channel = []
+            for k in range(num_shards):
+                conn = no_delay(Client(tuple(addresses[k % len(addresses)]), authkey=authkey))
+                channel.append(conn)
+            opened = self._broadcast(channel, [encode({"op": "open", "shard": k, "nprobe": nprobe, "ef_search": ef_search}) for k in range(num_shards)])
+            for k, ((header, _), (start, end)) in enumerate(zip(opened, self.meta["ranges"])):
+                if (header["start"], header["start"] + header["ntotal"]) != (start, end):
+                    raise RuntimeError(f"Shard {k} of node {addresses[k % len(addresses)]} covers ids {header['start']}:{header['start'] + header['ntotal']}, not {start}:{end}")
+            self.channels.put(channel)
+
+    @staticmethod
+    def _receive(conn):
+        header, arrays = decode(conn.recv_bytes())
+        if header.get("status") != "ok":
+            raise RuntimeError(f"Shard node failed: {header.get('error')}")
+        return header, arrays
+
+    def _broadcast(self, channel, messages):
+        for conn, message in zip(channel, messages):
+            conn.send_bytes(message)
+        return [self._receive(conn) for conn in channel]
+
+    def set_deleted(self, deleted):
+        """Skip the chunks marked in the boolean mask `deleted` in all following searches."""
+        # Waits for the in-flight searches so that every connection gets the mask
+        channels = [self.channels.get() for _ in range(self.connections)]
+        try:
+            for channel in channels:
+                self._broadcast(channel, [encode({"op": "deleted"}, np.asarray(deleted[start:end], dtype=bool)) for start, end in self.meta["ranges"]])
+        finally:
+            for channel in channels:
+                self.channels.put(channel)
+
+    def search(self, queries, top_k, params=None):
+        queries = np.ascontiguousarray(queries, dtype='float32')
+        channel = self.channels.get()
+        try:
+            results = self._broadcast(channel, [encode({"op": "search", "top_k": int(top_k)}, queries)] * len(channel))
+        finally:
+            self.channels.put(channel)
+        return merge_results([arrays for _, arrays in results], top_k)
+
+    def close(self):
+        """Close the connections once in-flight searches are done and stop the local nodes."""
+        for _ in range(self.connections):
+            for conn in self.channels.get():
+                conn.close()
+        for process in self.processes:
+            process.terminate()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Shard node serving searches over shard indexes built by gen_index.py --num_shards.")
+    parser.add_argument('--shard_dir', type=str, required=True, help="Build path whose vector_shards/ this node serves")
+    parser.add_argument('--host', type=str, default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=9001)
+    parser.add_argument('--threads', type=int, default=None, help="FAISS threads of this node")
+    parser.add_argument('--authkey', type=str, default="", help=f"Secret shared with the clients, read from ${AUTHKEY_ENV} if empty")
+    args = parser.parse_args()
+    authkey = (args.authkey or os.environ.get(AUTHKEY_ENV, "")).encode()
+    if not authkey:
+        parser.error(f"Set --authkey or ${AUTHKEY_ENV}{'' if is_loopback(args.host) else f', {args.host} is reachable from other machines'}")
+    if not has_shards(args.shard_dir):
+        parser.error(f"No shard indexes in {args.shard_dir}, build them with gen_index.py --num_shards")
+    print(f"Shard node serving {args.shard_dir} on {args.host}:{args.port}")
+    ShardNode(args.shard_dir, args.threads).serve((args.host, args.port), authkey)
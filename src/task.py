@@ -11,10 +11,11 @@ model2path = config["model_path"]["chatglm3-6b-32k"]
 tokenizer = AutoTokenizer.from_pretrained(model2path, trust_remote_code=True)
 
 from api import call_api
+from tokens import TokenCounter
+token_counter = TokenCounter(tokenizer)
     
 def get_word_len(input):
-    tokenized_prompt = tokenizer(input, truncation=False, return_tensors="pt", add_special_tokens=False).input_ids[0]
-    return len(tokenized_prompt)
+    return token_counter.length(input)
 
 
 def build_ext_instruction(model, question, answer, content, support, min_res_tokens):
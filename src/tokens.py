@@ -0,0 +1,72 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+from cache import text_hash
+
+
+class TokenCounter:
+    """Token ids of texts under one tokenizer, kept in an LRU cache keyed by text hash.
+
+    Ids are stored as uint32 arrays (4 bytes per token), and the cache is bounded by the total
+    number of cached tokens. `lengths` encodes all uncached texts with a single batched tokenizer call.
+    """
+
+    def __init__(self, tokenizer, max_tokens=5000000):
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.cached_tokens = 0
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, key):
+        with self.lock:
+            ids = self.cache.get(key)
+            if ids is not None:
+                self.cache.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return ids
+
+    def _put(self, key, ids):
+        with self.lock:
+            if key in self.cache:
+                return self.cache[key]
+            self.cache[key] = ids = np.asarray(ids, dtype=np.uint32)
+            self.cached_tokens += len(ids)
+            while self.cached_tokens > self.max_tokens and len(self.cache) > 1:
+                _, evicted = self.cache.popitem(last=False)
+                self.cached_tokens -= len(evicted)
+            return ids
+
+    def encode(self, text, cache=True):
+        """Token ids of `text`. With `cache=False` the text is neither looked up nor stored,
+        for one-off texts such as whole prompts."""
+        if not cache:
+            return self.tokenizer(text, truncation=False, add_special_tokens=False).input_ids
+        key = text_hash(text)
+        ids = self._get(key)
+        if ids is None:
+            ids = self._put(key, self.tokenizer(text, truncation=False, add_special_tokens=False).input_ids)
+        return ids
+
+    def length(self, text):
+        return len(self.encode(text))
+
+    def lengths(self, texts):
+        keys = [text_hash(text) for text in texts]
+        ids = [self._get(key) for key in keys]
+        missing = [i for i, v in enumerate(ids) if v is None]
+        if missing:
+            encoded = self.tokenizer([texts[i] for i in missing], truncation=False, add_special_tokens=False).input_ids
+            for i, v in zip(missing, encoded):
+                ids[i] = v
+                self._put(keys[i], v)
+        return [len(v) for v in ids]
+
+    def decode(self, ids):
+        if isinstance(ids, np.ndarray):
+            ids = ids.tolist()
+        return self.tokenizer.decode(ids, skip_special_tokens=True)
@@ -0,0 +1,155 @@
+import json
+import time
+import threading
+from contextlib import nullcontext
+from collections import defaultdict
+
+NULL_SPAN = nullcontext()
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(q / 100 * len(values))) - 1))]
+
+
+class Span:
+    __slots__ = ("tracer", "name", "start")
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.tracer._stack().append(self.name)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        self.tracer._stack().pop()
+        self.tracer.add_time(self.name, elapsed)
+
+
+class Tracer:
+    """Per-stage wall time, token counts and counters of a run.
+
+    Every span is aggregated over the run. Spans and tokens recorded on a thread that is
+    working on a question are also stored in that question's record, which is written as
+    one line of the JSONL trace when the question finishes. Tokens are attributed to the
+    innermost open span. A tracer without a path is disabled: `span` returns a shared
+    no-op context manager and the other methods return immediately.
+    """
+
+    def __init__(self, path=None):
+        self.enabled = bool(path)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.durations = defaultdict(list)
+        self.tokens = defaultdict(lambda: [0, 0])
+        self.counters = defaultdict(int)
+        self.fout = open(path, "a", encoding='utf-8') if self.enabled else None
+
+    def _stack(self):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def _record(self):
+        return getattr(self.local, "record", None)
+
+    def span(self, name):
+        return Span(self, name) if self.enabled else NULL_SPAN
+
+    def add_time(self, name, seconds):
+        if not self.enabled:
+            return
+        record = self._record()
+        # Batch stages are added to the run durations per question by `finish_batch`
+        if record is None or "question" in record:
+            with self.lock:
+                self.durations[name].append(seconds)
+        if record is not None:
+            record["stages"][name] = record["stages"].get(name, 0) + seconds
+
+    def add_tokens(self, prompt_tokens, completion_tokens):
+        if not self.enabled:
+            return
+        stack = self._stack()
+        name = stack[-1] if stack else "other"
+        with self.lock:
+            self.tokens[name][0] += prompt_tokens
+            self.tokens[name][1] += completion_tokens
+        record = self._record()
+        if record is not None:
+            prompt, completion = record["tokens"].get(name, (0, 0))
+            record["tokens"][name] = (prompt + prompt_tokens, completion + completion_tokens)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] += n
+        record = self._record()
+        if record is not None:
+            record["counters"][name] = record["counters"].get(name, 0) + n
+
+    def start_batch(self):
+        if self.enabled:
+            self.local.record = {"stages": {}, "tokens": {}, "counters": {}}
+
+    def finish_batch(self, size):
+        """Stage times of the batch on this thread, split evenly over its `size` questions. The
+        run durations get one such share per question, so that all stages are per question."""
+        record = self._record()
+        self.local.record = None
+        if record is None:
+            return {}
+        shares = {name: seconds / size for name, seconds in record["stages"].items()}
+        with self.lock:
+            for name, share in shares.items():
+                self.durations[name].extend([share] * size)
+        return shares
+
+    def start_question(self, question, shared_stages=None):
+        if self.enabled:
+            self.local.record = {"question": question, "stages": dict(shared_stages or {}), "tokens": {}, "counters": {}}
+
+    def finish_question(self):
+        record = self._record()
+        if record is None:
+            return
+        self.local.record = None
+        record["tokens"] = {name: {"prompt": p, "completion": c} for name, (p, c) in record["tokens"].items()}
+        with self.lock:
+            self.fout.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.fout.flush()
+
+    def summary(self, caches=None):
+        """p50/p95/p99 per stage, token throughput per stage and cache hit rates.
+        `caches` maps a cache name to its (hits, misses)."""
+        if not self.enabled:
+            return {}
+        with self.lock:
+            stages = {name: {
+                "count": len(values),
+                "total": round(sum(values), 4),
+                "mean": round(sum(values) / len(values), 4),
+                "p50": round(percentile(values, 50), 4),
+                "p95": round(percentile(values, 95), 4),
+                "p99": round(percentile(values, 99), 4),
+            } for name, values in self.durations.items()}
+            tokens = {name: {
+                "prompt": prompt,
+                "completion": completion,
+                "completion_tokens_per_s": round(completion / sum(self.durations[name]), 2) if sum(self.durations.get(name, [])) else 0.0,
+            } for name, (prompt, completion) in self.tokens.items()}
+            counters = dict(self.counters)
+        hit_rates = {name: {"hits": hits, "misses": misses, "hit_rate": round(hits / (hits + misses), 4) if hits + misses else 0.0} for name, (hits, misses) in (caches or {}).items()}
+        return {"stages": stages, "tokens": tokens, "counters": counters, "cache": hit_rates}
+
+    def close(self):
+        if self.fout is not None:
+            self.fout.close()
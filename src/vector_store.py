@@ -0,0 +1,109 @@
+import os
+import json
+import numpy as np
+import faiss
+
+INDEX_TYPES = ["flat", "ivf_flat", "ivf_pq", "hnsw", "sq8"]
+
+
+def meta_path(index_path):
+    return f"{index_path}.meta.json"
+
+def create_index(dimension, index_type="flat", nlist=1024, pq_m=64, hnsw_m=32, ef_construction=200, **kwargs):
+    if index_type == "flat":
+        return faiss.IndexFlatIP(dimension)
+    if index_type == "ivf_flat":
+        quantizer = faiss.IndexFlatIP(dimension)
+        return faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_INNER_PRODUCT)
+    if index_type == "ivf_pq":
+        if dimension % pq_m != 0:
+            raise ValueError(f"pq_m={pq_m} must divide the embedding dimension {dimension}")
+        quantizer = faiss.IndexFlatIP(dimension)
+        return faiss.IndexIVFPQ(quantizer, dimension, nlist, pq_m, 8, faiss.METRIC_INNER_PRODUCT)
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dimension, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = ef_construction
+        return index
+    if index_type == "sq8":
+        return faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+    raise ValueError(f"Unknown index type: {index_type}")
+
+def train_index(index, embeddings, train_size=100000, seed=42):
+    if index.is_trained:
+        return
+    rng = np.random.default_rng(seed)
+    sample = embeddings if len(embeddings) <= train_size else embeddings[np.sort(rng.choice(len(embeddings), train_size, replace=False))]
+    index.train(np.ascontiguousarray(sample, dtype='float32'))
+
+def set_search_params(index, nprobe=None, ef_search=None):
+    params = faiss.ParameterSpace()
+    if nprobe and faiss.try_extract_index_ivf(index) is not None:
+        params.set_index_parameter(index, "nprobe", nprobe)
+    if ef_search and hasattr(index, "hnsw"):
+        params.set_index_parameter(index, "efSearch", ef_search)
+
+def build_index(embeddings, index_type="flat", nlist=1024, train_size=100000, **kwargs):
+    embeddings = np.ascontiguousarray(embeddings, dtype='float32')
+    # IVF needs at least one training point per list
+    nlist = max(1, min(nlist, len(embeddings), train_size))
+    index = create_index(embeddings.shape[1], index_type, nlist=nlist, **kwargs)
+    train_index(index, embeddings, train_size)
+    index.add(embeddings)
+    return index
+
+def evaluate_recall(index, embeddings, top_k=100, num_queries=1000, seed=42):
+    """Recall@top_k of `index` against exhaustive inner-product search, using corpus vectors as queries.
+
+    `embeddings` may also be a list of shards (e.g. memory-mapped .npy files) in index order.
+    """
+    shards = embeddings if isinstance(embeddings, list) else [embeddings]
+    total = sum(len(shard) for shard in shards)
+    flat = faiss.IndexFlatIP(shards[0].shape[1])
+    for shard in shards:
+        flat.add(np.ascontiguousarray(shard, dtype='float32'))
+    rng = np.random.default_rng(seed)
+    positions = np.sort(rng.choice(total, min(num_queries, total), replace=False))
+    queries = np.vstack([flat.reconstruct(int(i)) for i in positions]) if len(shards) > 1 else shards[0][positions]
+    queries = np.ascontiguousarray(queries, dtype='float32')
+    top_k = min(top_k, total)
+    _, truth = flat.search(queries, top_k)
+    _, approx = index.search(queries, top_k)
+    hits = sum(len(set(t) & set(a)) for t, a in zip(truth, approx))
+    return hits / (len(queries) * top_k)
+
+def save_index(index, index_path, meta):
+    # Written to temporary files first so that readers never load a partially written index
+    faiss.write_index(index, f"{index_path}.tmp")
+    with open(f"{meta_path(index_path)}.tmp", "w", encoding='utf-8') as fout:
+        json.dump(meta, fout, ensure_ascii=False, indent=4)
+    os.replace(f"{index_path}.tmp", index_path)
+    os.replace(f"{meta_path(index_path)}.tmp", meta_path(index_path))
+
+def load_index(index_path, nprobe=None, ef_search=None):
+    index = faiss.read_index(index_path)
+    meta = {"index_type": "flat"}
+    if os.path.exists(meta_path(index_path)):
+        with open(meta_path(index_path), encoding='utf-8') as f:
+            meta = json.load(f)
+    set_search_params(index, nprobe or meta.get("nprobe"), ef_search or meta.get("ef_search"))
+    return index, meta
+
+def search_params(index, deleted):
+    """Search parameters that skip the vectors marked in the boolean mask `deleted` and keep the
+    nprobe/efSearch set on `index`, or None if nothing is deleted."""
+    if deleted is None or not deleted.any():
+        return None
+    live = np.ones(index.ntotal, dtype=bool)
+    live[:len(deleted)] = ~deleted[:index.ntotal]
+    bitmap = np.packbits(live, bitorder='little')
+    selector = faiss.IDSelectorBitmap(len(live), faiss.swig_ptr(bitmap))
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        params = faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe)
+    elif hasattr(index, "hnsw"):
+        params = faiss.SearchParametersHNSW(sel=selector, efSearch=index.hnsw.efSearch)
+    else:
+        params = faiss.SearchParameters(sel=selector)
+    # The selector only points to the bitmap, both have to outlive the parameters
+    params.referenced_objects = [selector, bitmap]
+    return params